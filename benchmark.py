@@ -0,0 +1,192 @@
+"""Benchmarks of the reader, of smooth_combine and of whole runs on synthetic releases
+
+    python benchmark.py --nside 32 64 128 --repeat 3
+
+writes for each nside a synthetic release at twice the nside in a temporary
+folder, see synthetic.py, and times, best and mean of repeat calls:
+
+ * read_map: DXReader.__call__ of the IQU full mission map, downgraded to nside
+ * read_masks: DXReader.read_masks
+ * combine_maps: difference of the IQU halfring maps
+ * smooth_combine: halfring difference with its variance, chi2 and spectra
+ * run_null: a serial run_null.py run of the halfrings and surveydiff tests
+   of the frequency in a subprocess, --no-run leaves it out
+
+Each invocation appends a json line with the commit, host, versions and
+results to benchmarks.jsonl (--output), --compare prints the ratio of the
+last record to the previous one, or to the last record of a given commit:
+
+    python benchmark.py --compare
+    python benchmark.py --compare a1b2c3d
+"""
+
+import os
+import sys
+import json
+import time
+import shutil
+import socket
+import argparse
+import subprocess
+import exceptions
+import numpy as np
+import healpy as hp
+
+import synthetic
+from reader import DXReader
+from differences import combine_maps, smooth_combine, halfrings_output
+
+FILENAME = "benchmarks.jsonl"
+NSIDES = [32, 64, 128]
+RUN_NULL = os.path.join(os.path.dirname(os.path.abspath(__file__)), "run_null.py")
+
+def time_call(function, repeat=3):
+    """Seconds of repeat calls of function"""
+    seconds = []
+    for i in range(repeat):
+        start = time.time()
+        function()
+        seconds.append(time.time() - start)
+    return seconds
+
+def git_commit(folder=None):
+    """Short hash of the commit of the code, with a + if it has uncommitted changes, None outside git"""
+    folder = folder or os.path.dirname(os.path.abspath(__file__))
+    try:
+        commit = subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], cwd=folder).strip()
+        if subprocess.check_output(["git", "status", "--porcelain", "--untracked-files=no"], cwd=folder).strip():
+            commit += "+"
+        return commit
+    except (exceptions.OSError, subprocess.CalledProcessError):
+        return None
+
+def run_benchmarks(nsides=NSIDES, freq=30, repeat=3, run=True, keep=False):
+    """Run the benchmarks at each nside
+
+    Parameters
+    ----------
+    nsides : list of ints
+        nside of the reader, the releases are written at twice the nside
+    freq : int
+        frequency of the maps
+    repeat : int
+        calls of each benchmark, run_null runs once
+    run : bool
+        whether to benchmark a whole run_null.py run
+    keep : bool
+        keep the synthetic releases and the outputs, else removed
+
+    Returns
+    -------
+    results : list of dicts
+        benchmark, nside, best and mean seconds and repeat of each benchmark
+    """
+    results = []
+    def add(benchmark, nside, seconds):
+        results.append(dict(benchmark=benchmark, nside=nside, best=min(seconds), mean=np.mean(seconds), repeat=len(seconds)))
+        print "%-16s nside %4d: %.4f s" % (benchmark, nside, min(seconds))
+
+    for nside in nsides:
+        reader_conf = synthetic.make_release(2 * nside, freqs=[freq])
+        base_dir = os.path.dirname(reader_conf)
+        try:
+            mapreader = DXReader(reader_conf, nside=nside)
+            add("read_map", nside, time_call(lambda: mapreader(freq, "full", halfring=0, pol="IQU"), repeat))
+            add("read_masks", nside, time_call(lambda: mapreader.read_masks(freq), repeat))
+
+            ps_mask, union_mask, galaxy_mask = mapreader.read_masks(freq)
+            maps = [mapreader(freq, "full", halfring=halfring, pol="IQU") for halfring in [1, 2]]
+            variance_maps = [mapreader(freq, "full", halfring=halfring, pol="ADF") for halfring in [1, 2]]
+            add("combine_maps", nside, time_call(lambda: combine_maps([(maps[0], 1), (maps[1], -1)]), repeat))
+
+            root_folder = os.path.join(base_dir, "out")
+            base_filename, metadata = halfrings_output(freq, "", "full")
+            os.makedirs(os.path.join(root_folder, "halfrings"))
+            add("smooth_combine", nside, time_call(lambda: smooth_combine([(maps[0], 1), (maps[1], -1)],
+                                                                          [(variance_maps[0], 1.), (variance_maps[1], 1.)],
+                                                                          fwhm=np.radians(10.), degraded_nside=max(1, nside // 4),
+                                                                          spectra=True, chi2=True, smooth_mask=ps_mask,
+                                                                          spectra_mask=union_mask, galaxy_mask=galaxy_mask,
+                                                                          base_filename=base_filename, root_folder=root_folder,
+                                                                          metadata=dict(metadata)), repeat))
+
+            if run:
+                run_conf = synthetic.make_run_config(reader_conf, os.path.join(base_dir, "run"), nside, freqs=[freq])
+                with open(os.path.join(base_dir, "run_null.log"), "w") as f:
+                    add("run_null", nside, time_call(lambda: subprocess.check_call([sys.executable, RUN_NULL, run_conf],
+                                                                                   stdout=f, stderr=subprocess.STDOUT), 1))
+        finally:
+            if keep:
+                print "Release and outputs at nside %d kept in %s" % (2 * nside, base_dir)
+            else:
+                shutil.rmtree(base_dir)
+    return results
+
+def record(results, filename=FILENAME, label=None, freq=30):
+    """Append the results of a benchmark run with the commit and versions of the code"""
+    entry = dict(commit=git_commit(), label=label, date=time.strftime("%Y-%m-%d %H:%M:%S"), host=socket.gethostname(),
+                 python=sys.version.split()[0], numpy=np.__version__, healpy=hp.__version__, freq=freq, results=results)
+    with open(filename, "a") as f:
+        f.write(json.dumps(entry, sort_keys=True) + "\n")
+    return entry
+
+def load(filename=FILENAME):
+    """Records of the previous benchmark runs, oldest first"""
+    try:
+        with open(filename) as f:
+            return [json.loads(line) for line in f if line.strip()]
+    except exceptions.IOError:
+        return []
+
+def compare(records, baseline=None):
+    """Table of the best times of the last record and of a baseline
+
+    Parameters
+    ----------
+    records : list of dicts
+        see load
+    baseline : string or None
+        commit or label of the baseline record, its last record is used,
+        by default the record before the last
+
+    Returns
+    -------
+    table : string
+        best seconds of each benchmark and ratio to the baseline
+    """
+    if not records:
+        return "No benchmark records"
+    current = records[-1]
+    if baseline is None:
+        previous = records[:-1]
+    else:
+        previous = [entry for entry in records[:-1] if baseline in [entry["commit"], entry.get("label")]]
+    if not previous:
+        return "No baseline record to compare with"
+    base = previous[-1]
+    base_times = dict(((r["benchmark"], r["nside"]), r["best"]) for r in base["results"])
+    lines = ["%s (%s) vs %s (%s)" % (current["commit"], current["date"], base["commit"], base["date"]),
+             "%-16s %6s %12s %12s %7s" % ("Benchmark", "Nside", "Base [s]", "Current [s]", "Ratio")]
+    for r in current["results"]:
+        base_time = base_times.get((r["benchmark"], r["nside"]))
+        if base_time is None:
+            lines.append("%-16s %6d %12s %12.4f %7s" % (r["benchmark"], r["nside"], "-", r["best"], "-"))
+        else:
+            lines.append("%-16s %6d %12.4f %12.4f %7.2f" % (r["benchmark"], r["nside"], base_time, r["best"], r["best"] / base_time))
+    return "\n".join(lines)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the reader, smooth_combine and whole runs on synthetic releases")
+    parser.add_argument("--nside", type=int, nargs="+", default=NSIDES, help="nsides of the benchmarks")
+    parser.add_argument("--freq", type=int, default=30, help="frequency of the maps")
+    parser.add_argument("--repeat", type=int, default=3, help="calls of each benchmark, the best is compared")
+    parser.add_argument("--no-run", action="store_true", help="do not benchmark a whole run_null.py run")
+    parser.add_argument("--keep", action="store_true", help="keep the synthetic releases and the outputs")
+    parser.add_argument("--label", help="label of the record, e.g. a branch name")
+    parser.add_argument("--output", default=FILENAME, help="json lines file of the records")
+    parser.add_argument("--compare", nargs="?", const="", help="only compare the last record with the previous one or with the last record of a commit or label")
+    args = parser.parse_args()
+    if args.compare is None:
+        results = run_benchmarks(args.nside, args.freq, args.repeat, run=not args.no_run, keep=args.keep)
+        record(results, args.output, args.label, args.freq)
+    print compare(load(args.output), args.compare or None)
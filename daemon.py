@@ -0,0 +1,265 @@
+"""Warm worker daemon for interactive null tests
+
+Launch script as:
+
+    python daemon.py run_dx11.conf [--socket /tmp/plancknull.sock]
+
+The daemon keeps healpy imported and the reader of the run configuration
+with its masks and a map cache, see reader.CachedReader, of
+`daemon_cache_maps` maps (32 by default) in the [run] section, and runs the
+null tests requested over a Unix socket, by default `daemon_socket` in the
+[run] section or /tmp/plancknull_<user>/daemon.sock. The socket is created
+readable only by its owner, in a folder only its owner can enter, and the
+clients authenticate with a random key the daemon writes, also readable only
+by its owner, next to the socket with the .key suffix: requests are
+unpickled, other users must not be able to send them.
+
+From a notebook:
+
+    from plancknull.daemon import DaemonClient
+    client = DaemonClient()
+    result = client.halfrings(70, "LFI18", "full", pol="IQU", arrays=True)
+    result["outputs"], result["metadata"], result["maps"], result["cls"]
+
+Each request returns the paths of the outputs of the test, their metadata
+and, with arrays=True, the output maps and spectra. A request already served
+with the same smooth_combine configuration and output folder answers from
+the existing outputs, a changed request only reads the maps missing from the
+cache. `reset` empties the caches, e.g. after the input maps are modified.
+"""
+
+import os
+import sys
+import json
+import time
+import getpass
+import argparse
+import traceback
+import exceptions
+import logging as log
+from multiprocessing.connection import Listener, Client
+from multiprocessing import AuthenticationError
+import healpy as hp
+
+from reader import CachedReader
+from tasks import Task, run_task, task_outputs
+
+KEY_SUFFIX = ".key"
+
+def default_address():
+    return os.path.join("/tmp", "plancknull_%s" % getpass.getuser(), "daemon.sock")
+
+def key_filename(address):
+    """File of the authentication key of the daemon listening on address"""
+    return address + KEY_SUFFIX
+
+def private_folder(folder):
+    """Create folder readable only by its owner, or check an existing one is"""
+    if not os.path.isdir(folder):
+        os.makedirs(folder, 0700)
+    info = os.stat(folder)
+    if info.st_uid != os.getuid() or info.st_mode & 0077:
+        raise exceptions.OSError("%s must be owned by the user and not accessible by others" % folder)
+
+def write_key(address):
+    """Write a new random authentication key readable only by its owner"""
+    authkey = os.urandom(32)
+    filename = key_filename(address)
+    if os.path.exists(filename):
+        os.remove(filename)
+    fd = os.open(filename, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0600)
+    with os.fdopen(fd, "wb") as f:
+        f.write(authkey)
+    return authkey
+
+def read_key(address):
+    with open(key_filename(address), "rb") as f:
+        return f.read()
+
+class NullTestDaemon(object):
+    """Serves null test requests with a warm reader
+
+    Parameters
+    ----------
+    config_filename : string
+        run configuration file, see run_dx11.conf
+    address : string or None
+        path of the Unix socket, by default `daemon_socket` in the [run]
+        section or default_address()
+    """
+
+    def __init__(self, config_filename, address=None):
+        # imported here, runner imports the parallel back ends
+        from runner import Run
+        run = Run(config_filename)
+        self.address = address or run.option("daemon_socket", default_address())
+        self.mapreader = CachedReader(run.mapreader, max_maps=run.option("daemon_cache_maps", 32, "getint"))
+        self.smooth_combine_config = run.smooth_combine_config
+        self.root_folder = run.root_folder
+        self.served = {}
+        self.start = time.time()
+        self.requests = 0
+
+    def outputs(self, task, root_folder):
+        return [os.path.join(root_folder, base_filename) for base_filename in task_outputs(task)]
+
+    def run(self, request):
+        """Run the null test of a request, unless its outputs are up to date
+
+        Parameters
+        ----------
+        request : dict
+            task, the fields of a tasks.Task; smooth_combine, overrides of the
+            smooth_combine configuration, e.g. {"fwhm": np.radians(5)};
+            root_folder, by default the output folder of the configuration;
+            arrays, whether to return the output maps and spectra
+        """
+        task = Task(*request["task"])
+        smooth_combine_config = dict(self.smooth_combine_config, **request.get("smooth_combine", {}))
+        root_folder = request.get("root_folder", self.root_folder)
+        key = (task, tuple(sorted(smooth_combine_config.items())), root_folder)
+        outputs = self.outputs(task, root_folder)
+        cached = key in self.served and all(os.path.exists(output + "_map.json") for output in outputs)
+        if not cached:
+            run_task(task, self.mapreader, smooth_combine_config, root_folder)
+            self.served[key] = True
+        response = dict(status="done", cached=cached, outputs=outputs, metadata=[])
+        for output in outputs:
+            with open(output + "_map.json") as f:
+                response["metadata"].append(json.load(f))
+        if request.get("arrays"):
+            response["maps"] = [hp.read_map(output + "_map.fits", field=None, verbose=False) for output in outputs]
+            if smooth_combine_config["spectra"]:
+                response["cls"] = [hp.read_cl(output + "_cl.fits") for output in outputs]
+        return response
+
+    def stats(self):
+        return dict(status="done", requests=self.requests, served=len(self.served),
+                    cache_hits=self.mapreader.hits, cache_misses=self.mapreader.misses,
+                    cached_maps=len(self.mapreader.maps), uptime=time.time() - self.start)
+
+    def reset(self):
+        self.mapreader.maps.clear()
+        self.mapreader.masks.clear()
+        self.served.clear()
+        return dict(status="done")
+
+    def handle(self, request):
+        """Response to a request, its command is "run" (default), "stats", "reset" or "shutdown" """
+        self.requests += 1
+        start = time.time()
+        command = request.get("command", "run")
+        try:
+            if command == "run":
+                response = self.run(request)
+            elif command == "stats":
+                response = self.stats()
+            elif command == "reset":
+                response = self.reset()
+            elif command == "shutdown":
+                response = dict(status="done")
+            else:
+                raise ValueError("Unknown command " + command)
+        except exceptions.Exception:
+            log.error("FAILED request %s" % str(request))
+            response = dict(status="failed", error=traceback.format_exc())
+        response["time"] = time.time() - start
+        return response
+
+    def serve(self):
+        """Serve requests, one at a time, until a shutdown request"""
+        folder = os.path.dirname(os.path.abspath(self.address))
+        if self.address == default_address():
+            private_folder(folder)
+        if os.path.exists(self.address):
+            os.remove(self.address)
+        # socket and key are created readable only by the owner, never accessible to others
+        umask = os.umask(0077)
+        try:
+            authkey = write_key(self.address)
+            listener = Listener(self.address, family="AF_UNIX", authkey=authkey)
+        finally:
+            os.umask(umask)
+        log.info("Null tests daemon listening on " + self.address)
+        try:
+            while True:
+                try:
+                    connection = listener.accept()
+                except (AuthenticationError, EOFError, IOError):
+                    log.warning("Rejected a connection without the key of the daemon")
+                    continue
+                try:
+                    request = connection.recv()
+                    response = self.handle(request)
+                    connection.send(response)
+                except (EOFError, IOError):
+                    log.warning("Connection closed by the client")
+                    continue
+                finally:
+                    connection.close()
+                if request.get("command") == "shutdown":
+                    break
+        finally:
+            listener.close()
+            os.remove(key_filename(self.address))
+
+class DaemonClient(object):
+    """Client of a NullTestDaemon
+
+    Parameters
+    ----------
+    address : string or None
+        path of the Unix socket of the daemon, by default default_address()
+    authkey : string or None
+        authentication key of the daemon, by default read from its key file
+        at each request, a restarted daemon has a new key
+    """
+
+    def __init__(self, address=None, authkey=None):
+        self.address = address or default_address()
+        self.authkey = authkey
+
+    def request(self, **request):
+        """Send a request and wait for its response, raises RuntimeError if it failed"""
+        connection = Client(self.address, family="AF_UNIX", authkey=self.authkey or read_key(self.address))
+        try:
+            connection.send(request)
+            response = connection.recv()
+        finally:
+            connection.close()
+        if response["status"] == "failed":
+            raise RuntimeError(response["error"])
+        return response
+
+    def run(self, task, smooth_combine=None, root_folder=None, arrays=False):
+        """Run a task, see NullTestDaemon.run"""
+        request = dict(task=tuple(task), smooth_combine=smooth_combine or {}, arrays=arrays)
+        if root_folder:
+            request["root_folder"] = root_folder
+        return self.request(**request)
+
+    def halfrings(self, freq, chtag, surv, pol="I", **kwargs):
+        return self.run(Task("halfrings", freq, chtag, surv, pol, False), **kwargs)
+
+    def surveydiff(self, freq, chtag, survlist, pol="I", bp_corr=False, **kwargs):
+        return self.run(Task("surveydiff", freq, chtag, tuple(survlist), pol, bp_corr), **kwargs)
+
+    def chdiff(self, freq, chlist, surv, pol="I", **kwargs):
+        return self.run(Task("chdiff", freq, tuple(chlist), surv, pol, False), **kwargs)
+
+    def stats(self):
+        return self.request(command="stats")
+
+    def reset(self):
+        return self.request(command="reset")
+
+    def shutdown(self):
+        return self.request(command="shutdown")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Serve interactive null test requests over a Unix socket")
+    parser.add_argument("config", help="run configuration file")
+    parser.add_argument("--socket", help="path of the Unix socket")
+    args = parser.parse_args()
+    log.root.level = log.INFO
+    NullTestDaemon(args.config, args.socket).serve()
@@ -6,6 +6,10 @@ import numpy as np
 import logging as log
 import healpy as hp
 import reader
+import mapstore
+import summarydb
+import timings
+import memory
 
 import utils
 
@@ -14,8 +18,8 @@ def configure_file_logger(base_filename):
     handler = log.FileHandler(base_filename + ".log", mode='w')
     handler.setLevel(log.DEBUG)
     handler.setFormatter(log.Formatter('%(asctime)s %(levelname)-8s %(message)s'))
-    for h in rl.handlers:
-        h.stream.close()
+    for h in rl.handlers[:]:
+        h.close()
         rl.removeHandler(h)
     rl.level = log.DEBUG
     rl.addHandler( handler )
@@ -41,7 +45,7 @@ def combine_maps(maps_and_weights):
 
     return combined_map
 
-def smooth_combine(maps_and_weights, variance_maps_and_weights=None, fwhm=np.radians(2.0), degraded_nside=32, spectra=False, smooth_mask=False, spectra_mask=False, galaxy_mask=False, base_filename="out", root_folder=".", metadata={}, chi2=False):
+def smooth_combine(maps_and_weights, variance_maps_and_weights=None, fwhm=np.radians(2.0), degraded_nside=32, spectra=False, smooth_mask=False, spectra_mask=False, galaxy_mask=False, base_filename="out", root_folder=".", metadata={}, chi2=False, summary_db=None, run_id=""):
     """Combine, smooth, take-spectra, write metadata
 
     The maps (I or IQU) are first combined with their own weights, then smoothed and degraded.
@@ -68,11 +72,37 @@ def smooth_combine(maps_and_weights, variance_maps_and_weights=None, fwhm=np.rad
         root path of the output files
     metadata : dict
         initial state of the metadata to be written to the json files
+    summary_db : string or None
+        path to a SQLite summary database, see summarydb.py, if given the map metadata are also stored there
+    run_id : string
+        identifier of the run in the summary database
 
     Returns
     -------
     None : all outputs are written to fits files
     """
+    outputs = smooth_combine_maps(maps_and_weights, variance_maps_and_weights, fwhm=fwhm, degraded_nside=degraded_nside,
+                                  spectra=spectra, smooth_mask=smooth_mask, spectra_mask=spectra_mask,
+                                  galaxy_mask=galaxy_mask, base_filename=base_filename, metadata=metadata)
+    write_outputs(outputs, base_filename, root_folder, summary_db=summary_db, run_id=run_id)
+
+def smooth_combine_maps(maps_and_weights, variance_maps_and_weights=None, fwhm=np.radians(2.0), degraded_nside=32, spectra=False, smooth_mask=False, spectra_mask=False, galaxy_mask=False, base_filename="out", metadata={}, smoothing=None):
+    """Outputs of smooth_combine without writing them
+
+    Parameters
+    ----------
+    smoothing : callable or None
+        smoothing(maps, fwhm=fwhm) of the combined maps and of the variance
+        maps, by default hp.smoothing, e.g. with a cache of alms
+
+    see smooth_combine for the other parameters
+
+    Returns
+    -------
+    outputs : dict
+        map (smoothed and degraded I map or IQU maps), cl (None without spectra),
+        cl_metadata (None without spectra) and metadata of the map
+    """
 
     log.debug("smooth_combine")
     # check if I or IQU
@@ -80,21 +110,24 @@ def smooth_combine(maps_and_weights, variance_maps_and_weights=None, fwhm=np.rad
     if not is_IQU:
         assert hp.isnpixok(len(maps_and_weights[0][0])), "Input maps must have either 1 or 3 components"
 
-    combined_map = combine_maps(maps_and_weights)
-    for m in combined_map:
-        m.mask |= smooth_mask
-    if not variance_maps_and_weights is None:
-        combined_variance_map = combine_maps(variance_maps_and_weights)
-        for m in combined_variance_map:
+    with timings.timed("combine"):
+        combined_map = combine_maps(maps_and_weights)
+        for m in combined_map:
             m.mask |= smooth_mask
+        if not variance_maps_and_weights is None:
+            combined_variance_map = combine_maps(variance_maps_and_weights)
+            for m in combined_variance_map:
+                m.mask |= smooth_mask
 
-    monopole_I, dipole_I = hp.fit_dipole(combined_map[0], gal_cut=30)
+    with timings.timed("fit_dipole"):
+        monopole_I, dipole_I = hp.fit_dipole(combined_map[0], gal_cut=30)
     # remove monopole, only I
     combined_map[0] -= monopole_I
 
     # save original masks
     orig_mask = [m.mask.copy() for m in combined_map] 
 
+    cl = None
     if spectra:
 
         # spectra
@@ -102,7 +135,8 @@ def smooth_combine(maps_and_weights, variance_maps_and_weights=None, fwhm=np.rad
         for m in combined_map:
             m.mask |= spectra_mask
         # dividing by two in order to recover the same noise as the average map (M1 - M2)/2
-        cl = hp.anafast([m/2. for m in combined_map])
+        with timings.timed("anafast"):
+            cl = hp.anafast([m/2. for m in combined_map])
         # sky fraction
         sky_frac = (~combined_map[0].mask).sum()/float(len(combined_map[0]))
 
@@ -112,21 +146,14 @@ def smooth_combine(maps_and_weights, variance_maps_and_weights=None, fwhm=np.rad
         else:
             cl /= sky_frac
 
-        # write spectra
-        log.debug("Write cl: " + base_filename + "_cl.fits")
-        try:
-            hp.write_cl(os.path.join(root_folder, base_filename + "_cl.fits"), cl)
-        except exceptions.NotImplementedError:
-            log.error("Write IQU Cls to fits requires more recent version of healpy")
-        del cl
-
         if not variance_maps_and_weights is None:
-            # expected cl from white noise
-            # /4. to have same normalization of cl
-            metadata["whitenoise_cl"] = utils.get_whitenoise_cl(combined_variance_map[0]/4., mask=combined_map[0].mask) / sky_frac
-            if is_IQU:
-                # /2. is the mean, /4. is the half difference in power
-                metadata["whitenoise_cl_P"] = utils.get_whitenoise_cl((combined_variance_map[1] + combined_variance_map[2])/2./4., mask=combined_map[1].mask | combined_map[2].mask) / sky_frac 
+            with timings.timed("whitenoise_cl"):
+                # expected cl from white noise
+                # /4. to have same normalization of cl
+                metadata["whitenoise_cl"] = utils.get_whitenoise_cl(combined_variance_map[0]/4., mask=combined_map[0].mask) / sky_frac
+                if is_IQU:
+                    # /2. is the mean, /4. is the half difference in power
+                    metadata["whitenoise_cl_P"] = utils.get_whitenoise_cl((combined_variance_map[1] + combined_variance_map[2])/2./4., mask=combined_map[1].mask | combined_map[2].mask) / sky_frac 
 
         # restore masks 
         # we need to restore both here and after next smoothing
@@ -135,37 +162,39 @@ def smooth_combine(maps_and_weights, variance_maps_and_weights=None, fwhm=np.rad
     # smooth
     log.debug("Smooth")
 
-    smoothed_map = hp.smoothing(combined_map, fwhm=fwhm)
+    with timings.timed("smoothing"):
+        smoothed_map = (smoothing or hp.smoothing)(combined_map, fwhm=fwhm)
 
     if not variance_maps_and_weights is None:
         log.debug("Smooth Variance")
-        if is_IQU:
-            smoothed_variance_map = [utils.smooth_variance_map(var, fwhm=fwhm) for var in combined_variance_map]
-            for comp,m,var,galmask in zip("IQU", smoothed_map, smoothed_variance_map, spectra_mask):
-                 metadata["map_chi2_%s" % comp] = np.mean(m**2 / var) 
-            for comp,m,var in zip("IQU", combined_map, combined_variance_map):
-                 metadata["map_unsm_chi2_%s" % comp] = np.mean(m**2 / var) 
-
-            for m in (combined_map + combined_variance_map):
-                m.mask |= galaxy_mask
-            smoothed_variance_map = [utils.smooth_variance_map(var, fwhm=fwhm) for var in combined_variance_map]
-            smoothed_map_galaxy_mask = hp.smoothing(combined_map, fwhm=fwhm)
-
-            for comp,m,var in zip("IQU", smoothed_map_galaxy_mask, smoothed_variance_map):
-                 metadata["map_chi2_galmask_%s" % comp] = np.mean((m**2 / var)) 
-        else:
-            smoothed_variance_map = utils.smooth_variance_map(combined_variance_map[0], fwhm=fwhm)
-            metadata["map_chi2"] = np.mean(smoothed_map**2 / smoothed_variance_map) 
-            metadata["map_unsm_chi2"] = np.mean(combined_map[0]**2 / combined_variance_map[0]) 
+        with timings.timed("smoothing_chi2"):
+            if is_IQU:
+                smoothed_variance_map = [utils.smooth_variance_map(var, fwhm=fwhm, smoothing=smoothing) for var in combined_variance_map]
+                for comp,m,var,galmask in zip("IQU", smoothed_map, smoothed_variance_map, spectra_mask):
+                     metadata["map_chi2_%s" % comp] = np.mean(m**2 / var) 
+                for comp,m,var in zip("IQU", combined_map, combined_variance_map):
+                     metadata["map_unsm_chi2_%s" % comp] = np.mean(m**2 / var) 
 
-            for m in (combined_map + combined_variance_map):
-                m.mask |= galaxy_mask
-            smoothed_variance_map = utils.smooth_variance_map(combined_variance_map[0], fwhm=fwhm)
-            smoothed_map_galaxy_mask = hp.smoothing(combined_map[0], fwhm=fwhm)
+                for m in (combined_map + combined_variance_map):
+                    m.mask |= galaxy_mask
+                smoothed_variance_map = [utils.smooth_variance_map(var, fwhm=fwhm, smoothing=smoothing) for var in combined_variance_map]
+                smoothed_map_galaxy_mask = (smoothing or hp.smoothing)(combined_map, fwhm=fwhm)
 
-            metadata["map_chi2_galmask"] = np.mean((smoothed_map_galaxy_mask**2 / smoothed_variance_map))
+                for comp,m,var in zip("IQU", smoothed_map_galaxy_mask, smoothed_variance_map):
+                     metadata["map_chi2_galmask_%s" % comp] = np.mean((m**2 / var)) 
+            else:
+                smoothed_variance_map = utils.smooth_variance_map(combined_variance_map[0], fwhm=fwhm, smoothing=smoothing)
+                metadata["map_chi2"] = np.mean(smoothed_map**2 / smoothed_variance_map) 
+                metadata["map_unsm_chi2"] = np.mean(combined_map[0]**2 / combined_variance_map[0]) 
 
-        del smoothed_variance_map
+                for m in (combined_map + combined_variance_map):
+                    m.mask |= galaxy_mask
+                smoothed_variance_map = utils.smooth_variance_map(combined_variance_map[0], fwhm=fwhm, smoothing=smoothing)
+                smoothed_map_galaxy_mask = (smoothing or hp.smoothing)(combined_map[0], fwhm=fwhm)
+
+                metadata["map_chi2_galmask"] = np.mean((smoothed_map_galaxy_mask**2 / smoothed_variance_map))
+
+            del smoothed_variance_map
 
     # restore masks
     for m, mask in zip(combined_map, orig_mask):
@@ -174,10 +203,8 @@ def smooth_combine(maps_and_weights, variance_maps_and_weights=None, fwhm=np.rad
     # removed downgrade of variance
     # smoothed_variance_map = hp.ud_grade(smoothed_variance_map, degraded_nside, power=2)
 
-    # fits
-    log.info("Write fits map: " + base_filename + "_map.fits")
-    smoothed_map = hp.ud_grade(smoothed_map, degraded_nside)
-    hp.write_map(os.path.join(root_folder, base_filename + "_map.fits"), smoothed_map)
+    with timings.timed("ud_grade"):
+        smoothed_map = hp.ud_grade(smoothed_map, degraded_nside)
 
     # metadata
     metadata["base_file_name"] = base_filename
@@ -186,10 +213,10 @@ def smooth_combine(maps_and_weights, variance_maps_and_weights=None, fwhm=np.rad
     metadata["removed_monopole_I"] = monopole_I
     metadata["dipole_I"] = tuple(dipole_I)
 
+    cl_metadata = None
     if spectra:
         metadata["sky_fraction"] = sky_frac
-        with open(os.path.join(root_folder, base_filename + "_cl.json"), 'w') as f:
-            json.dump(metadata, f, indent=4)
+        cl_metadata = dict(metadata)
 
     metadata["file_name"] = base_filename + "_map.fits"
     metadata["file_type"] = metadata["file_type"].replace("_cl","_map")
@@ -204,9 +231,176 @@ def smooth_combine(maps_and_weights, variance_maps_and_weights=None, fwhm=np.rad
         metadata["map_p2p_I"] = smoothed_map.ptp()
         metadata["map_std_I"] = smoothed_map.std()
 
+    return dict(map=smoothed_map, cl=cl, cl_metadata=cl_metadata, metadata=metadata)
+
+def write_outputs(outputs, base_filename, root_folder=".", summary_db=None, run_id=""):
+    """Write the outputs of smooth_combine_maps, see smooth_combine"""
+    if outputs["cl"] is not None:
+        # write spectra
+        log.debug("Write cl: " + base_filename + "_cl.fits")
+        try:
+            with timings.timed("write"):
+                hp.write_cl(os.path.join(root_folder, base_filename + "_cl.fits"), outputs["cl"])
+        except exceptions.NotImplementedError:
+            log.error("Write IQU Cls to fits requires more recent version of healpy")
+        with open(os.path.join(root_folder, base_filename + "_cl.json"), 'w') as f:
+            json.dump(outputs["cl_metadata"], f, indent=4)
+
+    # fits
+    log.info("Write fits map: " + base_filename + "_map.fits")
+    with timings.timed("write"):
+        hp.write_map(os.path.join(root_folder, base_filename + "_map.fits"), outputs["map"])
+
+    # stages since the previous output, see timings.py and memory.py
+    outputs["metadata"]["timings"] = timings.take()
+    outputs["metadata"]["memory"], traced_peaks = memory.take()
+    if traced_peaks:
+        outputs["metadata"]["memory_traced"] = traced_peaks
     with open(os.path.join(root_folder, base_filename + "_map.json"), 'w') as f:
-        json.dump(metadata, f, indent=4)
+        json.dump(outputs["metadata"], f, indent=4)
+
+    if summary_db:
+        db = summarydb.SummaryDB(summary_db)
+        db.insert(outputs["metadata"], run_id)
+        db.close()
+
+
+def halfrings_output(freq, ch, surv):
+    """Base filename and metadata of a halfring difference
+
+    Returns
+    -------
+    base_filename : string
+        path of the outputs relative to root_folder without suffix
+    metadata : dict
+        initial metadata for smooth_combine
+    """
+    chtag = ch or str(freq)
+    base_filename = os.path.join("halfrings", "%s_SS%s" % (chtag, str(surv)))
+    metadata = dict( 
+        file_type="halfring_%s" % (reader.type_of_channel_set(ch),),
+        channel=chtag,
+        survey=surv,
+        title="Halfring difference survey %s ch %s" % (str(surv), chtag),
+        )
+    return base_filename, metadata
+
+def surveydiff_output(freq, ch, comb, bp_corr=False):
+    """Ordered surveys, base filename and metadata of a survey difference
 
+    in case of even-odd, swap to odd-even. Do the same for
+    combinations like e.g. SS3-SS1 (-> SS1-SS3)
+
+    Returns
+    -------
+    comb : tuple
+        the couple of surveys in the order of the difference
+    base_filename, metadata : see halfrings_output
+    """
+    chtag = ch or str(freq)
+    if (comb[1] % 2 != 0 and comb[0] % 2 == 0) or (comb[1] < comb[0]):
+        comb = (comb[1], comb[0])
+    metadata = dict(
+        channel=chtag,
+        file_type="surveydiff_%s" % (reader.type_of_channel_set(ch),),
+        title="Survey difference SS%s-SS%s ch %s" % (str(comb[0])[:4], str(comb[1])[:4], chtag),
+        )
+    base_filename = os.path.join("surveydiff", "%s_SS%d-SS%d" % (chtag, comb[0], comb[1]))
+    if bp_corr:
+        metadata["title"] += " BPCORR"
+        base_filename += "_bpcorr"
+    metadata["surveys"] = comb
+    return comb, base_filename, metadata
+
+def chdiff_output(freq, comb, surv):
+    """Base filename and metadata of a channel difference, see halfrings_output"""
+    base_filename = os.path.join("chdiff", "%s-%s_SS%s" % (comb[0], comb[1], surv))
+    metadata = dict(
+        survey=surv,
+        title="Channel difference %s-%s SS%s" % (comb[0], comb[1], surv),
+        channel=comb,
+        file_type="chdiff",
+        )
+    return base_filename, metadata
+
+def blocked_pairs(items, max_resident):
+    """All the couples of items, in blocks so that at most max_resident items are used at a time
+
+    items are split in blocks of max_resident/2 items, the couples are produced
+    tile by tile of the upper triangle of the matrix of couples, like a tiled
+    matrix traversal, the first block of each tile stays in use along its row
+
+    Returns
+    -------
+    pairs : list of tuples
+        same couples as itertools.combinations(items, 2), each in the same order
+    """
+    block = max(1, max_resident // 2)
+    blocks = [items[i:i + block] for i in range(0, len(items), block)]
+    pairs = []
+    for i, block_i in enumerate(blocks):
+        pairs += list(itertools.combinations(block_i, 2))
+        for block_j in blocks[i + 1:]:
+            pairs += list(itertools.product(block_i, block_j))
+    return pairs
+
+def _nbytes(value):
+    if isinstance(value, (list, tuple)):
+        return sum(_nbytes(v) for v in value)
+    if isinstance(value, np.ma.MaskedArray):
+        return value.data.nbytes + np.ma.getmaskarray(value).nbytes
+    return np.asarray(value).nbytes
+
+def pairs_of_maps(read, items, memory_budget=None, scratch_folder=None):
+    """Maps of all the couples of items, in memory or out of core
+
+    without memory_budget, or if the maps of all items fit in it, all items are
+    read in memory. Otherwise they are written one at a time to memory-mapped
+    scratch files, see mapstore.ScratchMaps, and the couples are produced in
+    the order of blocked_pairs so that at most memory_budget / size of the maps
+    of an item (at least 2) are attached at the same time.
+
+    Parameters
+    ----------
+    read : callable
+        read(item) returns the maps of an item, e.g. list of signal and variance maps
+    items : list
+        e.g. surveys or channels
+    memory_budget : float or None
+        memory for the maps of the resident items in MB
+    scratch_folder : string or None
+        parent folder of the scratch files, see mapstore.ScratchMaps
+
+    Yields
+    ------
+    item1, item2, maps1, maps2
+        couples in the order of itertools.combinations or blocked_pairs
+    """
+    items = list(items)
+    if not items:
+        return
+    maps = {items[0]: read(items[0])}
+    max_resident = len(items)
+    if memory_budget:
+        max_resident = max(2, int(memory_budget * 2**20 // _nbytes(maps[items[0]])))
+    if max_resident >= len(items):
+        for item in items[1:]:
+            maps[item] = read(item)
+        for item1, item2 in itertools.combinations(items, 2):
+            yield item1, item2, maps[item1], maps[item2]
+        return
+
+    log.info("Out of core: %d items, at most %d resident" % (len(items), max_resident))
+    scratch = mapstore.ScratchMaps(scratch_folder, max_resident)
+    try:
+        scratch[items[0]] = maps.pop(items[0])
+        for item in items[1:]:
+            scratch[item] = read(item)
+        for item1, item2 in blocked_pairs(items, max_resident):
+            yield item1, item2, scratch[item1], scratch[item2]
+        log.debug("Out of core: %d scratch loads" % scratch.loads)
+    finally:
+        scratch.close()
 
 def halfrings(freq, ch, surv, pol='I', smooth_combine_config=None, root_folder="out/",log_to_file=False, mapreader=None):
     """Half ring differences
@@ -234,23 +428,12 @@ def halfrings(freq, ch, surv, pol='I', smooth_combine_config=None, root_folder="
     except:
         pass
 
-    if ch:
-        chtag = ch
-    else:
-        chtag = str(freq)
-
-    base_filename = os.path.join("halfrings", "%s_SS%s" % (chtag, str(surv)))
+    base_filename, metadata = halfrings_output(freq, ch, surv)
     if log_to_file:
         configure_file_logger(os.path.join(root_folder, base_filename))
 
     ps_mask, union_mask, galaxy_mask = mapreader.read_masks(freq)
 
-    metadata = dict( 
-        file_type="halfring_%s" % (reader.type_of_channel_set(ch),),
-        channel=chtag,
-        survey=surv,
-        title="Halfring difference survey %s ch %s" % (str(surv), chtag),
-        )
     log.info("Call smooth_combine")
     variance_maps_and_weights = None
     if smooth_combine_config["chi2"]:
@@ -270,7 +453,7 @@ def halfrings(freq, ch, surv, pol='I', smooth_combine_config=None, root_folder="
             **smooth_combine_config)
     log.info("Completed")
 
-def surveydiff(freq, ch, survlist=[1,2,3,4,5], pol='I', root_folder="out/", smooth_combine_config=None, log_to_file=False, bp_corr=False, mapreader=None):
+def surveydiff(freq, ch, survlist=[1,2,3,4,5], pol='I', root_folder="out/", smooth_combine_config=None, log_to_file=False, bp_corr=False, mapreader=None, memory_budget=None, scratch_folder=None):
     """Survey differences
 
     for a specific channel or channel set, produces all the possible combinations of the surveys in survlist
@@ -278,6 +461,11 @@ def surveydiff(freq, ch, survlist=[1,2,3,4,5], pol='I', root_folder="out/", smoo
     Parameters
     ----------
     survlist : list of survey id (1..5, "nominal", "full")
+    memory_budget : float or None
+        if given, memory for the maps of the surveys in MB, if they do not fit
+        they are processed out of core, see pairs_of_maps
+    scratch_folder : string or None
+        parent folder of the out of core scratch files
 
     see the halfrings function for other parameters
     """
@@ -292,66 +480,49 @@ def surveydiff(freq, ch, survlist=[1,2,3,4,5], pol='I', root_folder="out/", smoo
         chtag = str(freq)
 
     if log_to_file:
-        logfilename = "%s_SSdiff" % chtag
+        logfilename = os.path.join("surveydiff", "%s_SSdiff" % chtag)
         if bp_corr:
             logfilename += "_bpcorr"
-        configure_file_logger(os.path.join(root_folder, "surveydiff", logfilename))
+        if len(survlist) == 2:
+            # a single couple, e.g. a task split by tasks.split_task, logs to its own file
+            logfilename = surveydiff_output(freq, ch, survlist, bp_corr)[1]
+        configure_file_logger(os.path.join(root_folder, logfilename))
 
-    # read all maps
-    maps = dict([(surv, mapreader(freq, surv, ch, halfring=0, pol=pol, bp_corr=bp_corr)) for surv in survlist])
-
-    if smooth_combine_config["chi2"]:
-        log.debug("Read variance")
-        var_pol = 'A' if len(pol) == 1 else 'ADF' # for I only read sigma_II, else read sigma_II, sigma_QQ, sigma_UU
-        variance_maps = dict([(surv, mapreader(freq, surv, ch, halfring=0, pol=var_pol, bp_corr=False)) for surv in survlist])
-        for var_m in variance_maps.values():
-            assert np.all(var_m >= 0)
-
-    log.debug("All maps read")
+    def read(surv):
+        maps = [mapreader(freq, surv, ch, halfring=0, pol=pol, bp_corr=bp_corr)]
+        if smooth_combine_config["chi2"]:
+            log.debug("Read variance")
+            var_pol = 'A' if len(pol) == 1 else 'ADF' # for I only read sigma_II, else read sigma_II, sigma_QQ, sigma_UU
+            maps.append(mapreader(freq, surv, ch, halfring=0, pol=var_pol, bp_corr=False))
+            assert np.all(maps[1] >= 0)
+        return maps
 
     ps_mask, union_mask, galaxy_mask = mapreader.read_masks(freq)
 
-    log.debug("Metadata")
-
-    metadata = dict( 
-        channel=chtag,
-        )
-
     variance_maps_and_weights = None
-    combs = list(itertools.combinations(survlist, 2))
-    for comb in combs:
-        metadata["file_type"]="surveydiff_%s" % (reader.type_of_channel_set(ch),)
-        # in case of even-odd, swap to odd-even. Do the same for
-        # combinations like e.g. SS3-SS1 (-> SS1-SS3)
-        if (comb[1] % 2 != 0 and comb[0] % 2 == 0) or (comb[1] < comb[0]):
-            comb = (comb[1], comb[0])
-
-        metadata["title"]="Survey difference SS%s-SS%s ch %s" % (str(comb[0])[:4], str(comb[1])[:4], chtag)
-        base_filename = os.path.join("surveydiff", "%s_SS%d-SS%d" % (chtag, comb[0], comb[1]))
-        if bp_corr:
-            metadata["title"] += " BPCORR"
-            base_filename += "_bpcorr"
+    for surv1, surv2, maps1, maps2 in pairs_of_maps(read, survlist, memory_budget, scratch_folder):
+        comb, base_filename, metadata = surveydiff_output(freq, ch, (surv1, surv2), bp_corr)
+        if comb[0] != surv1:
+            maps1, maps2 = maps2, maps1
 
         if smooth_combine_config["chi2"]:
-            variance_maps_and_weights = [ (variance_maps[comb[0]], 1),
-                  (variance_maps[comb[1]], 1) ]
+            variance_maps_and_weights = [ (maps1[1], 1),
+                  (maps2[1], 1) ]
         log.debug("Launching smooth_combine")
         smooth_combine(
-                [ (maps[comb[0]],  1),
-                  (maps[comb[1]], -1) ],
+                [ (maps1[0],  1),
+                  (maps2[0], -1) ],
                 variance_maps_and_weights, 
                 base_filename=base_filename,
                 root_folder=root_folder,
-                metadata=dict(metadata.items() + {"surveys": comb}.items()),
-              smooth_mask=ps_mask,
-              spectra_mask=union_mask,
-              galaxy_mask = galaxy_mask,
-
-
+                metadata=metadata,
+                smooth_mask=ps_mask,
+                spectra_mask=union_mask,
+                galaxy_mask=galaxy_mask,
                 **smooth_combine_config )
     log.info("Completed")
 
-def chdiff(freq, chlist, surv, pol='I', smooth_combine_config=None, root_folder="out/", log_to_file=False, mapreader=None):
+def chdiff(freq, chlist, surv, pol='I', smooth_combine_config=None, root_folder="out/", log_to_file=False, mapreader=None, memory_budget=None, scratch_folder=None):
     """Channel difference
 
     for a specific survey, produces all the possible combinations of the channels in chlist
@@ -359,6 +530,7 @@ def chdiff(freq, chlist, surv, pol='I', smooth_combine_config=None, root_folder=
     Parameters
     ----------
     chlist : list of channel tags (see reader or halfrings documentation)
+    memory_budget, scratch_folder : see surveydiff
 
     see the halfrings function for other parameters
     """
@@ -369,38 +541,34 @@ def chdiff(freq, chlist, surv, pol='I', smooth_combine_config=None, root_folder=
         pass
 
     base_filename=os.path.join("chdiff", "%d_SS%s" % (freq, surv))
+    if len(chlist) == 2:
+        # a single couple, e.g. a task split by tasks.split_task, logs to its own file
+        base_filename = chdiff_output(freq, chlist, surv)[0]
     if log_to_file:
         configure_file_logger(os.path.join(root_folder, base_filename))
 
-    # read all maps
-    maps = dict([(ch, mapreader(freq, surv, ch, halfring=0, pol=pol)) for ch in chlist])
-
-    if smooth_combine_config["chi2"]:
-        log.debug("Read variance")
-        var_pol = 'A' if len(pol) == 1 else 'ADF' # for I only read sigma_II, else read sigma_II, sigma_QQ, sigma_UU
-        variance_maps = dict([(ch, mapreader(freq, surv, ch, halfring=0, pol=var_pol, bp_corr=False)) for ch in chlist])
-        for var_m in variance_maps.values():
-            assert np.all(var_m >= 0)
+    def read(ch):
+        maps = [mapreader(freq, surv, ch, halfring=0, pol=pol)]
+        if smooth_combine_config["chi2"]:
+            log.debug("Read variance")
+            var_pol = 'A' if len(pol) == 1 else 'ADF' # for I only read sigma_II, else read sigma_II, sigma_QQ, sigma_UU
+            maps.append(mapreader(freq, surv, ch, halfring=0, pol=var_pol, bp_corr=False))
+            assert np.all(maps[1] >= 0)
+        return maps
 
     ps_mask, union_mask, galaxy_mask = mapreader.read_masks(freq)
 
-    metadata = dict( 
-        survey=surv
-        )
-
-    combs = list(itertools.combinations(chlist, 2))
-    for comb in combs:
-        metadata["title"]="Channel difference %s-%s SS%s" % (comb[0], comb[1], surv)
-        metadata["channel"] = comb
-        metadata["file_type"] = "chdiff"
+    variance_maps_and_weights = None
+    for ch1, ch2, maps1, maps2 in pairs_of_maps(read, chlist, memory_budget, scratch_folder):
+        base_filename, metadata = chdiff_output(freq, (ch1, ch2), surv)
         if smooth_combine_config["chi2"]:
-           variance_maps_and_weights = [ (variance_maps[comb[0]], 1),
-                  (variance_maps[comb[1]], 1) ]
+           variance_maps_and_weights = [ (maps1[1], 1),
+                  (maps2[1], 1) ]
         smooth_combine(
-                [ (maps[comb[0]],  1),
-                  (maps[comb[1]], -1) ],
+                [ (maps1[0],  1),
+                  (maps2[0], -1) ],
                 variance_maps_and_weights,
-                base_filename=os.path.join("chdiff", "%s-%s_SS%s" % (comb[0],   comb[1], surv)),
+                base_filename=base_filename,
                 root_folder=root_folder,
                 metadata=metadata,
                 smooth_mask=ps_mask,
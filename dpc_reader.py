@@ -1,4 +1,5 @@
 from reader import *
+import timings
 
 class DPCDX9Reader(BaseMapReader):
     """All maps in a single folder, DX9 naming convention"""
@@ -8,6 +9,7 @@ class DPCDX9Reader(BaseMapReader):
         self.default_nside = default_nside
         self.debug_mode = debug_mode
 
+    @timings.timed("read")
     def read_map(self, path, components):
         if not self.debug_mode:
             return hp.ma(hp.read_map(path, components))
@@ -0,0 +1,81 @@
+"""Engine side state of the ipython back end
+
+Instead of pickling the map reader, with its configuration parser, and the
+smooth_combine configuration into every apply_async call, the ipython back
+end ships each task as a compact descriptor, the tuple of the fields of
+tasks.Task, together with the id of the context of the run.
+
+At the start of a run the client sends once to every engine the context of
+the run, its resolved reader, smooth_combine and out of core configuration
+and options, see set_context, so that the engines run exactly the client
+configuration, e.g. the coarse nside of a quick-look stage, see quicklook.py.
+Each engine wraps the reader in a CachedReader, so that masks and recently
+read maps are kept between the tasks of the run.
+"""
+
+from reader import CachedReader
+from tasks import Task, run_task
+
+_context = None
+
+class EngineContext(object):
+    """Reader, map cache and configuration of a run on an engine
+
+    Parameters
+    ----------
+    context_id : string
+        id of the run, sent with each task
+    mapreader : BaseMapReader
+        reader of the run, wrapped in a CachedReader
+    cache_maps : int
+        maps kept by the CachedReader
+    see tasks.run_task for the other parameters
+    """
+
+    def __init__(self, context_id, mapreader, smooth_combine_config, root_folder, cache_maps=8, out_of_core_config=None, profile=False):
+        self.context_id = context_id
+        self.mapreader = CachedReader(mapreader, max_maps=cache_maps)
+        self.smooth_combine_config = smooth_combine_config
+        self.root_folder = root_folder
+        self.out_of_core_config = out_of_core_config
+        self.profile = profile
+
+def set_context(context_id, *args, **kwargs):
+    """Set the context of a run on this engine, replacing the previous one and its cache
+
+    see EngineContext for the parameters
+    """
+    global _context
+    if _context is None or _context.context_id != context_id:
+        _context = EngineContext(context_id, *args, **kwargs)
+
+def get_context(context_id):
+    """Context of a run on this engine, see set_context"""
+    if _context is None or _context.context_id != context_id:
+        raise RuntimeError("Context %s of the run not set on this engine, see engine.set_context" % context_id)
+    return _context
+
+def run_descriptor(context_id, descriptor, task_fingerprint=None, threads=None, log_collector=None):
+    """Run a task shipped as a descriptor, see tasks.run_task
+
+    Parameters
+    ----------
+    context_id : string
+        id of the context of the run, see set_context
+    descriptor : tuple
+        fields of the Task, e.g. tuple(task)
+    see tasks.run_task for the other parameters
+
+    Returns
+    -------
+    stats : dict
+        see tasks.run_task
+    """
+    context = get_context(context_id)
+    stats = run_task(Task(*descriptor), context.mapreader, context.smooth_combine_config, context.root_folder,
+                     log_to_file=True, task_fingerprint=task_fingerprint,
+                     out_of_core_config=context.out_of_core_config, threads=threads,
+                     log_collector=log_collector, profile=context.profile, acquire=True)
+    # map cache counters of the engine so far, see telemetry.py
+    stats.update(cache_hits=context.mapreader.hits, cache_misses=context.mapreader.misses)
+    return stats
@@ -0,0 +1,98 @@
+"""Fingerprints of the tasks of a run, used to resume interrupted runs
+
+The fingerprint of a task is a hash of the task itself, of the smooth_combine
+configuration, of the reader configuration, of the code computing the outputs
+and of the modification time and size of all its input files. When a task completes, its fingerprint is written
+to `root_folder/fingerprints/`, the task is then up to date as long as the
+fingerprint does not change and its outputs exist.
+"""
+
+import os
+import json
+import hashlib
+import exceptions
+import logging as log
+from ConfigParser import NoOptionError
+
+import tasks
+
+FOLDER = "fingerprints"
+# modules whose source changes the outputs of a task
+CODE_MODULES = ["differences", "utils", "reader", "tasks"]
+_code_hash = None
+
+def code_hash():
+    """Hash of the source of CODE_MODULES, computed once per process"""
+    global _code_hash
+    if _code_hash is None:
+        folder = os.path.dirname(os.path.abspath(__file__))
+        digest = hashlib.sha1()
+        for module in CODE_MODULES:
+            with open(os.path.join(folder, module + ".py"), "rb") as f:
+                digest.update(f.read())
+        _code_hash = digest.hexdigest()
+    return _code_hash
+
+def task_input_files(task, mapreader, chi2):
+    """All the files read by a task, masks included, without reading them
+
+    mapreader must provide mask_files and input_files, see reader.DXReader
+    """
+    files = list(mapreader.mask_files(task.freq))
+    for read in tasks.task_reads(task, chi2):
+        files += mapreader.input_files(*read)
+    return sorted(set(files))
+
+def task_fingerprint(task, mapreader, smooth_combine_config):
+    """Fingerprint of a task
+
+    Returns
+    -------
+    fingerprint : string or None
+        hex digest, None if the reader cannot list its input files
+        or some of them are missing
+    """
+    if not hasattr(mapreader, "input_files"):
+        return None
+    try:
+        files = task_input_files(task, mapreader, smooth_combine_config["chi2"])
+    except (NoOptionError, exceptions.IOError):
+        return None
+    reader_config = mapreader.config
+    state = dict(
+        task=list(task),
+        smooth_combine=sorted((k, repr(v)) for k, v in smooth_combine_config.items()),
+        reader=dict(nside=mapreader.nside,
+                    debug=getattr(mapreader, "debug", False),
+                    config=[(section, sorted(reader_config.items(section, raw=True))) for section in sorted(reader_config.sections())]),
+        code=code_hash(),
+        inputs=[(f, os.path.getmtime(f), os.path.getsize(f)) for f in files],
+        )
+    return hashlib.sha1(json.dumps(state, sort_keys=True)).hexdigest()
+
+def stamp_filename(root_folder, task):
+    return os.path.join(root_folder, FOLDER, tasks.task_name(task) + ".json")
+
+def write_stamp(root_folder, task, fingerprint):
+    """Record that task completed with the given fingerprint"""
+    filename = stamp_filename(root_folder, task)
+    try:
+        os.makedirs(os.path.dirname(filename))
+    except OSError:
+        pass
+    with open(filename, "w") as f:
+        json.dump(dict(fingerprint=fingerprint, outputs=tasks.task_outputs(task)), f, indent=4)
+
+def is_up_to_date(root_folder, task, fingerprint):
+    """Whether task completed with the same fingerprint and its outputs exist"""
+    if fingerprint is None:
+        return False
+    try:
+        with open(stamp_filename(root_folder, task)) as f:
+            stamp = json.load(f)
+    except (exceptions.IOError, exceptions.ValueError):
+        return False
+    if stamp["fingerprint"] != fingerprint:
+        log.debug("Stale: " + tasks.task_name(task))
+        return False
+    return all(os.path.exists(os.path.join(root_folder, base_filename + "_map.json")) for base_filename in stamp["outputs"])
@@ -0,0 +1,89 @@
+"""Wall time and peak memory of the tasks of previous runs
+
+The runner records the wall time and the peak resident memory of each task
+that completes in a json file, by default `task_history.json` in the output
+folder. Later runs submit the tasks longest first, so that the long tasks,
+e.g. 70 GHz surveydiff, do not start at the end of the run, and the local
+back end uses the peak memory to pack tasks on the workers, see
+scheduler.run_local.
+"""
+
+import os
+import json
+import time
+import exceptions
+
+import tasks
+import memory
+
+FILENAME = "task_history.json"
+
+class TaskMonitor(object):
+    """Measures wall time and peak memory of a task in the current process,
+    create it when the task starts and call stats when it completes"""
+
+    def __init__(self):
+        memory.start_task()
+        self.start = time.time()
+
+    def stats(self):
+        return dict(wall_time=time.time() - self.start, peak_memory=memory.task_peak())
+
+class History(object):
+    """History of the tasks of previous runs
+
+    Parameters
+    ----------
+    filename : string
+        json file, created by save if missing
+    nside : int or None
+        working nside, entries recorded at another nside are ignored
+    """
+
+    def __init__(self, filename, nside=None):
+        self.filename = filename
+        self.nside = nside
+        try:
+            with open(filename) as f:
+                self.entries = json.load(f)
+        except (exceptions.IOError, exceptions.ValueError):
+            self.entries = {}
+
+    def get(self, task):
+        """Last wall_time, peak_memory and the number of runs of a task, None if unknown"""
+        entry = self.entries.get(tasks.task_name(task))
+        if entry is None or entry.get("nside") != self.nside:
+            return None
+        return entry
+
+    def wall_time(self, task, default=None):
+        entry = self.get(task)
+        return entry["wall_time"] if entry else default
+
+    def peak_memory(self, task, default=None):
+        entry = self.get(task)
+        return entry["peak_memory"] if entry else default
+
+    def mean_wall_time(self, default=1.):
+        """Mean wall time of the tasks at this nside, e.g. expected wall time of new tasks"""
+        wall_times = [e["wall_time"] for e in self.entries.values() if e.get("nside") == self.nside]
+        return sum(wall_times) / len(wall_times) if wall_times else default
+
+    def update(self, task, stats):
+        """Record the stats of a completed task, see TaskMonitor"""
+        entry = self.get(task) or dict(runs=0)
+        entry.update(wall_time=stats["wall_time"], peak_memory=stats["peak_memory"],
+                     nside=self.nside, runs=entry["runs"] + 1)
+        self.entries[tasks.task_name(task)] = entry
+
+    def save(self):
+        tmp_filename = "%s.tmp%d" % (self.filename, os.getpid())
+        with open(tmp_filename, "w") as f:
+            json.dump(self.entries, f, indent=4, sort_keys=True)
+        os.rename(tmp_filename, self.filename)
+
+    def order(self, task_list):
+        """Tasks longest first, tasks without history first in their original order"""
+        unknown = [task for task in task_list if self.get(task) is None]
+        known = [task for task in task_list if self.get(task) is not None]
+        return unknown + sorted(known, key=self.wall_time, reverse=True)
@@ -0,0 +1,138 @@
+"""Process x thread layout of the workers of a node
+
+healpy runs map2alm and alm2map, i.e. smoothing and anafast, with OpenMP
+threads, by default as many as the cores of the node. One worker per core
+oversubscribes the node during the transforms, one worker per node leaves
+the reading, downgrading and masking single threaded.
+
+The layout takes the number of cores of a node and chooses for each task
+class, I or IQU maps, the number of transform threads of a task and the
+number of worker processes, so that the workers running tasks of the class
+with fewest threads fill the node. The local back end dispatches a task only
+if its threads fit in the cores left by the running tasks, each worker sets
+its OpenMP threads before running a task, see set_threads.
+
+Transforms scale as nside^3, reading as nside^2, so the larger the nside the
+more threads a task gets, IQU tasks twice as many as I tasks.
+"""
+
+import os
+import ctypes
+import socket
+import multiprocessing
+import logging as log
+
+# nside at which a task of each class gets 1 thread per factor
+REFERENCE_NSIDE = 512
+THREADS_FACTOR = {"I": 1, "IQU": 2}
+
+def task_class(task):
+    """Class of a task, the components of its maps, "I" or "IQU" """
+    return "IQU" if len(task.pol) > 1 else "I"
+
+def transform_threads(task_class, nside, cores):
+    """Default number of transform threads of a task of a class"""
+    threads = int(round(THREADS_FACTOR[task_class] * float(nside) / REFERENCE_NSIDE))
+    return max(1, min(threads, cores))
+
+def plan_layout(tasks, nside, cores, threads=None, processes=None):
+    """Worker processes and transform threads for a list of tasks
+
+    Parameters
+    ----------
+    tasks : list of Task
+        tasks to run, only their classes are used
+    nside : int
+        working nside
+    cores : int
+        cores of a node
+    threads : dict or None
+        task class: threads, overriding the defaults of transform_threads
+    processes : int or None
+        number of worker processes, by default enough to fill the node with
+        tasks of the class with fewest threads
+
+    Returns
+    -------
+    layout : dict
+        cores, processes and threads (task class: threads) of the classes of the tasks
+    """
+    threads = threads or {}
+    classes = sorted(set(task_class(task) for task in tasks)) or ["I"]
+    layout_threads = dict((c, max(1, min(int(threads.get(c, transform_threads(c, nside, cores))), cores)))
+                          for c in classes)
+    if processes is None:
+        processes = max(1, cores // min(layout_threads.values()))
+    return dict(cores=cores, processes=processes, threads=layout_threads)
+
+def running_layout(tasks, nside, nodes, cores=None, threads=None):
+    """Layout of worker processes already running, e.g. IPython engines or MPI ranks
+
+    the transform threads are capped so that all the processes of the most
+    crowded node fit in its cores
+
+    Parameters
+    ----------
+    nodes : list of tuples
+        node_info of each process
+    cores : int or None
+        cores of a node, by default the fewest cores reported by the processes
+
+    Returns
+    -------
+    layout : dict
+        see plan_layout, processes is the number of processes of the most crowded node
+    """
+    hosts = [host for host, node_cores in nodes]
+    processes = max(hosts.count(host) for host in hosts)
+    cores = cores or min(node_cores for host, node_cores in nodes)
+    planned = plan_layout(tasks, nside, cores, threads)
+    if processes != planned["processes"]:
+        log.warning("%d processes per node, the layout has %d" % (processes, planned["processes"]))
+    per_process = max(1, cores // processes)
+    return dict(cores=cores, processes=processes,
+                threads=dict((c, min(n, per_process)) for c, n in planned["threads"].items()))
+
+def node_info():
+    """Hostname and number of cores of the node running this process, e.g. an engine"""
+    return socket.gethostname(), multiprocessing.cpu_count()
+
+def describe(layout):
+    return "Layout of each node: %d cores, %d worker processes, transform threads %s" % (
+        layout["cores"], layout["processes"],
+        ", ".join("%s %d" % (c, n) for c, n in sorted(layout["threads"].items())))
+
+def _openmp_libraries():
+    """Paths of the OpenMP runtimes loaded in this process, e.g. the libgomp bundled with healpy"""
+    paths = set()
+    try:
+        with open("/proc/self/maps") as f:
+            for line in f:
+                path = line.split()[-1]
+                name = os.path.basename(path)
+                if name.startswith("libgomp") or name.startswith("libomp") or name.startswith("libiomp"):
+                    paths.add(path)
+    except IOError:
+        pass
+    return sorted(paths)
+
+def set_threads(threads):
+    """Set the number of OpenMP threads of the following transforms in this process
+
+    OMP_NUM_THREADS is read only when the OpenMP runtime starts, the runtimes
+    already loaded, e.g. by importing healpy, are set through omp_set_num_threads.
+
+    Returns
+    -------
+    libraries : list of strings
+        paths of the OpenMP runtimes that were set
+    """
+    os.environ["OMP_NUM_THREADS"] = str(threads)
+    libraries = []
+    for path in _openmp_libraries():
+        try:
+            ctypes.CDLL(path).omp_set_num_threads(int(threads))
+            libraries.append(path)
+        except (OSError, AttributeError):
+            pass
+    return libraries
@@ -0,0 +1,249 @@
+"""Centralized logging of the workers of the parallel back ends
+
+With `log_collector = true` in the [run] section, the local, ipython and
+mpi back ends do not open a log file per test: a collector process started
+by the runner receives the records of all the workers and writes them to a
+single file, `log_file` or run_log.jsonl in the output folder, with buffered
+I/O. Each worker installs once a CollectorHandler as the only handler of its
+root logger, it keeps the records of a task in memory and sends them in
+batches, at least at the end of each task and before each error.
+
+Each line of the log file is a json record:
+
+    {"t": 1400000000.123, "level": "INFO", "task": "halfrings/30_SSfull", "worker": "node1:1234", "msg": "Start logging"}
+
+where task is the name of the task, see tasks.task_name, the same as the base
+filename of its log file. The log can be split into one log file per test,
+with the same format as differences.configure_file_logger:
+
+    python logcollector.py out/run_log.jsonl [out/]
+"""
+
+import os
+import json
+import time
+import Queue
+import socket
+import argparse
+import threading
+import exceptions
+import multiprocessing
+import logging as log
+from multiprocessing.connection import Listener, Client
+
+FILENAME = "run_log.jsonl"
+# records sent at once by a worker
+BATCH = 256
+STOP = "stop"
+
+_handler = None
+_task = None
+
+def connect(address):
+    """Connection to a collector, see LogCollector.address"""
+    return Client(address[0], authkey=address[1])
+
+def _receive(connection, records):
+    try:
+        while True:
+            batch = connection.recv()
+            records.put(batch)
+            if batch == STOP:
+                break
+    except (EOFError, IOError):
+        pass
+    finally:
+        connection.close()
+
+def _collect(listener, filename, buffer_size, grace=10.):
+    """Collector process main loop, writes the batches received until STOP
+
+    after STOP, the batches still in flight are written until all the
+    connections are closed or for at most grace seconds
+    """
+    records = Queue.Queue()
+    receivers = []
+
+    def accept():
+        while True:
+            try:
+                connection = listener.accept()
+            except (exceptions.IOError, exceptions.EOFError, socket.error, multiprocessing.AuthenticationError):
+                # wrong authkey or closed listener
+                continue
+            receiver = threading.Thread(target=_receive, args=(connection, records))
+            receiver.daemon = True
+            receiver.start()
+            receivers.append(receiver)
+
+    acceptor = threading.Thread(target=accept)
+    acceptor.daemon = True
+    acceptor.start()
+    with open(filename, "a", buffer_size) as f:
+        stop_time = None
+        while True:
+            try:
+                # a timeout makes the wait interruptible
+                batch = records.get(timeout=1.)
+            except Queue.Empty:
+                # the workers close their connections at the end of their tasks
+                if stop_time and (not any(receiver.is_alive() for receiver in receivers) or time.time() > stop_time + grace):
+                    break
+                continue
+            if batch == STOP:
+                stop_time = time.time()
+                continue
+            for record in batch:
+                f.write(json.dumps(record, separators=(",", ":")) + "\n")
+
+class LogCollector(object):
+    """Collector process of the records of the workers
+
+    Parameters
+    ----------
+    filename : string
+        json lines log file, records are appended
+    buffer_size : int
+        bytes of the write buffer of the log file
+    """
+
+    def __init__(self, filename, buffer_size=2**20):
+        self.filename = filename
+        authkey = os.urandom(16)
+        listener = Listener(("", 0), authkey=authkey)
+        # the workers might run on other nodes
+        self.address = ((socket.getfqdn(), listener.address[1]), authkey)
+        self.process = multiprocessing.Process(target=_collect, args=(listener, filename, buffer_size))
+        self.process.daemon = True
+        self.process.start()
+        listener.close()
+
+    def stop(self, timeout=30.):
+        """Write the records received and stop the collector"""
+        connection = connect(self.address)
+        connection.send(STOP)
+        connection.close()
+        self.process.join(timeout)
+        if self.process.is_alive():
+            log.warning("Log collector still running, terminated")
+            self.process.terminate()
+
+class CollectorHandler(log.Handler):
+    """Handler sending the records of the current task to a LogCollector
+
+    Parameters
+    ----------
+    address : tuple
+        address and authkey of the collector, see LogCollector.address
+    """
+
+    def __init__(self, address):
+        log.Handler.__init__(self)
+        self.address = address
+        self.worker = "%s:%d" % (socket.gethostname(), os.getpid())
+        self.records = []
+        self.connection = None
+        self.setFormatter(log.Formatter("%(message)s"))
+
+    def emit(self, record):
+        try:
+            self.records.append(dict(t=round(record.created, 3), level=record.levelname, task=_task,
+                                     worker=self.worker, msg=self.format(record)))
+            if len(self.records) >= BATCH or record.levelno >= log.ERROR:
+                self.flush()
+        except exceptions.Exception:
+            self.handleError(record)
+
+    def flush(self):
+        if not self.records:
+            return
+        if self.connection is None:
+            self.connection = connect(self.address)
+        self.connection.send(self.records)
+        self.records = []
+
+    def close(self):
+        """Send the records and close the connection, a new one is opened by the next record"""
+        self.flush()
+        if self.connection is not None:
+            self.connection.close()
+            self.connection = None
+
+def start_task(address, name):
+    """Log the records of a task to a collector, installing the handler on the first call
+
+    Parameters
+    ----------
+    address : tuple
+        see LogCollector.address
+    name : string
+        name of the task, see tasks.task_name
+    """
+    global _handler, _task
+    _task = name
+    if _handler is None or _handler.address != address or _handler not in log.root.handlers:
+        _handler = CollectorHandler(address)
+        for h in log.root.handlers[:]:
+            h.close()
+            log.root.removeHandler(h)
+        log.root.addHandler(_handler)
+        log.root.level = log.DEBUG
+    log.info("Start logging")
+
+def end_task():
+    """Send the records of the current task and close the connection"""
+    global _task
+    if _handler is not None:
+        _handler.close()
+    _task = None
+
+def format_record(record):
+    """Line of a record in the format of differences.configure_file_logger"""
+    asctime = time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(record["t"])) + ",%03d" % (record["t"] % 1 * 1000)
+    return "%s %-8s %s" % (asctime, record["level"], record["msg"])
+
+def split_log(filename, root_folder=None):
+    """Write the records of each task of a collected log to its own log file
+
+    Parameters
+    ----------
+    filename : string
+        json lines log file written by a LogCollector
+    root_folder : string or None
+        root folder of the log files, by default the folder of filename,
+        records without task go to run.log
+
+    Returns
+    -------
+    filenames : list of strings
+        log files written, in the order of the first record of each task
+    """
+    root_folder = root_folder or os.path.dirname(filename)
+    lines = {}
+    order = []
+    with open(filename) as f:
+        for line in f:
+            record = json.loads(line)
+            task = record["task"] or "run"
+            if task not in lines:
+                lines[task] = []
+                order.append(task)
+            lines[task].append(format_record(record))
+    filenames = []
+    for task in order:
+        log_filename = os.path.join(root_folder, task + ".log")
+        try:
+            os.makedirs(os.path.dirname(log_filename))
+        except OSError:
+            pass
+        with open(log_filename, "w") as f:
+            f.write("\n".join(lines[task]) + "\n")
+        filenames.append(log_filename)
+    return filenames
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Split a collected log in one log file per test")
+    parser.add_argument("log", help="json lines log file, e.g. out/run_log.jsonl")
+    parser.add_argument("root_folder", nargs="?", help="root folder of the log files, by default the folder of the log")
+    args = parser.parse_args()
+    print "Wrote %d log files" % len(split_log(args.log, args.root_folder))
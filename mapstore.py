@@ -0,0 +1,281 @@
+"""Node-local shared memory store of maps and masks
+
+Maps are read and downgraded once per node and written as `.npy` files to a
+folder on a memory backed filesystem, typically `/dev/shm`. All the processes
+on the node then attach zero-copy read-only views of the same pages with
+`numpy.load(mmap_mode='r')`.
+
+Each entry has a reference count of the tasks that read it, tasks release
+it when they complete and the entry is evicted when the count drops to zero.
+The serial, local and graph back ends run on the node of the runner, which
+declares all the queued tasks as consumers before the run, the retries of a
+failed task declare themselves again. The dispatch side of the ipython
+and mpi back ends does not know the store of the node that runs a task, so
+each engine or rank declares a task as consumer when it receives it, see
+tasks.run_task: an entry then lives while the tasks of the node reading it
+run, plus the masks shared by the MPI ranks, which are kept until the end
+of the run. Views that are still attached, e.g. in the reader.CachedReader
+of a process, survive the eviction, the memory is freed when they are deleted.
+Entries left by killed tasks are removed when the store is cleared at the end
+of the run.
+
+ScratchMaps uses the same files as private scratch space of a single test,
+see differences.pairs_of_maps.
+"""
+
+import os
+import json
+import fcntl
+import shutil
+import hashlib
+import tempfile
+import logging as log
+from collections import OrderedDict
+import numpy as np
+
+from reader import BaseMapReader
+
+DEFAULT_FOLDER = "/dev/shm/plancknull"
+
+def _write_value(folder, value, name="0"):
+    """Write arrays, masked arrays and (nested) lists of them to .npy files
+
+    Returns
+    -------
+    structure : dict
+        json-serializable description used by _read_value to rebuild value
+    """
+    if isinstance(value, (list, tuple)):
+        return {"type":type(value).__name__, "items":[_write_value(folder, v, "%s_%d" % (name, i)) for i, v in enumerate(value)]}
+    if isinstance(value, np.ma.MaskedArray):
+        np.save(os.path.join(folder, name + "_data.npy"), value.data)
+        np.save(os.path.join(folder, name + "_mask.npy"), np.ma.getmaskarray(value))
+        # healpy.ma sets the fill value to UNSEEN, healpy functions fill masked pixels with it
+        return {"type":"ma", "name":name, "fill_value":float(value.fill_value)}
+    np.save(os.path.join(folder, name + ".npy"), np.asarray(value))
+    return {"type":"array", "name":name}
+
+def _read_value(folder, structure):
+    """Attach read-only memory mapped views of a value written by _write_value"""
+    if structure["type"] in ["list", "tuple"]:
+        items = [_read_value(folder, s) for s in structure["items"]]
+        return items if structure["type"] == "list" else tuple(items)
+    if structure["type"] == "ma":
+        data = np.load(os.path.join(folder, structure["name"] + "_data.npy"), mmap_mode='r')
+        mask = np.load(os.path.join(folder, structure["name"] + "_mask.npy"), mmap_mode='r')
+        return np.ma.MaskedArray(data, mask=mask, copy=False, fill_value=structure.get("fill_value"))
+    return np.load(os.path.join(folder, structure["name"] + ".npy"), mmap_mode='r')
+
+class SharedMapStore(object):
+    """Maps and masks shared by all the processes of a node
+
+    Parameters
+    ----------
+    folder : string
+        folder on a node-local memory backed filesystem, e.g. /dev/shm/plancknull,
+        or on local disk for memory-mapped files
+    """
+
+    def __init__(self, folder=DEFAULT_FOLDER):
+        self.folder = folder
+        try:
+            os.makedirs(folder)
+        except OSError:
+            pass
+
+    def _path(self, key):
+        return os.path.join(self.folder, hashlib.md5(repr(key)).hexdigest())
+
+    def _lock(self, key):
+        """Exclusive lock on a key across processes, release by closing the file"""
+        lock_file = open(self._path(key) + ".lock", "a")
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        return lock_file
+
+    def __contains__(self, key):
+        return os.path.exists(os.path.join(self._path(key), "structure.json"))
+
+    def get(self, key, loader):
+        """Read-only view of the value of key
+
+        the first process requesting a key calls loader() and writes its output
+        to the store, the other processes wait for it and attach to the same files
+
+        Parameters
+        ----------
+        key : tuple
+            identifier of the value, its repr must be the same in all processes
+        loader : callable
+            function without arguments returning the value, arrays or lists of arrays
+        """
+        path = self._path(key)
+        with self._lock(key):
+            if key in self:
+                log.debug("Shared store hit: %s" % str(key))
+            else:
+                log.debug("Shared store miss: %s" % str(key))
+                tmp_path = "%s.tmp%d" % (path, os.getpid())
+                os.mkdir(tmp_path)
+                try:
+                    structure = _write_value(tmp_path, loader())
+                    with open(os.path.join(tmp_path, "structure.json"), "w") as f:
+                        json.dump(structure, f)
+                except:
+                    # a failed read can be retried by the same process
+                    shutil.rmtree(tmp_path, ignore_errors=True)
+                    raise
+                os.rename(tmp_path, path)
+            with open(os.path.join(path, "structure.json")) as f:
+                structure = json.load(f)
+            return _read_value(path, structure)
+
+    def _update_refs(self, key, delta):
+        path = self._path(key)
+        with self._lock(key):
+            try:
+                with open(path + ".refs") as f:
+                    refs = int(f.read())
+            except IOError:
+                if delta < 0:
+                    # consumers never declared, e.g. interactive use, keep until clear()
+                    return None
+                refs = 0
+            refs = max(refs + delta, 0)
+            with open(path + ".refs", "w") as f:
+                f.write(str(refs))
+            if refs == 0:
+                self._evict(key)
+        return refs
+
+    def incref(self, key, n=1):
+        """Declare n more consumers of key, e.g. queued tasks, nothing for n = 0"""
+        if not n:
+            return None
+        return self._update_refs(key, n)
+
+    def release(self, key):
+        """A consumer of key is done, evict key if it has no more consumers
+
+        Returns
+        -------
+        refs : int or None
+            remaining number of consumers, None if they were never declared
+        """
+        return self._update_refs(key, -1)
+
+    def _evict(self, key):
+        path = self._path(key)
+        if os.path.exists(path):
+            log.debug("Shared store evict: %s" % str(key))
+            shutil.rmtree(path)
+        # the lock file is kept, other processes might be waiting on it
+        try:
+            os.remove(path + ".refs")
+        except OSError:
+            pass
+
+    def clear(self):
+        """Remove all entries of the store"""
+        shutil.rmtree(self.folder, ignore_errors=True)
+
+class ScratchMaps(object):
+    """Maps written to memory-mapped scratch files, with a bounded number attached
+
+    Values are written once with `scratch[key] = value`, `scratch[key]` attaches
+    read-only views and keeps at most max_resident values attached, in least
+    recently used order, so the pages of the others can be dropped by the kernel.
+
+    Parameters
+    ----------
+    folder : string or None
+        parent folder of the scratch files, by default the system temporary folder,
+        it should be on local disk
+    max_resident : int
+        maximum number of values attached at the same time
+    """
+
+    def __init__(self, folder=None, max_resident=2):
+        self.folder = tempfile.mkdtemp(prefix="plancknull_scratch_", dir=folder)
+        self.max_resident = max_resident
+        self.structures = {}
+        self.resident = OrderedDict()
+        self.loads = 0
+
+    def __setitem__(self, key, value):
+        self.structures[key] = _write_value(self.folder, value, "item%d" % len(self.structures))
+
+    def __getitem__(self, key):
+        if key in self.resident:
+            value = self.resident.pop(key)
+        else:
+            self.loads += 1
+            value = _read_value(self.folder, self.structures[key])
+        self.resident[key] = value
+        while len(self.resident) > self.max_resident:
+            self.resident.popitem(last=False)
+        return value
+
+    def close(self):
+        """Detach all values and remove the scratch files"""
+        self.resident.clear()
+        shutil.rmtree(self.folder, ignore_errors=True)
+
+class SharedStoreReader(BaseMapReader):
+    """Reader wrapper that reads maps and masks through a SharedMapStore
+
+    It is picklable, so it can be sent to parallel engines in place of the
+    wrapped reader, each engine attaches to the store of its own node.
+
+    Parameters
+    ----------
+    reader : BaseMapReader
+        reader used on store misses, other attributes are forwarded to it
+    folder : string
+        folder of the SharedMapStore
+    """
+
+    def __init__(self, reader, folder=DEFAULT_FOLDER):
+        self.reader = reader
+        self.folder = folder
+        self.nside = getattr(reader, "nside", None)
+
+    def __getattr__(self, name):
+        if name == "reader":
+            raise AttributeError(name)
+        return getattr(self.reader, name)
+
+    @property
+    def store(self):
+        return SharedMapStore(self.folder)
+
+    def map_key(self, freq, surv, chtag='', halfring=0, pol="I", bp_corr=False):
+        return ("map", freq, surv, chtag, halfring, pol, bp_corr, self.nside)
+
+    def masks_key(self, freq):
+        return ("masks", freq, self.nside)
+
+    def read_masks(self, freq):
+        return self.store.get(self.masks_key(freq), lambda: self.reader.read_masks(freq))
+
+    def __call__(self, freq, surv, chtag='', halfring=0, pol="I", bp_corr=False):
+        return self.store.get(self.map_key(freq, surv, chtag, halfring, pol, bp_corr),
+                              lambda: self.reader(freq, surv, chtag, halfring=halfring, pol=pol, bp_corr=bp_corr))
+
+    def task_keys(self, reads, freqs):
+        """Store keys of a list of reader calls and of the masks of freqs"""
+        return [self.map_key(*r) for r in reads] + [self.masks_key(freq) for freq in freqs]
+
+    def acquire(self, keys):
+        """Declare a consumer of keys, e.g. a task received by an engine"""
+        store = self.store
+        for key in keys:
+            store.incref(key)
+
+    def release(self, keys):
+        store = self.store
+        for key in keys:
+            store.release(key)
+
+def clear(folder=DEFAULT_FOLDER):
+    """Remove the store in folder, e.g. on all the engines at the end of a run"""
+    SharedMapStore(folder).clear()
@@ -0,0 +1,229 @@
+"""Resident memory of the tasks and of their stages
+
+The stages of the readers and of smooth_combine, see timings.py, also
+record the high-water mark of the resident memory (RSS) of the process
+while they run: the mark is reset when a stage starts and read when it
+ends, Linux >= 4.0 only, otherwise each stage records the peak since the
+process started. differences.write_outputs stores the peak of each stage
+since the previous output of the task, in bytes, in the `memory` block of
+each `_map.json`. At the end of a run, runner.Run writes to run_memory.txt
+in the output folder the mean, 95th percentile and maximum of the peak of
+each stage by test type, and the tasks with the highest peak memory.
+
+The peaks of the stages are recorded separately by each thread, e.g. of the
+nodes evaluated by pipeline.ThreadExecutor, but the high-water mark is the
+one of the whole process and resetting it in a thread would also reset the
+peaks of the stages running in the other threads. While stages run in more
+than one thread the mark is therefore not reset and a stage overlapping
+another one records the resident memory of the process when it ends, which
+includes the memory of the other threads: stage peaks are exact only with
+one task per process, e.g. the local, MPI and ipython back ends.
+
+With `memory_trace = true` in the [run] section, every process of the run
+also traces the Python allocations with tracemalloc, i.e. the pytracemalloc
+backport on Python 2: the `memory_traced` block of each `_map.json` has the
+peak of the traced memory of each stage and the snapshot at the end of each
+task is written next to its outputs, e.g. surveydiff/30_SS1-SS2.tracemalloc.
+"""
+
+import os
+import json
+import resource
+import threading
+import exceptions
+import logging as log
+import numpy as np
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+FILENAME = "run_memory.txt"
+SNAPSHOT_SUFFIX = ".tracemalloc"
+
+class _Peaks(threading.local):
+    def __init__(self):
+        self.peaks = {}
+        self.traced_peaks = {}
+        self.task_peak = 0
+        # stages of the task overlapped stages of other threads, see the module docstring
+        self.shared = False
+        self.overlaps = 0
+
+_state = _Peaks()
+
+# threads running a stage and stages started while another one was running
+_lock = threading.Lock()
+_active = 0
+_overlaps = 0
+
+def reset_peak_memory():
+    """Reset the peak resident memory of this process, Linux >= 4.0 only
+
+    Returns
+    -------
+    reset : bool
+        False if not supported, peak_memory is then the peak since the process started
+    """
+    try:
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+        return True
+    except exceptions.IOError:
+        return False
+
+def peak_memory():
+    """Peak resident memory of this process in bytes"""
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) * 1024
+    except exceptions.IOError:
+        pass
+    # kilobytes on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+def current_memory():
+    """Resident memory of this process in bytes, peak_memory if not available"""
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) * 1024
+    except exceptions.IOError:
+        pass
+    return peak_memory()
+
+def start_tracing():
+    """Trace the Python allocations of this process, see the module docstring"""
+    if tracemalloc is None:
+        log.warning("memory_trace requires tracemalloc, e.g. pytracemalloc on Python 2")
+    elif not tracemalloc.is_tracing():
+        tracemalloc.start()
+
+def is_tracing():
+    return tracemalloc is not None and tracemalloc.is_tracing()
+
+def start_task():
+    """Reset the peak memory of the task and of its stages"""
+    _state.peaks.clear()
+    _state.traced_peaks.clear()
+    _state.task_peak = 0
+    _state.shared = False
+    with _lock:
+        if not _active:
+            reset_peak_memory()
+
+def task_peak():
+    """Peak resident memory since start_task in bytes"""
+    return max(_state.task_peak, current_memory() if _state.shared else peak_memory())
+
+def start_stage():
+    global _active, _overlaps
+    # the peak since the end of the previous stage is part of the task peak
+    _state.task_peak = max(_state.task_peak, current_memory() if _state.shared else peak_memory())
+    with _lock:
+        if _active:
+            _overlaps += 1
+        else:
+            reset_peak_memory()
+        _active += 1
+        _state.overlaps = _overlaps
+    if is_tracing() and hasattr(tracemalloc, "reset_peak"):
+        tracemalloc.reset_peak()
+
+def end_stage(stage):
+    global _active
+    with _lock:
+        _active -= 1
+        # another stage ran during this one, the high-water mark includes its memory
+        shared = _active > 0 or _overlaps != _state.overlaps
+    _state.shared = _state.shared or shared
+    peak = current_memory() if shared else peak_memory()
+    _state.peaks[stage] = max(_state.peaks.get(stage, 0), peak)
+    _state.task_peak = max(_state.task_peak, peak)
+    if is_tracing():
+        _state.traced_peaks[stage] = max(_state.traced_peaks.get(stage, 0), tracemalloc.get_traced_memory()[1])
+
+def take():
+    """Peak memory of each stage since the last call, reset
+
+    Returns
+    -------
+    peaks : dict
+        peak resident memory of each stage in bytes
+    traced_peaks : dict
+        peak traced memory of each stage in bytes, empty without tracing
+    """
+    peaks, traced_peaks = dict(_state.peaks), dict(_state.traced_peaks)
+    _state.peaks.clear()
+    _state.traced_peaks.clear()
+    return peaks, traced_peaks
+
+def dump_snapshot(root_folder, name):
+    """Write the tracemalloc snapshot of a task, name is its task name, see tasks.task_name"""
+    if is_tracing():
+        tracemalloc.take_snapshot().dump(os.path.join(root_folder, name + SNAPSHOT_SUFFIX))
+
+def aggregate(root_folder, outputs):
+    """Statistics of the peak memory of the stages of outputs by test type and stage
+
+    Parameters
+    ----------
+    root_folder : string
+        root path of the output files
+    outputs : list of tuples
+        (test_type, base_filename) of the outputs, see timings.aggregate
+
+    Returns
+    -------
+    rows : list of tuples
+        (test_type, stage, outputs, mean, p95, max) in bytes, sorted by test type and stage
+    """
+    peaks = {}
+    for test_type, base_filename in outputs:
+        try:
+            with open(os.path.join(root_folder, base_filename + "_map.json")) as f:
+                output_memory = json.load(f).get("memory")
+        except exceptions.IOError:
+            continue
+        for stage, value in (output_memory or {}).items():
+            peaks.setdefault((test_type, stage), []).append(value)
+    return [(test_type, stage, len(values), np.mean(values), np.percentile(values, 95), np.max(values))
+            for (test_type, stage), values in sorted(peaks.items())]
+
+def write_summary(root_folder, outputs, task_peaks, filename=None, top=10):
+    """Write the peak memory by stage and of the tasks with the highest peak
+
+    Parameters
+    ----------
+    root_folder : string
+        root path of the output files
+    outputs : list of tuples
+        see aggregate
+    task_peaks : dict
+        peak memory in bytes by task name, see history.TaskMonitor
+    top : int
+        number of tasks listed
+
+    Returns
+    -------
+    summary : string
+        text of the summary, empty without memory records
+    """
+    rows = aggregate(root_folder, outputs)
+    if not rows and not task_peaks:
+        return ""
+    lines = ["%-12s %-16s %7s %10s %10s %10s" % ("Test type", "Stage", "Outputs", "Mean [MB]", "P95 [MB]", "Max [MB]")]
+    for test_type, stage, n, mean, p95, maximum in rows:
+        lines.append("%-12s %-16s %7d %10.1f %10.1f %10.1f" % (test_type, stage, n, mean / 2.**20, p95 / 2.**20, maximum / 2.**20))
+    if task_peaks:
+        lines += ["", "%-40s %10s" % ("Task", "Peak [MB]")]
+        for name, peak in sorted(task_peaks.items(), key=lambda item: -item[1])[:top]:
+            lines.append("%-40s %10.1f" % (name, peak / 2.**20))
+    summary = "\n".join(lines)
+    with open(filename or os.path.join(root_folder, FILENAME), "w") as f:
+        f.write(summary + "\n")
+    return summary
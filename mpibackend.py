@@ -0,0 +1,245 @@
+"""MPI back end for run_null.py
+
+For batch allocations where an IPython controller is awkward to start, with
+`backend = mpi` in the [run] section:
+
+    mpirun -n 64 python run_null.py run_dx11.conf
+
+All the ranks read the run configuration. Rank 0 plans the run, see
+runner.Run.execute, and dispatches the tasks one at a time to the other
+ranks with the same Dispatcher as the local back end, so that the ranks keep
+working on tasks reading the same maps. With a single rank, rank 0 runs all
+the tasks itself.
+
+Maps and masks are shared by the ranks of a node through the node shared
+map store, see mapstore.py: rank 0 reads the masks of all the frequencies
+and broadcasts them to one rank per node, which writes them to the store of
+its node, a map is read once per node by the first rank that needs it and
+evicted when no task running on the node reads it. The stores are cleared at
+the end of the run.
+
+The failures of all the ranks are gathered on rank 0, each with the rank and
+host that ran the task, and reported together in the summary of the run.
+"""
+
+import time
+import socket
+import traceback
+import exceptions
+from ConfigParser import NoOptionError
+import logging as log
+
+from mpi4py import MPI
+
+import layout
+import mapstore
+from reader import CachedReader
+from scheduler import Dispatcher, WorkerStats, print_utilisation
+from tasks import run_task, task_name
+
+ROOT = 0
+
+def node_communicators(comm):
+    """Communicator of the ranks of this node and communicator of the first rank of each node
+
+    Returns
+    -------
+    node : MPI.Comm
+        ranks sharing memory with this rank
+    leaders : MPI.Comm
+        rank 0 of each node, ordered as in comm, MPI.COMM_NULL on the other ranks
+    """
+    node = comm.Split_type(MPI.COMM_TYPE_SHARED, key=comm.rank)
+    leaders = comm.Split(0 if node.rank == 0 else MPI.UNDEFINED, comm.rank)
+    return node, leaders
+
+def share_masks(comm, mapreader, freqs=None):
+    """Read the masks on rank 0 and write them once to the shared store of each node
+
+    collective, rank 0 is the first rank of its node, so it is also rank 0 of leaders
+
+    Parameters
+    ----------
+    mapreader : mapstore.SharedStoreReader
+        reader of the run
+    freqs : list of int or None
+        frequencies of the tasks, used on rank 0 only
+    """
+    node, leaders = node_communicators(comm)
+    freqs = comm.bcast(freqs, root=ROOT)
+    if leaders != MPI.COMM_NULL:
+        log.info("Rank %d: sharing the masks of %d frequencies on %s" % (comm.rank, len(freqs), socket.gethostname()))
+        for freq in freqs:
+            masks = mapreader.reader.read_masks(freq) if comm.rank == ROOT else None
+            masks = leaders.bcast(masks, root=ROOT)
+            mapreader.store.get(mapreader.masks_key(freq), lambda: masks)
+            # kept until finish clears the store, the tasks only add and release their own references
+            mapreader.store.incref(mapreader.masks_key(freq))
+        leaders.Free()
+    node.Barrier()
+    return node
+
+def execute(item, mapreader, smooth_combine_config, root_folder, out_of_core_config, log_collector=None, profile=False):
+    """Run a task received from rank 0
+
+    Returns
+    -------
+    message : tuple
+        ("task", task_id, status, error, start, end, stats of the task), error
+        is prefixed with the rank and host that ran the task
+    """
+    task_id, task, task_fingerprint, threads = item
+    start = time.time()
+    error = None
+    task_stats = None
+    try:
+        task_stats = run_task(task, mapreader, smooth_combine_config, root_folder, log_to_file=True,
+                              task_fingerprint=task_fingerprint, out_of_core_config=out_of_core_config,
+                              threads=threads, log_collector=log_collector, profile=profile, acquire=True)
+        status = "done"
+    except (NoOptionError, exceptions.IOError) as e:
+        status = "skipped"
+        error = str(e)
+    except exceptions.Exception:
+        status = "failed"
+        error = traceback.format_exc()
+    if error:
+        error = "rank %d on %s: %s" % (MPI.COMM_WORLD.rank, socket.gethostname(), error)
+    return ("task", task_id, status, error, start, time.time(), task_stats)
+
+def finish(comm, node, folder):
+    """Collective end of a run, clears the shared store of each node"""
+    comm.Barrier()
+    if node.rank == 0:
+        mapstore.clear(folder)
+    node.Free()
+
+def serve(mapreader, smooth_combine_config, root_folder, cache_maps=8, out_of_core_config=None, profile=False, comm=MPI.COMM_WORLD):
+    """Main loop of the ranks other than rank 0, runs tasks until rank 0 sends None
+
+    Parameters
+    ----------
+    mapreader : mapstore.SharedStoreReader
+        reader of the run, wrapped in a CachedReader
+    see run_mpi for the other parameters
+    """
+    comm.gather(layout.node_info(), root=ROOT)
+    log_collector = comm.bcast(None, root=ROOT)
+    node = share_masks(comm, mapreader)
+    cached_reader = CachedReader(mapreader, max_maps=cache_maps)
+    message = ("ready",)
+    while True:
+        comm.send(message + (cached_reader.hits, cached_reader.misses), dest=ROOT)
+        item = comm.recv(source=ROOT)
+        if item is None:
+            break
+        message = execute(item, cached_reader, smooth_combine_config, root_folder, out_of_core_config, log_collector, profile)
+    finish(comm, node, mapreader.folder)
+
+def run_mpi(tasks, mapreader, smooth_combine_config, root_folder, cache_maps=8, fingerprints=None, out_of_core_config=None, cost=None, node_cores=None, transform_threads=None, task_stats=None, log_collector=None, profile=False, telemetry=None, comm=MPI.COMM_WORLD):
+    """Run tasks on all the ranks, called on rank 0 while the other ranks call serve
+
+    Parameters
+    ----------
+    tasks : list of Task
+        tasks to run, see tasks.build_tasks
+    mapreader : mapstore.SharedStoreReader
+        reader of the run
+    smooth_combine_config : dict
+        configuration for smooth_combine
+    root_folder : string
+        root path of the output files
+    cache_maps : int
+        maximum number of maps in the cache of each rank
+    fingerprints : dict or None
+        fingerprint of each task, recorded when it completes, see fingerprint.py
+    out_of_core_config : dict or None
+        see tasks.run_task
+    cost : callable or None
+        expected wall time of a task, see scheduler.Dispatcher
+    node_cores : int or None
+        cores of a node, see layout.running_layout
+    transform_threads : dict or None
+        threads of each task class, see layout.plan_layout
+    task_stats : dict or None
+        filled with the stats returned by tasks.run_task for each completed task
+    log_collector : tuple or None
+        address of the collector of the log records of the ranks, see logcollector.py
+    profile : bool
+        run each task under cProfile, see profiling.py
+    telemetry : telemetry.Telemetry or None
+        receives the start and the end of each task
+    comm : MPI.Comm
+        communicator of all the ranks
+
+    Returns
+    -------
+    results : list of tuples
+        (task, status, error) for each task, status is "done", "skipped" or "failed",
+        error is the exception message or traceback
+    """
+    fingerprints = fingerprints or {}
+    nodes = comm.gather(layout.node_info(), root=ROOT)
+    comm.bcast(log_collector, root=ROOT)
+    # rank 0 only dispatches, unless it is alone
+    workers = range(1, comm.size) or [ROOT]
+    run_layout = layout.running_layout(tasks, mapreader.nside, [nodes[rank] for rank in workers],
+                                       cores=node_cores, threads=transform_threads)
+    log.info(layout.describe(run_layout))
+    print "Run %d tasks on %d MPI ranks on %d nodes" % (len(tasks), len(workers), len(set(host for host, cores in nodes)))
+    node = share_masks(comm, mapreader, sorted(set(task.freq for task in tasks)))
+
+    dispatcher = Dispatcher(tasks, cost=cost)
+    results = [None] * len(tasks)
+    stats = dict((rank, WorkerStats()) for rank in workers)
+
+    def next_item(rank):
+        item = dispatcher.next_task(rank)
+        if item is None:
+            return None
+        task_id, task = item
+        if telemetry:
+            telemetry.started(task, rank)
+        return (task_id, task, fingerprints.get(task), run_layout["threads"][layout.task_class(task)])
+
+    def collect(rank, message):
+        _, task_id, status, error, start, end, stats_of_task = message
+        if stats_of_task is not None and task_stats is not None:
+            task_stats[tasks[task_id]] = stats_of_task
+        results[task_id] = (tasks[task_id], status, error)
+        stats[rank].tasks += 1
+        stats[rank].busy += end - start
+        if telemetry:
+            telemetry.completed(tasks[task_id], status, rank, end - start,
+                                dict(stats_of_task or {}, cache_hits=stats[rank].cache_hits, cache_misses=stats[rank].cache_misses), error)
+        if status == "done":
+            log.info("Completed %s in %.1f s on rank %d" % (task_name(tasks[task_id]), end - start, rank))
+        else:
+            log.error("%s %s on rank %d" % (status.upper(), task_name(tasks[task_id]), rank))
+
+    run_start = time.time()
+    if comm.size == 1:
+        # without the collector, the records of rank 0 go to a log file per test
+        cached_reader = CachedReader(mapreader, max_maps=cache_maps)
+        item = next_item(ROOT)
+        while item is not None:
+            collect(ROOT, execute(item, cached_reader, smooth_combine_config, root_folder, out_of_core_config, profile=profile))
+            item = next_item(ROOT)
+        stats[ROOT].cache_hits, stats[ROOT].cache_misses = cached_reader.hits, cached_reader.misses
+    else:
+        status = MPI.Status()
+        active = len(workers)
+        while active:
+            message = comm.recv(source=MPI.ANY_SOURCE, status=status)
+            rank = status.Get_source()
+            stats[rank].cache_hits, stats[rank].cache_misses = message[-2:]
+            if message[0] == "task":
+                collect(rank, message[:-2])
+            item = next_item(rank)
+            if item is None:
+                active -= 1
+            comm.send(item, dest=rank)
+    wall_time = time.time() - run_start
+    finish(comm, node, mapreader.folder)
+    print_utilisation(stats, wall_time)
+    return results
@@ -0,0 +1,336 @@
+"""Lazy pipeline graph of the null tests
+
+The tasks of a run are expanded to a directed acyclic graph whose nodes are
+map reads (including the downgrade to the working nside), mask reads and
+outputs, each output node combines, smooths and takes the spectra of a couple
+of maps with smooth_combine. Nodes are identified by a key, so a map or a
+mask needed by several tests is read only once. The graph is evaluated by a
+pluggable executor and the value of each node is freed as soon as its last
+consumer completes.
+"""
+
+import os
+import time
+import Queue
+import traceback
+import exceptions
+import multiprocessing
+import multiprocessing.pool
+import logging as log
+from ConfigParser import NoOptionError
+import numpy as np
+
+import differences
+import fingerprint
+from tasks import task_couples, task_outputs, task_reads
+
+class Ref(object):
+    """Reference to the value of another node in the arguments of a node"""
+
+    def __init__(self, key):
+        self.key = key
+
+class Node(object):
+    """Node of the graph, func(*args) with Ref arguments replaced by values"""
+
+    def __init__(self, key, func, args):
+        self.key = key
+        self.func = func
+        self.args = args
+        self.deps = list(set(a.key for a in args if isinstance(a, Ref)))
+        self.value = None
+
+def _call(func, args):
+    """Run a node, exceptions are returned with their traceback"""
+    try:
+        return "done", func(*args), None
+    except (NoOptionError, exceptions.IOError) as e:
+        return "skipped", None, str(e)
+    except exceptions.Exception:
+        return "failed", None, traceback.format_exc()
+
+class SerialExecutor(object):
+    """Evaluates each node in the calling thread"""
+
+    slots = 1
+
+    def submit(self, func, args, callback):
+        callback(_call(func, args))
+
+    def close(self):
+        pass
+
+class ThreadExecutor(object):
+    """Evaluates nodes in a pool of threads, healpy and numpy release the GIL
+    in the transforms and in most array operations"""
+
+    def __init__(self, threads=None):
+        self.slots = threads or multiprocessing.cpu_count()
+        self.pool = multiprocessing.pool.ThreadPool(self.slots)
+        if self.slots > 1:
+            log.warning("Peak memory of the stages is the resident memory of the process shared by %d threads, see memory.py" % self.slots)
+
+    def submit(self, func, args, callback):
+        self.pool.apply_async(_call, (func, args), callback=callback)
+
+    def close(self):
+        self.pool.close()
+        self.pool.join()
+
+class ProcessExecutor(ThreadExecutor):
+    """Evaluates nodes in a pool of processes, node functions and values
+    are pickled to and from the workers"""
+
+    def __init__(self, processes=None):
+        self.slots = processes or multiprocessing.cpu_count()
+        self.pool = multiprocessing.Pool(self.slots)
+
+EXECUTORS = dict(serial=SerialExecutor, threads=ThreadExecutor, processes=ProcessExecutor)
+
+class Graph(object):
+    """Directed acyclic graph of lazily evaluated nodes"""
+
+    def __init__(self):
+        self.nodes = {}
+        # insertion order, used to evaluate ready nodes in a deterministic order
+        self.order = []
+
+    def add(self, key, func, *args):
+        """Add a node unless a node with the same key exists
+
+        Returns
+        -------
+        ref : Ref
+            reference to the node, to be used as argument of other nodes
+        """
+        if key not in self.nodes:
+            for a in args:
+                if isinstance(a, Ref) and a.key not in self.nodes:
+                    raise KeyError("Missing dependency %s of %s" % (str(a.key), str(key)))
+            self.nodes[key] = Node(key, func, args)
+            self.order.append(key)
+        return Ref(key)
+
+    def consumers(self):
+        """Number of nodes depending on each node"""
+        count = dict((key, 0) for key in self.nodes)
+        for node in self.nodes.values():
+            for dep in node.deps:
+                count[dep] += 1
+        return count
+
+    def run(self, executor=None, callback=None):
+        """Evaluate all the nodes
+
+        nodes whose dependencies failed are not evaluated, the value of a
+        node is released after all its consumers completed
+
+        Parameters
+        ----------
+        executor : SerialExecutor, ThreadExecutor or ProcessExecutor
+            default SerialExecutor
+        callback : callable or None
+            called as callback(key, status) when each node completes or is skipped
+
+        Returns
+        -------
+        status : dict
+            (status, error) of each node key, status is "done", "skipped" or "failed"
+        """
+        executor = executor or SerialExecutor()
+        consumers = self.consumers()
+        missing = dict((key, len(node.deps)) for key, node in self.nodes.items())
+        dependents = dict((key, []) for key in self.nodes)
+        for node in self.nodes.values():
+            for dep in node.deps:
+                dependents[dep].append(node.key)
+        # nodes without consumers (outputs) first, so that their inputs are freed
+        # as early as possible, then in insertion order
+        priority = dict((key, (consumers[key] > 0, i)) for i, key in enumerate(self.order))
+        ready = [key for key in self.order if missing[key] == 0]
+        completed = Queue.Queue()
+        status = {}
+        running = 0
+
+        def release(key):
+            for dep in self.nodes[key].deps:
+                consumers[dep] -= 1
+                if consumers[dep] == 0:
+                    self.nodes[dep].value = None
+
+        def cancel(key, reason):
+            # dependents of a failed node are skipped
+            if key in status:
+                return
+            status[key] = ("skipped", reason)
+            if callback:
+                callback(key, "skipped")
+            release(key)
+            for dependent in dependents[key]:
+                cancel(dependent, reason)
+
+        while ready or running:
+            while ready and running < executor.slots:
+                key = min(ready, key=priority.get)
+                ready.remove(key)
+                if key in status:
+                    continue
+                node = self.nodes[key]
+                args = [self.nodes[a.key].value if isinstance(a, Ref) else a for a in node.args]
+                log.debug("Evaluate node %s" % str(key))
+                running += 1
+                executor.submit(node.func, args, lambda result, key=key: completed.put((key, result)))
+            if not running:
+                continue
+            # timeout keeps the main thread responsive to KeyboardInterrupt
+            while True:
+                try:
+                    key, (node_status, value, error) = completed.get(timeout=1)
+                    break
+                except Queue.Empty:
+                    pass
+            running -= 1
+            node = self.nodes[key]
+            if node_status == "done":
+                status[key] = (node_status, None)
+                if consumers[key] > 0:
+                    node.value = value
+                release(key)
+                for dependent in dependents[key]:
+                    missing[dependent] -= 1
+                    if missing[dependent] == 0:
+                        ready.append(dependent)
+            else:
+                log.error("%s node %s: %s" % (node_status.upper(), str(key), error))
+                status[key] = (node_status, error)
+                release(key)
+            if callback:
+                callback(key, node_status)
+            if node_status != "done":
+                for dependent in dependents[key]:
+                    cancel(dependent, "Dependency %s %s" % (str(key), node_status))
+        executor.close()
+        return status
+
+def _read_map(mapreader, freq, surv, chtag, halfring, pol, bp_corr):
+    m = mapreader(freq, surv, chtag, halfring=halfring, pol=pol, bp_corr=bp_corr)
+    if pol in ["A", "ADF"]:
+        assert np.all(m >= 0), "Negative variance"
+    return m
+
+def _read_masks(mapreader, freq):
+    return mapreader.read_masks(freq)
+
+def _output(base_filename, metadata, smooth_combine_config, root_folder, masks, m1, m2, var1=None, var2=None):
+    try:
+        os.makedirs(os.path.join(root_folder, os.path.dirname(base_filename)))
+    except OSError:
+        pass
+    ps_mask, union_mask, galaxy_mask = masks
+    variance_maps_and_weights = None
+    if var1 is not None:
+        variance_maps_and_weights = [(var1, 1), (var2, 1)]
+    differences.smooth_combine([(m1, 1), (m2, -1)], variance_maps_and_weights,
+                               base_filename=base_filename, metadata=metadata,
+                               root_folder=root_folder,
+                               smooth_mask=ps_mask, spectra_mask=union_mask,
+                               galaxy_mask=galaxy_mask, **smooth_combine_config)
+    return None
+
+def build_graph(tasks, mapreader, smooth_combine_config, root_folder):
+    """Graph of all the outputs of a list of tasks
+
+    Parameters
+    ----------
+    tasks : list of Task
+        see tasks.build_tasks
+    mapreader, smooth_combine_config, root_folder :
+        see tasks.run_task
+
+    Returns
+    -------
+    graph : Graph
+        map and masks nodes are shared by all the tests reading them
+    """
+    graph = Graph()
+    chi2 = smooth_combine_config["chi2"]
+    for task in tasks:
+        masks = graph.add(("masks", task.freq), _read_masks, mapreader, task.freq)
+        var_pol = 'A' if len(task.pol) == 1 else 'ADF'
+        bp_corr = task.bp_corr if task.test_type == "surveydiff" else False
+        for base_filename, metadata, read1, read2 in task_couples(task):
+            args = []
+            for pol, corr in [(task.pol, bp_corr)] + ([(var_pol, False)] if chi2 else []):
+                for surv, chtag, halfring in [read1, read2]:
+                    key = ("map", task.freq, surv, chtag, halfring, pol, corr)
+                    args.append(graph.add(key, _read_map, mapreader, *key[1:]))
+            graph.add(("output", base_filename), _output, base_filename, metadata,
+                      smooth_combine_config, root_folder, masks, *args)
+    return graph
+
+def run_graph(tasks, mapreader, smooth_combine_config, root_folder, executor="serial", workers=None, fingerprints=None):
+    """Build and evaluate the graph of a list of tasks
+
+    if mapreader reads through a shared store, see mapstore.py, the store
+    entries read by a task are released when all its outputs completed
+
+    Parameters
+    ----------
+    executor : string
+        serial, threads or processes
+    workers : int or None
+        number of threads or processes, by default the number of cores
+    fingerprints : dict or None
+        fingerprint of each task, recorded as soon as all its outputs are written
+
+    Returns
+    -------
+    results : list of tuples
+        (task, status, error) for each task, status is "done" if all its outputs
+        are written, "failed" if any failed, "skipped" otherwise
+    """
+    graph = build_graph(tasks, mapreader, smooth_combine_config, root_folder)
+    fingerprints = fingerprints or {}
+    task_of_output = {}
+    pending = {}
+    for task in tasks:
+        pending[task] = set(("output", base_filename) for base_filename in task_outputs(task))
+        for key in pending[task]:
+            task_of_output[key] = task
+    status = {}
+
+    def callback(key, node_status):
+        if key[0] != "output":
+            return
+        status[key] = node_status
+        task = task_of_output[key]
+        pending[task].discard(key)
+        if not pending[task] and hasattr(mapreader, "release"):
+            mapreader.release(mapreader.task_keys(task_reads(task, smooth_combine_config["chi2"]), [task.freq]))
+        if not pending[task] and fingerprints.get(task) and \
+           all(status[k] == "done" for k in task_of_output if task_of_output[k] == task):
+            fingerprint.write_stamp(root_folder, task, fingerprints[task])
+
+    n_outputs = len(task_of_output)
+    print "Pipeline graph: %d nodes, %d outputs" % (len(graph.nodes), n_outputs)
+    if executor == "serial":
+        executor = SerialExecutor()
+    else:
+        executor = EXECUTORS[executor](workers)
+    start = time.time()
+    node_status = graph.run(executor, callback)
+    print "Pipeline completed in %.1f s" % (time.time() - start)
+
+    results = []
+    for task in tasks:
+        outputs = [node_status[("output", base_filename)] for base_filename in task_outputs(task)]
+        statuses = [s for s, error in outputs]
+        errors = [error for s, error in outputs if error]
+        if all(s == "done" for s in statuses):
+            task_status = "done"
+        elif "failed" in statuses:
+            task_status = "failed"
+        else:
+            task_status = "skipped"
+        results.append((task, task_status, errors[0] if errors else None))
+    return results
@@ -0,0 +1,187 @@
+"""Dry-run plan of a null tests run
+
+Enumerates all the tasks of a run configuration and resolves their input
+files without reading any pixel, then estimates for each task the bytes
+read, the peak memory and the number of spherical harmonic transforms
+(each map2alm or alm2map of an I or IQU map counts as one).
+
+Usage:
+    python run_null.py run_dx11.conf --plan [--plan-json plan.json]
+"""
+
+import os
+import json
+import exceptions
+from ConfigParser import NoOptionError
+import healpy as hp
+
+import fingerprint
+import layout
+from reader import get_filename
+from tasks import task_name, task_reads, task_outputs
+
+# bytes per pixel of a masked float64 map, data and mask
+PIXEL_BYTES = 9
+# read throughput of the input files in MB/s, conservative for shared filesystems
+IO_RATE = 20.
+# seconds of a transform of an IQU map at nside 512, they scale as nside**3
+TRANSFORM_SECONDS = 2.
+
+def transforms_per_output(ncomp, spectra, chi2):
+    """Number of transforms of a smooth_combine call
+
+    anafast is 1 transform, each smoothing 2: map2alm and alm2map.
+    with chi2 every variance component is smoothed twice, with and without
+    galaxy mask, and the map is smoothed again with the galaxy mask
+    """
+    n = 2
+    if spectra:
+        n += 1
+    if chi2:
+        n += 2 * 2 * ncomp + 2
+    return n
+
+def _file_sizes(patterns):
+    """Resolved files and their size, missing files as None"""
+    files = []
+    for pattern in patterns:
+        try:
+            filename = get_filename(pattern)
+            files.append((filename, os.path.getsize(filename)))
+        except exceptions.IOError:
+            files.append((pattern, None))
+    return files
+
+def _input_patterns(task, mapreader, reads):
+    """Patterns of the files of the masks and of each reader call, a file read by several calls is repeated"""
+    patterns = list(mapreader.mask_patterns(task.freq))
+    for read in reads:
+        patterns += mapreader.map_patterns(read[0], read[1], read[2], read[3], read[5])
+    return patterns
+
+def estimate_peak_memory(task, mapreader, chi2, input_sizes=None):
+    """Peak memory of a task in bytes, from the reader nside and its input files
+
+    Parameters
+    ----------
+    input_sizes : list of int or None
+        sizes of the existing input files, by default resolved from the reader patterns
+
+    Returns
+    -------
+    peak_memory : int or None
+        None if the reader configuration lacks some patterns of the task
+    """
+    npix = hp.nside2npix(mapreader.nside)
+    reads = task_reads(task, chi2)
+    if input_sizes is None:
+        try:
+            input_sizes = [size for filename, size in _file_sizes(set(_input_patterns(task, mapreader, reads))) if size is not None]
+        except NoOptionError:
+            return None
+    ncomp = len(task.pol)
+    # all the maps of a task are in memory at the same time, masks are boolean
+    resident = sum(len(read[4]) for read in reads) * npix * PIXEL_BYTES + 3 * npix
+    # smooth_combine: combined, smoothed and masked copies of maps and variances
+    working = 6 * ncomp * npix * PIXEL_BYTES
+    # the largest input file is read at full resolution before downgrading
+    return resident + working + 2 * max(input_sizes or [0])
+
+def plan_task(task, mapreader, smooth_combine_config):
+    """Inputs and cost estimates of a task
+
+    Returns
+    -------
+    plan : dict
+        name, inputs (list of [filename, size] with size None if missing),
+        bytes_read, peak_memory (bytes), transforms, outputs. bytes_read
+        counts the files of each reader call, e.g. a map and its variance
+        are read from the same file by 2 calls
+    """
+    nside = mapreader.nside
+    chi2 = smooth_combine_config["chi2"]
+    reads = task_reads(task, chi2)
+
+    try:
+        patterns = _input_patterns(task, mapreader, reads)
+    except NoOptionError as e:
+        return dict(name=task_name(task), task=list(task), error=str(e))
+    unique_patterns = sorted(set(patterns))
+    inputs = _file_sizes(unique_patterns)
+    pattern_sizes = dict((pattern, size) for pattern, (filename, size) in zip(unique_patterns, inputs))
+    sizes = [size for filename, size in inputs if size is not None]
+    ncomp = len(task.pol)
+    peak_memory = estimate_peak_memory(task, mapreader, chi2, sizes)
+
+    outputs = task_outputs(task)
+    return dict(name=task_name(task), task=list(task),
+                inputs=inputs,
+                missing=len(inputs) - len(sizes),
+                bytes_read=sum(pattern_sizes[pattern] or 0 for pattern in patterns),
+                peak_memory=peak_memory,
+                transforms=len(outputs) * transforms_per_output(ncomp, smooth_combine_config["spectra"], chi2),
+                lmax=3 * nside - 1,
+                outputs=outputs)
+
+def estimate_wall_time(plan, nside, io_rate=IO_RATE):
+    """Expected wall time of a task in seconds from its plan, see plan_task
+
+    reading its inputs at io_rate MB/s and its transforms at the rate
+    of TRANSFORM_SECONDS, None if the task could not be planned
+    """
+    if "error" in plan:
+        return None
+    return plan["bytes_read"] / (io_rate * 2**20) + plan["transforms"] * TRANSFORM_SECONDS * (nside / 512.)**3
+
+def plan_run(run):
+    """Plan of all the tasks of a runner.Run
+
+    Returns
+    -------
+    plan : dict
+        configuration summary, tasks (see plan_task), totals and the
+        layout of the workers of a node, see layout.plan_layout
+    """
+    tasks = []
+    for task in run.tasks:
+        task_plan = plan_task(task, run.mapreader, run.smooth_combine_config)
+        if run.resume:
+            task_fingerprint = fingerprint.task_fingerprint(task, run.mapreader, run.smooth_combine_config)
+            task_plan["up_to_date"] = fingerprint.is_up_to_date(run.root_folder, task, task_fingerprint)
+        tasks.append(task_plan)
+    planned = [t for t in tasks if "error" not in t]
+    totals = dict(tasks=len(tasks),
+                  outputs=sum(len(t["outputs"]) for t in planned),
+                  bytes_read=sum(t["bytes_read"] for t in planned),
+                  max_peak_memory=max([t["peak_memory"] for t in planned] or [0]),
+                  transforms=sum(t["transforms"] for t in planned),
+                  missing_inputs=sum(t["missing"] for t in planned),
+                  errors=len(tasks) - len(planned))
+    return dict(config=run.config_filename, backend=run.backend, nside=run.mapreader.nside,
+                smooth_combine=dict((k, v) for k, v in run.smooth_combine_config.items() if k != "fwhm"),
+                tasks=tasks, totals=totals,
+                layout=run.plan_layout(run.tasks, processes=run.option("processes", None, "getint")))
+
+def _mb(n):
+    return n / 2.**20
+
+def print_plan(plan):
+    print "%-32s %7s %10s %10s %6s %8s" % ("Task", "Outputs", "Read [MB]", "Peak [MB]", "SHTs", "Missing")
+    for t in plan["tasks"]:
+        if "error" in t:
+            print "%-32s ERROR: %s" % (t["name"], t["error"])
+            continue
+        note = " up to date" if t.get("up_to_date") else ""
+        print "%-32s %7d %10.1f %10.1f %6d %8d%s" % (t["name"], len(t["outputs"]), _mb(t["bytes_read"]),
+                                                    _mb(t["peak_memory"]), t["transforms"], t["missing"], note)
+    totals = plan["totals"]
+    print "Total: %d tasks, %d outputs, %.1f MB read, %d transforms at nside %d, max peak memory per task %.1f MB" % (
+        totals["tasks"], totals["outputs"], _mb(totals["bytes_read"]), totals["transforms"],
+        plan["nside"], _mb(totals["max_peak_memory"]))
+    print layout.describe(plan["layout"])
+    if totals["missing_inputs"] or totals["errors"]:
+        print "WARNING: %d missing input files, %d tasks with configuration errors" % (totals["missing_inputs"], totals["errors"])
+
+def write_plan(plan, filename):
+    with open(filename, "w") as f:
+        json.dump(plan, f, indent=4)
@@ -0,0 +1,210 @@
+"""Pre-flight validation of the input files of a run
+
+Resolves the filename patterns of all the inputs of the tasks of a run,
+masks included, and checks concurrently that each pattern matches exactly
+one file, with the same fallback as reader.get_filename, and that its
+HEALPix header has at least the working NSIDE and the columns of all the
+components read from it. Only the headers are read, so that a bad release
+is reported in seconds.
+
+Usage:
+    python run_null.py run_dx11.conf --preflight
+"""
+
+import os
+import time
+import exceptions
+from glob import glob
+from ConfigParser import NoOptionError
+from multiprocessing.pool import ThreadPool
+
+from reader import stokes_I, stokes_IQU, type_of_channel_set
+from tasks import task_name, task_reads
+
+THREADS = 16
+BLOCK = 2880
+CARD = 80
+
+def _card_value(text):
+    text = text.strip()
+    if text.startswith("'"):
+        return text[1:].split("'")[0].strip()
+    value = text.split("/")[0].strip()
+    try:
+        return int(value)
+    except exceptions.ValueError:
+        return value
+
+def read_fits_header(filename, hdu=1):
+    """Header of an HDU of a FITS file, without reading any data
+
+    Returns
+    -------
+    header : dict
+        keyword: value, strings are stripped of quotes, integers converted
+    """
+    with open(filename, "rb") as f:
+        for i in range(hdu + 1):
+            header = {}
+            while True:
+                block = f.read(BLOCK)
+                if len(block) < BLOCK:
+                    raise exceptions.IOError("Truncated FITS header in " + filename)
+                cards = [block[j:j + CARD] for j in range(0, BLOCK, CARD)]
+                for card in cards:
+                    if card[8:10] == "= ":
+                        header[card[:8].strip()] = _card_value(card[10:])
+                if "END" in [card[:8].strip() for card in cards]:
+                    break
+            if i < hdu:
+                # skip the data of this HDU
+                naxis = [header.get("NAXIS%d" % n, 0) for n in range(1, header.get("NAXIS", 0) + 1)]
+                size = 0
+                if naxis:
+                    size = abs(header["BITPIX"]) // 8 * header.get("GCOUNT", 1) * \
+                           (reduce(lambda a, b: a * b, naxis) + header.get("PCOUNT", 0))
+                f.seek((size + BLOCK - 1) // BLOCK * BLOCK, os.SEEK_CUR)
+    return header
+
+def resolve(pattern):
+    """Files matching a pattern, with the same fallback as reader.get_filename"""
+    for candidate in [pattern, pattern.replace("_full", "")]:
+        matches = glob(candidate)
+        if len(matches) == 1:
+            break
+    return matches
+
+def read_columns(freq, chtag, pol):
+    """Number of columns needed to read the components pol, see DXReader.__call__"""
+    stokes = stokes_IQU
+    if (type_of_channel_set(chtag) in ["channel", "horn"]) or freq >= 545:
+        stokes = stokes_I
+    return max(stokes.index(p) for p in pol) + 1
+
+def requirements(tasks, mapreader, chi2):
+    """Input patterns of a list of tasks
+
+    Returns
+    -------
+    inputs : dict
+        pattern: {"columns": minimum number of columns, "tasks": set of task names}
+    errors : list of tuples
+        (task name, error) of the tasks whose patterns cannot be built
+    """
+    inputs = {}
+    errors = []
+
+    def require(pattern, columns, name):
+        entry = inputs.setdefault(pattern, dict(columns=1, tasks=set()))
+        entry["columns"] = max(entry["columns"], columns)
+        entry["tasks"].add(name)
+
+    for task in tasks:
+        name = task_name(task)
+        try:
+            for pattern in mapreader.mask_patterns(task.freq):
+                require(pattern, 1, name)
+            for freq, surv, chtag, halfring, pol, bp_corr in task_reads(task, chi2):
+                patterns = mapreader.map_patterns(freq, surv, chtag, halfring, bp_corr)
+                if bp_corr:
+                    # the correction map is read as IQU
+                    require(patterns.pop(), 3, name)
+                for pattern in patterns:
+                    require(pattern, read_columns(freq, chtag, pol), name)
+        except NoOptionError as e:
+            errors.append((name, str(e)))
+    return inputs, errors
+
+def check_file(pattern, columns=1, nside=None):
+    """Check a single input
+
+    Returns
+    -------
+    result : dict
+        pattern, filename (None unless a single match), problem (None if valid,
+        otherwise "missing", "ambiguous", "unreadable", "nside" or "columns")
+        and message
+    """
+    result = dict(pattern=pattern, filename=None, problem=None, message="")
+    matches = resolve(pattern)
+    if len(matches) != 1:
+        result["problem"] = "missing" if not matches else "ambiguous"
+        result["message"] = ", ".join(sorted(matches))
+        return result
+    result["filename"] = filename = matches[0]
+    try:
+        header = read_fits_header(filename)
+    except exceptions.IOError as e:
+        result["problem"] = "unreadable"
+        result["message"] = str(e)
+        return result
+    file_nside = header.get("NSIDE")
+    if nside and not (isinstance(file_nside, int) and file_nside >= nside):
+        result["problem"] = "nside"
+        result["message"] = "NSIDE %s, working nside %d" % (file_nside, nside)
+    elif header.get("TFIELDS", 0) < columns:
+        result["problem"] = "columns"
+        result["message"] = "%d columns (%s), %d needed" % (header.get("TFIELDS", 0),
+            ", ".join(str(header.get("TTYPE%d" % (n + 1), "")) for n in range(header.get("TFIELDS", 0))), columns)
+    return result
+
+def _check(args):
+    return check_file(*args)
+
+def preflight(tasks, mapreader, chi2, threads=THREADS):
+    """Check concurrently all the inputs of a list of tasks
+
+    Parameters
+    ----------
+    tasks : list of Task
+        see tasks.build_tasks
+    mapreader : DXReader
+        reader providing mask_patterns and map_patterns
+    chi2 : bool
+        whether variance maps are read
+    threads : int
+        number of concurrent checks, the checks are bound by file system latency
+
+    Returns
+    -------
+    report : dict
+        inputs (list of the results of check_file, with the names of the tasks
+        reading each input), config_errors (list of (task name, error)),
+        failed_tasks (names of the tasks with any invalid input) and time
+    """
+    start = time.time()
+    inputs, config_errors = requirements(tasks, mapreader, chi2)
+    patterns = sorted(inputs)
+    pool = ThreadPool(max(1, min(threads, len(patterns))))
+    try:
+        results = pool.map(_check, [(pattern, inputs[pattern]["columns"], mapreader.nside) for pattern in patterns])
+    finally:
+        pool.close()
+        pool.join()
+    failed_tasks = set(name for name, error in config_errors)
+    for result in results:
+        result["tasks"] = sorted(inputs[result["pattern"]]["tasks"])
+        if result["problem"]:
+            failed_tasks.update(result["tasks"])
+    return dict(inputs=results, config_errors=config_errors,
+                failed_tasks=sorted(failed_tasks), time=time.time() - start)
+
+def print_report(report):
+    """Print the invalid inputs grouped by problem, returns True if all are valid"""
+    invalid = [r for r in report["inputs"] if r["problem"]]
+    for problem in ["missing", "ambiguous", "unreadable", "nside", "columns"]:
+        results = [r for r in invalid if r["problem"] == problem]
+        if results:
+            print "%s (%d):" % (problem.upper(), len(results))
+        for r in results:
+            print "    %s" % (r["filename"] or r["pattern"])
+            if r["message"]:
+                print "        %s" % r["message"]
+            print "        read by %d tasks, e.g. %s" % (len(r["tasks"]), r["tasks"][0])
+    if report["config_errors"]:
+        print "CONFIGURATION (%d):" % len(report["config_errors"])
+        for name, error in report["config_errors"]:
+            print "    %s: %s" % (name, error)
+    print "Pre-flight: %d inputs checked in %.1f s, %d invalid, %d tasks affected" % (
+        len(report["inputs"]), report["time"], len(invalid), len(report["failed_tasks"]))
+    return not invalid and not report["config_errors"]
@@ -0,0 +1,120 @@
+"""Profiles of the tasks of a run
+
+With `profile = true` in the [run] section, the serial, local, ipython and
+mpi back ends run each task under cProfile and write its profile next to
+its log file, e.g. out/surveydiff/30_SS1-SS2.prof, whichever worker ran it.
+At the end of the run the profiles of all the tasks are merged in a single
+report of the hottest functions, run_profile.txt in the output folder; the
+report of any set of profiles, e.g. of another run or sorted differently, is
+produced by:
+
+    python profiling.py out/ [--sort cumulative] [--top 50]
+"""
+
+import os
+import sys
+import pstats
+import cProfile
+import argparse
+import logging as log
+from StringIO import StringIO
+
+SUFFIX = ".prof"
+REPORT_FILENAME = "run_profile.txt"
+
+def profile_filename(root_folder, name):
+    """Profile of a task, name is its task name, see tasks.task_name"""
+    return os.path.join(root_folder, name + SUFFIX)
+
+class TaskProfile(object):
+    """cProfile of a task, written when the task ends
+
+    Parameters
+    ----------
+    filename : string or None
+        profile file, see profile_filename, None does not profile
+    """
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.profiler = cProfile.Profile() if filename else None
+
+    def __enter__(self):
+        if self.profiler:
+            self.profiler.enable()
+        return self
+
+    def __exit__(self, *exc_info):
+        if not self.profiler:
+            return
+        self.profiler.disable()
+        try:
+            os.makedirs(os.path.dirname(self.filename))
+        except OSError:
+            pass
+        self.profiler.dump_stats(self.filename)
+
+def find_profiles(root_folder):
+    """Profiles of all the tasks under a folder, sorted"""
+    filenames = []
+    for folder, subfolders, names in os.walk(root_folder):
+        filenames += [os.path.join(folder, name) for name in names if name.endswith(SUFFIX)]
+    return sorted(filenames)
+
+def merge(filenames, sort="tottime", top=40):
+    """Ranked report of the functions of several profiles
+
+    Parameters
+    ----------
+    filenames : list of strings
+        profile files, see find_profiles
+    sort : string
+        sort key of the functions, see pstats.Stats.sort_stats
+    top : int
+        number of functions in the report
+
+    Returns
+    -------
+    report : string
+        empty without profiles
+    """
+    if not filenames:
+        return ""
+    report = StringIO()
+    stats = pstats.Stats(filenames[0], stream=report)
+    for filename in filenames[1:]:
+        stats.add(filename)
+    report.write("%d task profiles, %.1f s\n" % (len(filenames), stats.total_tt))
+    stats.strip_dirs().sort_stats(sort).print_stats(top)
+    return report.getvalue()
+
+def write_report(filenames, report_filename, sort="tottime", top=40):
+    """Merge the existing profiles among filenames in a report file, see merge
+
+    Returns
+    -------
+    n : int
+        number of profiles merged
+    """
+    filenames = [filename for filename in filenames if os.path.exists(filename)]
+    if filenames:
+        with open(report_filename, "w") as f:
+            f.write(merge(filenames, sort, top))
+        log.info("Merged %d task profiles in %s" % (len(filenames), report_filename))
+    return len(filenames)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Merge the profiles of the tasks of a run in one report of the hottest functions")
+    parser.add_argument("folder", help="output folder of the run, its profiles are searched recursively")
+    parser.add_argument("--sort", default="tottime", help="sort key, e.g. tottime, cumulative or calls, see pstats")
+    parser.add_argument("--top", type=int, default=40, help="number of functions in the report")
+    parser.add_argument("--output", help="write the report to a file instead of the standard output")
+    args = parser.parse_args()
+    report = merge(find_profiles(args.folder), args.sort, args.top)
+    if not report:
+        sys.exit("No profiles in " + args.folder)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(report)
+    else:
+        print report
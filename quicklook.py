@@ -0,0 +1,196 @@
+"""Quick-look progressive runs
+
+With `quicklook = true` in the [run] section, or `run_null.py --quicklook`,
+a run has two stages:
+
+ * quick look: every task runs at the coarse working nside `quicklook_nside`,
+   by default a quarter of the nside of [smooth_combine] but at least
+   degraded_nside, always with chi2, in the `quicklook` subfolder of the
+   output folder
+ * full resolution: the couples whose quick-look metadata exceed one of
+   `quicklook_thresholds` run again at the nside of [smooth_combine], e.g.
+   a json dict {"map_chi2*": 1.2, "map_unsm_chi2*": 1.1} of patterns of
+   metadata keys, see fnmatch, and thresholds
+
+The quick-look outputs of the couples that pass are copied to the output
+folder, so that it has the outputs of all the couples. The `_map.json` and
+`_cl.json` metadata of each output record the `stage` that produced it,
+"quicklook" or "full", and its working nside `stage_nside`; full resolution
+outputs also record the quick-look values that exceeded the thresholds in
+`quicklook_flags`.
+
+With a summary database, see summarydb.py, the quick-look outputs are
+stored under the run id of the run followed by `_quicklook`, the run id of the
+run has the outputs of the output folder. Outputs are stored again once their
+stage is recorded.
+
+Both stages run with the configured back end, or the quick-look stage with
+`quicklook_backend` if set. With `resume = true` each stage resumes from its
+own fingerprints.
+"""
+
+import os
+import copy
+import json
+import shutil
+import fnmatch
+import exceptions
+import logging as log
+
+import history
+import summarydb
+from tasks import split_task, task_outputs
+
+FOLDER = "quicklook"
+DEFAULT_THRESHOLDS = {"map_chi2*": 1.2}
+SUFFIXES = ["_map.fits", "_map.json", "_cl.fits", "_cl.json"]
+RUN_ID_SUFFIX = "_quicklook"
+
+def quicklook_nside(run):
+    """Working nside of the quick-look stage of a run"""
+    nside = run.mapreader.nside
+    degraded_nside = run.smooth_combine_config["degraded_nside"]
+    quick_nside = run.option("quicklook_nside", max(degraded_nside, nside // 4), "getint")
+    if quick_nside < degraded_nside:
+        raise exceptions.ValueError("quicklook_nside %d is lower than degraded_nside %d" % (quick_nside, degraded_nside))
+    return quick_nside
+
+def exceeded(metadata, thresholds):
+    """Metadata values above their threshold
+
+    Parameters
+    ----------
+    metadata : dict
+        map metadata, see differences.smooth_combine
+    thresholds : dict
+        threshold of the keys matching each pattern, see fnmatch
+
+    Returns
+    -------
+    flags : dict
+        keys and values of metadata above the threshold of any of their patterns
+    """
+    flags = {}
+    for key, value in metadata.items():
+        if not isinstance(value, float):
+            continue
+        for pattern, threshold in thresholds.items():
+            if fnmatch.fnmatchcase(key, pattern) and value > threshold:
+                flags[key] = value
+    return flags
+
+def read_metadata(root_folder, base_filename):
+    with open(os.path.join(root_folder, base_filename + "_map.json")) as f:
+        return json.load(f)
+
+def mark_stage(root_folder, base_filename, **fields):
+    """Add fields, e.g. stage, to the map and spectra metadata of an output"""
+    for suffix in ["_map.json", "_cl.json"]:
+        filename = os.path.join(root_folder, base_filename + suffix)
+        if not os.path.exists(filename):
+            continue
+        with open(filename) as f:
+            metadata = json.load(f)
+        metadata.update(fields)
+        with open(filename, "w") as f:
+            json.dump(metadata, f, indent=4)
+
+def record(run, base_filename):
+    """Store the map metadata of an output of run in its summary database, if any"""
+    summary_db = run.smooth_combine_config.get("summary_db")
+    if summary_db:
+        db = summarydb.SummaryDB(summary_db)
+        try:
+            db.insert(read_metadata(run.root_folder, base_filename), run.smooth_combine_config["run_id"])
+        finally:
+            db.close()
+
+def copy_outputs(source_folder, root_folder, base_filename):
+    """Copy the output files of a couple, its log and stamps excluded"""
+    try:
+        os.makedirs(os.path.dirname(os.path.join(root_folder, base_filename)))
+    except OSError:
+        pass
+    for suffix in SUFFIXES:
+        filename = os.path.join(source_folder, base_filename + suffix)
+        if os.path.exists(filename):
+            shutil.copyfile(filename, os.path.join(root_folder, base_filename + suffix))
+
+def quick_run(run, nside):
+    """Copy of run working at nside in the quicklook subfolder, always with chi2"""
+    quick = copy.copy(run)
+    quick.root_folder = os.path.join(run.root_folder, FOLDER)
+    try:
+        os.makedirs(quick.root_folder)
+    except OSError:
+        pass
+    quick.mapreader = run.make_reader(nside)
+    quick.smooth_combine_config = dict(run.smooth_combine_config, chi2=True)
+    if "summary_db" in quick.smooth_combine_config:
+        quick.smooth_combine_config["run_id"] += RUN_ID_SUFFIX
+    quick.backend = run.option("quicklook_backend", run.backend)
+    quick.history = history.History(os.path.join(quick.root_folder, history.FILENAME), nside=nside)
+    quick.task_stats = {}
+    quick._task_memory = {}
+    quick._task_timeout = {}
+    return quick
+
+def run_progressive(run):
+    """Quick-look stage, then full resolution of the flagged couples
+
+    Returns
+    -------
+    results : list of tuples
+        (task, status, error) of the quick-look tasks that failed or were
+        skipped and of the full resolution tasks, see runner.Run.execute
+    """
+    thresholds = json.loads(run.option("quicklook_thresholds", json.dumps(DEFAULT_THRESHOLDS)))
+    nside = quicklook_nside(run)
+    quick = quick_run(run, nside)
+    if run.backend == "mpi":
+        import mpibackend
+        if mpibackend.MPI.COMM_WORLD.rank != mpibackend.ROOT:
+            # the other ranks serve both stages
+            if quick.backend == "mpi":
+                quick.execute()
+            return run.execute()
+    print "QUICK LOOK at nside %d with %s back end" % (nside, quick.backend)
+    quick_results = quick.execute()
+
+    results = [(task, status, error) for task, status, error in quick_results if status in ["skipped", "failed"]]
+    rerun = []
+    passed = flagged = 0
+    for task, status, error in quick_results:
+        if status not in ["done", "up to date"]:
+            continue
+        for couple in split_task(task):
+            base_filename = task_outputs(couple)[0]
+            try:
+                metadata = read_metadata(quick.root_folder, base_filename)
+            except exceptions.IOError:
+                log.warning("Missing quick-look output " + base_filename)
+                continue
+            mark_stage(quick.root_folder, base_filename, stage="quicklook", stage_nside=nside)
+            record(quick, base_filename)
+            flags = exceeded(metadata, thresholds)
+            if flags:
+                flagged += 1
+                rerun.append((couple, base_filename, flags))
+            else:
+                passed += 1
+                copy_outputs(quick.root_folder, run.root_folder, base_filename)
+                record(run, base_filename)
+    print "QUICK LOOK: %d outputs passed, %d above the thresholds %s" % (passed, flagged, json.dumps(thresholds))
+
+    if rerun or run.backend == "mpi":
+        # MPI ranks serve until the root has dispatched the full resolution tasks
+        print "FULL RESOLUTION at nside %d" % run.mapreader.nside
+        full_results = run.execute([couple for couple, base_filename, flags in rerun])
+        done = set(task for task, status, error in full_results if status in ["done", "up to date"])
+        for couple, base_filename, flags in rerun:
+            if couple in done:
+                mark_stage(run.root_folder, base_filename, stage="full", stage_nside=run.mapreader.nside,
+                           quicklook_flags=flags)
+                record(run, base_filename)
+        results += full_results
+    return results
@@ -1,4 +1,5 @@
 from glob import glob
+from collections import OrderedDict
 from ConfigParser import SafeConfigParser
 import exceptions
 import logging as log
@@ -6,6 +7,8 @@ import os.path
 import numpy as np
 import healpy as hp
 
+import timings
+
 stokes_IQU = "IQUHABCDEF"
 stokes_I = "IHA" 
 # H for hits,
@@ -67,36 +70,35 @@ class DXReader(BaseMapReader):
         self.nside = nside
         self.debug = debug
 
+    def mask_patterns(self, freq):
+        """Filename patterns of the point source, spectra and galaxy masks"""
+        return [self.config.get("Templates", mask_type).format(frequency=freq) for mask_type in ["ps_mask", "spectra_mask", "galaxy_mask"]]
+
+    def mask_files(self, freq):
+        return [get_filename(pattern) for pattern in self.mask_patterns(freq)]
+
     def read_masks(self, freq):
         result = []
-        filenames = [get_filename(self.config.get("Templates", mask_type).format(frequency=freq)) for mask_type in ["ps_mask", "spectra_mask", "galaxy_mask"]]
+        filenames = self.mask_files(freq)
 
         for file_name in filenames:
-            result.append(np.logical_not(np.floor(hp.ud_grade(hp.read_map(file_name), self.nside)).astype(np.bool)))
+            with timings.timed("read"):
+                mask = hp.read_map(file_name)
+            with timings.timed("read_ud_grade"):
+                result.append(np.logical_not(np.floor(hp.ud_grade(mask, self.nside)).astype(np.bool)))
         return tuple(result)
 
-    def __call__(self, freq, surv, chtag='', halfring=0, pol="I", bp_corr=False):
-        """Read a map and return the array of pixels.
+    def map_patterns(self, freq, surv, chtag='', halfring=0, bp_corr=False):
+        """Filename patterns of the files read by __call__
 
-        Parameters
-        ----------
-        freq : int
-            frequency
-        surv : int or string
-            "nominal", "full", or survey number
-        chtag : string
-            can be "" for frequency, radiometer("LFI18S"), horn("LFI18"), quadruplet("18_23"), detset("detset_1")
-        halfring : int
-            0 for full, 1 and 2 for first and second halfrings
-        pol : string
-            required polarization components, e.g. 'I', 'Q', 'IQU'
+        see __call__ for the parameters
 
         Returns
         -------
-        maps : array or tuple of arrays
-            single map or tuple of maps as returned by healpy.read_map
+        patterns : list of strings
+            one pattern per map, horn maps are the average of 2 channel maps,
+            followed by the pattern of the bandpass correction map if bp_corr
         """
-
         # type of channel
         channel_type = type_of_channel_set(chtag)
 
@@ -104,17 +106,6 @@ class DXReader(BaseMapReader):
         is_survey = isinstance(surv, int)
         is_halfring = halfring != 0
 
-        # stokes component
-        stokes = stokes_IQU
-        if (channel_type in ["channel", "horn"]) or freq >= 545:
-            stokes = stokes_I
-        if isinstance(pol, str):
-            components = [stokes.index(p) for p in pol]
-            if len(components) == 1:
-                components = components[0]
-        else:
-            components = pol
-
         if channel_type in ["channel", "horn"]:
             if freq > 70:
                 freq = chtag
@@ -122,8 +113,6 @@ class DXReader(BaseMapReader):
             else:
                 chtag = chtag.translate(None, "LFI") # remove LFI from channel name
 
-        # read_map
-        output_map = []
         file_template_list = ["map", channel_type]
         if is_survey:
             file_template_list.append("survey")
@@ -145,12 +134,66 @@ class DXReader(BaseMapReader):
         if is_halfring:
             file_parameters["halfring"] = halfring
 
-        for tag in tags:
-            filename_pattern = self.config.get("Templates", file_template).format(channel=tag, **file_parameters)
+        patterns = [self.config.get("Templates", file_template).format(channel=tag, **file_parameters) for tag in tags]
+        if bp_corr:
+            bp_corr_file_template = "map_iqucorrection"
+            if is_survey:
+                bp_corr_file_template += "_survey"
+            patterns.append(self.config.get("Templates", bp_corr_file_template).format(frequency=freq, survey=surv))
+        return patterns
+
+    def input_files(self, freq, surv, chtag='', halfring=0, pol="I", bp_corr=False):
+        """Files read by __call__, without reading them, see map_patterns"""
+        return [get_filename(pattern) for pattern in self.map_patterns(freq, surv, chtag, halfring, bp_corr)]
+
+    def __call__(self, freq, surv, chtag='', halfring=0, pol="I", bp_corr=False):
+        """Read a map and return the array of pixels.
+
+        Parameters
+        ----------
+        freq : int
+            frequency
+        surv : int or string
+            "nominal", "full", or survey number
+        chtag : string
+            can be "" for frequency, radiometer("LFI18S"), horn("LFI18"), quadruplet("18_23"), detset("detset_1")
+        halfring : int
+            0 for full, 1 and 2 for first and second halfrings
+        pol : string
+            required polarization components, e.g. 'I', 'Q', 'IQU'
+
+        Returns
+        -------
+        maps : array or tuple of arrays
+            single map or tuple of maps as returned by healpy.read_map
+        """
+
+        # type of channel
+        channel_type = type_of_channel_set(chtag)
+
+        # stokes component
+        stokes = stokes_IQU
+        if (channel_type in ["channel", "horn"]) or freq >= 545:
+            stokes = stokes_I
+        if isinstance(pol, str):
+            components = [stokes.index(p) for p in pol]
+            if len(components) == 1:
+                components = components[0]
+        else:
+            components = pol
+
+        patterns = self.map_patterns(freq, surv, chtag, halfring, bp_corr)
+        if bp_corr:
+            bp_corr_filename_pattern = patterns.pop()
+
+        # read_map
+        output_map = []
+        for filename_pattern in patterns:
             filename = get_filename(filename_pattern)
             log.info("components %s" % (str(components)))
             if not self.debug:
-                output_map.append(hp.ma(hp.read_map(filename, components)))
+                with timings.timed("read"):
+                    output_map.append(hp.ma(hp.read_map(filename, components)))
             else:
                 if not os.path.exists(filename):
                     raise exceptions.ValueError("Map missing: " + filename)
@@ -158,13 +201,10 @@ class DXReader(BaseMapReader):
                     hp.ma(np.zeros((np.size(components), hp.nside2npix(1024))))
                                  )
         if bp_corr:
-            bp_corr_file_template = "map_iqucorrection"
-            if is_survey:
-                bp_corr_file_template += "_survey"
-            bp_corr_filename_pattern = self.config.get("Templates", bp_corr_file_template).format(frequency=freq, survey=surv)
             bp_corr_filename = get_filename(bp_corr_filename_pattern)
             if not self.debug:
-                corr_map = hp.ma(hp.read_map(bp_corr_filename, (0,1,2)))
+                with timings.timed("read"):
+                    corr_map = hp.ma(hp.read_map(bp_corr_filename, (0,1,2)))
             else:
                 corr_map = hp.ma([np.zeros(hp.nside2npix(1024)) for c in [0,1,2]])
             for comp, corr in zip(output_map[0], corr_map):
@@ -182,5 +222,56 @@ class DXReader(BaseMapReader):
             if pol in "ADF":
                 log.info("Downgrading a covariance matrix")
                 power = 2
-            out = hp.ud_grade(out, self.nside,power=power)
+            with timings.timed("read_ud_grade"):
+                out = hp.ud_grade(out, self.nside,power=power)
+        return out
+
+class CachedReader(BaseMapReader):
+    """Wrapper of another reader that keeps the most recently read maps in memory
+
+    Masks are always cached, maps are evicted in least recently used order.
+    Maps are shared between callers, they should not be modified in place.
+
+    Parameters
+    ----------
+    reader : BaseMapReader
+        reader used on cache misses, other attributes are forwarded to it
+    max_maps : int
+        maximum number of maps kept in memory
+    """
+
+    def __init__(self, reader, max_maps=8):
+        self.reader = reader
+        self.max_maps = max_maps
+        self.nside = getattr(reader, "nside", None)
+        self.maps = OrderedDict()
+        self.masks = {}
+        self.hits = 0
+        self.misses = 0
+
+    def __getattr__(self, name):
+        if name == "reader":
+            raise AttributeError(name)
+        return getattr(self.reader, name)
+
+    def read_masks(self, freq):
+        if freq in self.masks:
+            self.hits += 1
+        else:
+            self.misses += 1
+            self.masks[freq] = self.reader.read_masks(freq)
+        return self.masks[freq]
+
+    def __call__(self, freq, surv, chtag='', halfring=0, pol="I", bp_corr=False):
+        key = (freq, surv, chtag, halfring, pol, bp_corr)
+        if key in self.maps:
+            self.hits += 1
+            log.debug("Cache hit: %s" % str(key))
+            out = self.maps.pop(key)
+        else:
+            self.misses += 1
+            out = self.reader(freq, surv, chtag, halfring=halfring, pol=pol, bp_corr=bp_corr)
+        self.maps[key] = out
+        while len(self.maps) > self.max_maps:
+            self.maps.popitem(last=False)
         return out
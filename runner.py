@@ -0,0 +1,429 @@
+"""Execution of the null tests of a run configuration file
+
+`Run` reads a run configuration, see for example run_dx11.conf, creates the
+map reader and the list of tasks and executes them with the back end selected
+by `backend` in the [run] section:
+
+ * serial: in this process
+ * ipython: IPython.parallel load balanced view
+ * local: pool of local worker processes, see scheduler.py
+ * graph: pipeline graph, see pipeline.py
+ * mpi: MPI ranks, see mpibackend.py
+
+without `backend`, `paral = true` selects ipython and `paral = false` serial.
+"""
+
+import os
+import json
+import time
+import uuid
+import exceptions
+import multiprocessing
+import traceback
+import numpy as np
+import healpy as hp
+import logging as log
+from ConfigParser import SafeConfigParser, NoOptionError
+
+import reader
+import mapstore
+import planner
+import pipeline
+import scheduler
+import history
+import layout
+import engine
+import watchdog
+import fingerprint
+import logcollector
+import memory
+import profiling
+import telemetry
+import timings
+from tasks import build_tasks, split_task, run_task, task_reads, task_name, task_outputs
+
+def print_summary(results):
+    """Print the number of tasks by status and the errors of the failed ones"""
+    counts = {}
+    for task, status, error in results:
+        counts[status] = counts.get(status, 0) + 1
+    print "Tasks: %d up to date (skipped), %d recomputed, %d missing inputs, %d failed" % tuple(
+        counts.get(status, 0) for status in ["up to date", "done", "skipped", "failed"])
+    for task, status, error in results:
+        if status == "failed":
+            print "FAILED %s:\n%s" % (task_name(task), error)
+
+class Run(object):
+    """Null tests run defined by a run configuration file
+
+    Parameters
+    ----------
+    config_filename : string
+        path to the run configuration file
+    """
+
+    def __init__(self, config_filename):
+        self.config_filename = config_filename
+        self.config = config = SafeConfigParser()
+        config.read(config_filename)
+
+        paral = config.getboolean("run", "paral")
+        self.backend = self.option("backend", "ipython" if paral else "serial")
+        self.root_folder = config.get("run", "output_folder")
+        try:
+            os.mkdir(self.root_folder)
+        except OSError:
+            pass
+
+        self.smooth_combine_config = dict(fwhm=np.radians(config.getfloat("smooth_combine", "smoothing")), degraded_nside=config.getint("smooth_combine", "degraded_nside"), spectra=config.getboolean("smooth_combine", "spectra"), chi2=config.getboolean("smooth_combine", "chi2"))
+        if config.has_option("run", "summary_db"):
+            # store all metadata also in a SQLite database, see summarydb.py
+            self.smooth_combine_config["summary_db"] = os.path.abspath(config.get("run", "summary_db"))
+            self.smooth_combine_config["run_id"] = self.option("run_id", os.path.basename(os.path.normpath(self.root_folder)))
+
+        # MPI ranks always share maps and masks within a node
+        self.shared_store = self.option("shared_store", mapstore.DEFAULT_FOLDER if self.backend == "mpi" else None)
+        # create map reader
+        self.mapreader = self.make_reader(config.getint("smooth_combine", "nside"))
+
+        # surveydiff and chdiff exceeding memory_budget (MB) are processed out of core, see differences.pairs_of_maps
+        self.out_of_core_config = {}
+        if config.has_option("run", "memory_budget"):
+            self.out_of_core_config = dict(memory_budget=config.getfloat("run", "memory_budget"),
+                                           scratch_folder=self.option("scratch_folder", None))
+        # maps kept between reads by each worker, engine or rank, see reader.CachedReader,
+        # cached maps stay resident, with memory_budget only as many as fit in it
+        self.cache_maps = self.option("worker_cache_maps", 8, "getint")
+        if self.out_of_core_config:
+            map_bytes = 3 * hp.nside2npix(self.mapreader.nside) * planner.PIXEL_BYTES
+            self.cache_maps = min(self.cache_maps, int(self.out_of_core_config["memory_budget"] * 2**20 // map_bytes))
+
+        self.resume = self.option("resume", False, "getboolean")
+        self.tasks = build_tasks(config)
+        # wall time and peak memory of the tasks of previous runs, see history.py
+        self.history = history.History(self.option("history", os.path.join(self.root_folder, history.FILENAME)),
+                                       nside=self.mapreader.nside)
+        self.task_stats = {}
+        # memory budget of each worker or engine in MB, tasks are dispatched only when they fit
+        self.worker_memory = self.option("worker_memory", None, "getfloat")
+        self._task_memory = {}
+        self._task_timeout = {}
+        # address of the collector of the log records of the workers, see logcollector.py
+        self.log_address = None
+        # python allocations traced in every process of the run, see memory.py
+        if self.option("memory_trace", False, "getboolean"):
+            memory.start_tracing()
+        # each task under cProfile, see profiling.py
+        self.profile = self.option("profile", False, "getboolean")
+        if self.profile and self.backend == "graph":
+            log.warning("profile is ignored by the graph back end")
+        # event stream and metrics file of the run, see telemetry.py, self.events during execute
+        self.telemetry = self.option("telemetry", False, "getboolean")
+        self.events = None
+
+        # cores of a node and transform threads of each task class, e.g. {"I": 1, "IQU": 4}, see layout.py
+        self.node_cores = self.option("node_cores", None, "getint")
+        self.transform_threads = json.loads(self.option("transform_threads", "{}"))
+
+        self.split_pairs = self.option("split_pairs", False, "getboolean")
+        if self.split_pairs:
+            self.tasks = self.split_tasks(self.tasks)
+
+    def split_tasks(self, tasks):
+        """Split surveydiff and chdiff in one task per couple, see tasks.split_task
+
+        local workers keep the maps of a test in their cache, the couples are
+        ordered so that they fit, ipython engines and MPI ranks share them
+        through the node shared store, enabled in its default folder if not configured
+        """
+        if self.backend not in ["local", "ipython", "mpi"]:
+            log.warning("split_pairs is ignored by the %s back end" % self.backend)
+            return tasks
+        max_resident = None
+        if self.backend == "local":
+            maps_per_item = 2 if self.smooth_combine_config["chi2"] else 1
+            max_resident = self.cache_maps // maps_per_item
+        elif not self.shared_store:
+            self.shared_store = mapstore.DEFAULT_FOLDER
+            self.mapreader = mapstore.SharedStoreReader(self.mapreader, self.shared_store)
+            log.info("split_pairs: maps shared through the store in " + self.shared_store)
+        split = []
+        for task in tasks:
+            split += split_task(task, max_resident)
+        return split
+
+    def make_reader(self, nside):
+        """Map reader of the configuration at a working nside"""
+        mapreader = reader.DXReader(self.config.get("run", "reader_conf"), nside=nside, debug=self.config.getboolean("run", "debug"))
+        if self.shared_store:
+            # maps and masks are read once per node and shared by all processes, see mapstore.py
+            mapreader = mapstore.SharedStoreReader(mapreader, self.shared_store)
+        return mapreader
+
+    def option(self, name, default, get="get", section="run"):
+        """Optional configuration value, default if missing"""
+        if self.config.has_option(section, name):
+            return getattr(self.config, get)(section, name)
+        return default
+
+    def execute(self, tasks=None):
+        """Run tasks with the configured back end
+
+        with `resume = true` in the [run] section, tasks whose fingerprint
+        matches the one recorded at their last completion are skipped,
+        see fingerprint.py
+
+        tasks are submitted longest first according to the history of
+        previous runs, tasks never run before first, and the wall time and
+        peak memory of the completed tasks are added to the history, the
+        wall time of their stages is summarized in run_timings.txt, see timings.py,
+        and their peak memory in run_memory.txt, see memory.py
+
+        with `profile = true`, each task runs under cProfile and the profiles
+        of the tasks are merged in run_profile.txt, see profiling.py
+
+        with `log_collector = true`, the log records of the workers of the
+        local, ipython and mpi back ends go to a single file, see logcollector.py
+
+        with `telemetry = true`, the tasks queued, started and completed are
+        appended to run_events.jsonl and the totals are written periodically
+        to run_metrics.prom, see telemetry.py
+
+        Parameters
+        ----------
+        tasks : list of Task or None
+            tasks to run, by default all the tasks of the configuration
+
+        Returns
+        -------
+        results : list of tuples
+            (task, status, error), status is "up to date", "done", "skipped"
+            for missing inputs or "failed", empty on the MPI ranks other than 0
+        """
+        if self.backend == "mpi":
+            import mpibackend
+            if mpibackend.MPI.COMM_WORLD.rank != mpibackend.ROOT:
+                # rank 0 plans the run and dispatches the tasks to the other ranks
+                mpibackend.serve(self.mapreader, self.smooth_combine_config, self.root_folder,
+                                 cache_maps=self.cache_maps,
+                                 out_of_core_config=self.out_of_core_config,
+                                 profile=self.profile)
+                return []
+        if tasks is None:
+            tasks = self.tasks
+        fingerprints = {}
+        up_to_date = []
+        if self.resume:
+            to_run = []
+            for task in tasks:
+                task_fingerprint = fingerprint.task_fingerprint(task, self.mapreader, self.smooth_combine_config)
+                if fingerprint.is_up_to_date(self.root_folder, task, task_fingerprint):
+                    up_to_date.append(task)
+                else:
+                    fingerprints[task] = task_fingerprint
+                    to_run.append(task)
+            tasks = to_run
+        tasks = self.history.order(tasks)
+
+        if self.shared_store and self.backend not in ["ipython", "mpi"]:
+            # declare the consumers of each entry so that it is evicted after its last task,
+            # ipython engines and MPI ranks might run on other nodes, they declare each task
+            # they receive on the store of their node, see tasks.run_task
+            store = mapstore.SharedMapStore(self.shared_store)
+            for task in tasks:
+                for key in self.mapreader.task_keys(task_reads(task, self.smooth_combine_config["chi2"]), [task.freq]):
+                    store.incref(key)
+
+        results = [(task, "up to date", None) for task in up_to_date]
+        if self.telemetry:
+            self.events = telemetry.Telemetry(self.option("events_file", os.path.join(self.root_folder, telemetry.EVENTS_FILENAME)),
+                                              self.option("metrics_file", os.path.join(self.root_folder, telemetry.METRICS_FILENAME)),
+                                              root_folder=self.root_folder,
+                                              interval=self.option("metrics_interval", 15., "getfloat"))
+            self.events.run_started(self.backend, len(tasks) + len(up_to_date))
+            for task in tasks:
+                self.events.queued(task, planner.plan_task(task, self.mapreader, self.smooth_combine_config).get("bytes_read"))
+        collector = None
+        if self.option("log_collector", False, "getboolean") and self.backend in ["local", "ipython", "mpi"]:
+            collector = logcollector.LogCollector(self.option("log_file", os.path.join(self.root_folder, logcollector.FILENAME)))
+            self.log_address = collector.address
+        try:
+            results += getattr(self, "run_" + self.backend)(tasks, fingerprints)
+        finally:
+            if collector:
+                collector.stop()
+                self.log_address = None
+            if self.events:
+                self.events.close(results)
+                self.events = None
+            if self.shared_store and self.backend in ["serial", "local", "graph"]:
+                # entries left by failed or killed tasks, the other back ends clear the store of each node
+                mapstore.clear(self.shared_store)
+        for task, stats in self.task_stats.items():
+            self.history.update(task, stats)
+        self.history.save()
+        print_summary(results)
+        done = [task for task, status, error in results if status == "done"]
+        outputs = [(task.test_type, base_filename) for task in done for base_filename in task_outputs(task)]
+        table = timings.write_table(self.root_folder, outputs)
+        if table:
+            print table
+        memory.write_summary(self.root_folder, outputs, dict((task_name(task), self.task_stats[task]["peak_memory"])
+                                                             for task in done if task in self.task_stats))
+        if self.profile:
+            profiling.write_report([profiling.profile_filename(self.root_folder, task_name(task)) for task, status, error in results
+                                    if status in ["done", "failed"]], os.path.join(self.root_folder, profiling.REPORT_FILENAME))
+        return results
+
+    def plan_layout(self, tasks, cores=None, processes=None):
+        """Worker processes and transform threads on a node, see layout.plan_layout"""
+        return layout.plan_layout(tasks, self.mapreader.nside, cores or self.node_cores or multiprocessing.cpu_count(),
+                                  threads=self.transform_threads, processes=processes)
+
+    def run_serial(self, tasks, fingerprints):
+        results = []
+        test_type = None
+        for task in tasks:
+            if task.test_type != test_type:
+                test_type = task.test_type
+                print test_type.upper()
+            if self.events:
+                self.events.started(task)
+            start = time.time()
+            try:
+                self.task_stats[task] = run_task(task, self.mapreader, self.smooth_combine_config, self.root_folder,
+                                                 log_to_file=False, task_fingerprint=fingerprints.get(task),
+                                                 out_of_core_config=self.out_of_core_config,
+                                                 threads=self.node_cores, profile=self.profile)
+                results.append((task, "done", None))
+            except (NoOptionError, exceptions.IOError) as e:
+                log.error("SKIP TEST: " + e.message)
+                results.append((task, "skipped", e.message))
+            except exceptions.Exception:
+                log.error("FAILED TEST: " + task_name(task))
+                results.append((task, "failed", traceback.format_exc()))
+            if self.events:
+                self.events.completed(task, results[-1][1], wall_time=time.time() - start,
+                                      stats=self.task_stats.get(task), error=results[-1][2])
+        return results
+
+    def task_memory(self, task):
+        """Expected peak memory of a task in bytes, recorded in the history or
+        estimated from the reader parameters, see planner.estimate_peak_memory"""
+        if task not in self._task_memory:
+            self._task_memory[task] = self.history.peak_memory(task) or \
+                planner.estimate_peak_memory(task, self.mapreader, self.smooth_combine_config["chi2"])
+        return self._task_memory[task]
+
+    def task_timeout(self, task):
+        """Timeout of a task in seconds, None without timeouts, see watchdog.py"""
+        factor = self.option("timeout_factor", 10., "getfloat")
+        if not factor:
+            return None
+        if task not in self._task_timeout:
+            expected = self.history.wall_time(task)
+            if expected is None:
+                # never run before, e.g. a first run: planned cost, see planner.estimate_wall_time
+                plan = planner.plan_task(task, self.mapreader, self.smooth_combine_config)
+                expected = planner.estimate_wall_time(plan, self.mapreader.nside, self.option("io_rate", planner.IO_RATE, "getfloat"))
+            self._task_timeout[task] = max(self.option("timeout_min", 600., "getfloat"), factor * (expected or 0.))
+        return self._task_timeout[task]
+
+    def make_watchdog(self):
+        """Timeouts and retries of the tasks of the local and ipython back ends, see watchdog.py"""
+        return watchdog.Watchdog(self.task_timeout, retries=self.option("task_retries", 2, "getint"),
+                                 backoff=self.option("retry_backoff", 30., "getfloat"))
+
+    def run_ipython(self, tasks, fingerprints):
+        from IPython.parallel import Client
+        tc = Client()
+        run_layout = layout.running_layout(tasks, self.mapreader.nside, tc[:].apply_sync(layout.node_info),
+                                           cores=self.node_cores, threads=self.transform_threads)
+        log.info(layout.describe(run_layout))
+
+        # engines receive once the reader and configuration of the run, then task descriptors, see engine.py
+        context_id = uuid.uuid4().hex
+        tc[:].apply_sync(engine.set_context, context_id, self.mapreader, self.smooth_combine_config, self.root_folder,
+                         cache_maps=self.cache_maps, out_of_core_config=self.out_of_core_config, profile=self.profile)
+
+        def submit(view, task):
+            return view.apply_async(engine.run_descriptor, context_id, tuple(task),
+                                    task_fingerprint=fingerprints.get(task),
+                                    threads=run_layout["threads"][layout.task_class(task)],
+                                    log_collector=self.log_address)
+
+        task_watchdog = self.make_watchdog()
+        if self.worker_memory:
+            print("Run %d tasks packed in %.0f MB per engine" % (len(tasks), self.worker_memory))
+            mean_wall_time = self.history.mean_wall_time()
+            async_tasks = scheduler.submit_packed(tc, tasks, submit, self.worker_memory * 2**20, self.task_memory,
+                                                  cost=lambda task: self.history.wall_time(task, mean_wall_time),
+                                                  watchdog=task_watchdog, telemetry=self.events)
+        else:
+            lview = tc.load_balanced_view() # default load-balanced view
+            async_tasks = [submit(lview, task) for task in tasks]
+            print("Wait for %d tasks to complete" % len(async_tasks))
+            scheduler.wait_watched(tc, tasks, async_tasks, submit, task_watchdog, telemetry=self.events)
+        results = []
+        for task, async_task in zip(tasks, async_tasks):
+            if task_watchdog.gave_up(task):
+                results.append((task, "failed", task_watchdog.error(task)))
+                continue
+            status, error = scheduler.async_status(async_task)
+            if status == "done":
+                self.task_stats[task] = async_task.get()
+            results.append((task, status, error))
+        task_watchdog.print_report()
+        engines = [engine_id for engine_id in tc.ids if engine_id not in task_watchdog.hung]
+        if task_watchdog.hung:
+            log.warning("Engines %s are still running timed out tasks, restart them" % str(sorted(task_watchdog.hung)))
+        if self.shared_store and engines:
+            tc[engines].apply_sync(mapstore.clear, self.shared_store)
+        return results
+
+    def run_local(self, tasks, fingerprints):
+        run_layout = self.plan_layout(tasks, processes=self.option("processes", None, "getint"))
+        log.info(layout.describe(run_layout))
+        processes = run_layout["processes"]
+        print "Run %d tasks on %d local worker processes" % (len(tasks), min(processes, len(tasks)))
+        # memory available to all the workers in MB, by default worker_memory for each worker
+        memory_limit = self.option("memory_limit", None, "getfloat")
+        if memory_limit is None and self.worker_memory:
+            memory_limit = self.worker_memory * min(processes, len(tasks))
+        mean_wall_time = self.history.mean_wall_time()
+        return scheduler.run_local(tasks, self.mapreader, self.smooth_combine_config, self.root_folder,
+                                   processes=processes,
+                                   cache_maps=self.cache_maps,
+                                   fingerprints=fingerprints,
+                                   out_of_core_config=self.out_of_core_config,
+                                   cost=lambda task: self.history.wall_time(task, mean_wall_time),
+                                   task_memory=self.task_memory,
+                                   memory_limit=memory_limit and memory_limit * 2**20,
+                                   task_stats=self.task_stats,
+                                   task_threads=lambda task: run_layout["threads"][layout.task_class(task)],
+                                   cores=run_layout["cores"],
+                                   watchdog=self.make_watchdog(),
+                                   log_collector=self.log_address,
+                                   profile=self.profile,
+                                   telemetry=self.events)
+
+    def run_mpi(self, tasks, fingerprints):
+        import mpibackend
+        mean_wall_time = self.history.mean_wall_time()
+        return mpibackend.run_mpi(tasks, self.mapreader, self.smooth_combine_config, self.root_folder,
+                                  cache_maps=self.cache_maps,
+                                  fingerprints=fingerprints,
+                                  out_of_core_config=self.out_of_core_config,
+                                  cost=lambda task: self.history.wall_time(task, mean_wall_time),
+                                  node_cores=self.node_cores,
+                                  transform_threads=self.transform_threads,
+                                  task_stats=self.task_stats,
+                                  log_collector=self.log_address,
+                                  profile=self.profile,
+                                  telemetry=self.events)
+
+    def run_graph(self, tasks, fingerprints):
+        return pipeline.run_graph(tasks, self.mapreader, self.smooth_combine_config, self.root_folder,
+                                  executor=self.option("graph_executor", "serial"),
+                                  workers=self.option("processes", None, "getint"),
+                                  fingerprints=fingerprints)
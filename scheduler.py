@@ -0,0 +1,553 @@
+"""Local multiprocessing back end for run_null.py
+
+Tasks are executed by a pool of worker processes on the local machine, no
+external cluster is needed. Tasks reading the same maps, i.e. same frequency
+and same set of surveys, are grouped and an idle worker keeps receiving tasks
+from the group it is working on, so that its map cache, see
+reader.CachedReader, gets hits. Idle workers without a group take the
+largest group nobody else is working on.
+
+The same dispatcher submits tasks to IPython engines with submit_packed,
+so that the tasks running on a node do not exceed its memory.
+"""
+
+import time
+import socket
+import Queue
+import traceback
+import exceptions
+import multiprocessing
+from collections import OrderedDict, deque
+from ConfigParser import NoOptionError
+import logging as log
+
+from reader import CachedReader
+from tasks import run_task, task_name, is_pair_task
+
+def locality_key(task):
+    """Tasks with the same key read the same maps"""
+    if is_pair_task(task):
+        # couples of the same surveydiff or chdiff, see tasks.split_task
+        return (task.test_type, task.freq, task.chtag if task.test_type == "surveydiff" else task.surv)
+    return (task.freq, task.surv)
+
+class Dispatcher(object):
+    """Chooses the next task for an idle worker
+
+    Parameters
+    ----------
+    tasks : list of Task
+        tasks to dispatch, task ids are their indices in the list,
+        tasks of the same group are dispatched in this order
+    key : callable
+        locality key of a task, see locality_key
+    cost : callable or None
+        expected cost of a task, e.g. wall time, by default 1 for each task
+    """
+
+    def __init__(self, tasks, key=locality_key, cost=None):
+        self.cost = cost or (lambda task: 1)
+        self.key = key
+        self.groups = OrderedDict()
+        for task_id, task in enumerate(tasks):
+            self.groups.setdefault(key(task), deque()).append((task_id, task))
+        self.worker_group = {}
+
+    def __len__(self):
+        return sum(len(group) for group in self.groups.values())
+
+    def put(self, task_id, task):
+        """Dispatch again a task, e.g. to retry it, first of its group"""
+        self.groups.setdefault(self.key(task), deque()).appendleft((task_id, task))
+
+    def _first_fitting(self, key, fits):
+        for item in self.groups[key]:
+            if fits is None or fits(item[1]):
+                return item
+        return None
+
+    def next_task(self, worker, fits=None):
+        """Next task for worker, preferring the group of its previous task
+
+        Parameters
+        ----------
+        worker : int
+            worker id
+        fits : callable or None
+            fits(task) is False for tasks that cannot start now, e.g. without
+            enough free memory, by default all tasks can start
+
+        Returns
+        -------
+        task_id, task : int, Task
+            None if there are no pending tasks or none of them fits
+        """
+        key = self.worker_group.get(worker)
+        if key not in self.groups or self._first_fitting(key, fits) is None:
+            owned = set(k for w, k in self.worker_group.items() if w != worker)
+            candidates = [k for k in self.groups if self._first_fitting(k, fits) is not None]
+            if not candidates:
+                return None
+            # groups nobody is working on first, the most expensive first
+            key = max(candidates, key=lambda k: (k not in owned, sum(self.cost(task) for task_id, task in self.groups[k])))
+            self.worker_group[worker] = key
+        item = self._first_fitting(key, fits)
+        self.groups[key].remove(item)
+        if not self.groups[key]:
+            del self.groups[key]
+        return item
+
+class WorkerStats(object):
+    """Utilisation of a worker"""
+
+    def __init__(self):
+        self.tasks = 0
+        self.busy = 0.
+        self.cache_hits = 0
+        self.cache_misses = 0
+
+def _worker(worker_id, task_queue, result_queue, mapreader, smooth_combine_config, root_folder, cache_maps, out_of_core_config, log_collector, profile):
+    """Worker process main loop, runs tasks until it receives None"""
+    mapreader = CachedReader(mapreader, max_maps=cache_maps)
+    while True:
+        item = task_queue.get()
+        if item is None:
+            break
+        task_id, task, task_fingerprint, threads, acquire = item
+        start = time.time()
+        error = None
+        task_stats = None
+        try:
+            task_stats = run_task(task, mapreader, smooth_combine_config, root_folder, log_to_file=True,
+                                  task_fingerprint=task_fingerprint, out_of_core_config=out_of_core_config,
+                                  threads=threads, log_collector=log_collector, profile=profile, acquire=acquire)
+            # map cache counters of the worker so far, see telemetry.py
+            task_stats.update(cache_hits=mapreader.hits, cache_misses=mapreader.misses)
+            status = "done"
+        except (NoOptionError, exceptions.IOError) as e:
+            status = "skipped"
+            error = str(e)
+        except exceptions.Exception:
+            status = "failed"
+            error = traceback.format_exc()
+        result_queue.put(("task", worker_id, task_id, status, error, start, time.time(), task_stats))
+    result_queue.put(("stats", worker_id, mapreader.hits, mapreader.misses))
+
+def print_utilisation(stats, wall_time):
+    print "%-8s %6s %10s %12s %12s" % ("Worker", "Tasks", "Busy [s]", "Utilisation", "Cache hits")
+    for worker_id, s in sorted(stats.items()):
+        lookups = s.cache_hits + s.cache_misses
+        print "%-8d %6d %10.1f %11.1f%% %5d/%-6d" % (worker_id, s.tasks, s.busy,
+                100. * s.busy / wall_time if wall_time else 0., s.cache_hits, lookups)
+    print "Wall time: %.1f s" % wall_time
+
+def run_local(tasks, mapreader, smooth_combine_config, root_folder, processes=None, cache_maps=8, poll_interval=5., fingerprints=None, out_of_core_config=None, cost=None, task_memory=None, memory_limit=None, task_stats=None, task_threads=None, cores=None, watchdog=None, log_collector=None, profile=False, telemetry=None):
+    """Run tasks on a pool of local worker processes
+
+    Parameters
+    ----------
+    tasks : list of Task
+        tasks to run, see tasks.build_tasks
+    mapreader : BaseMapReader
+        reader, each worker wraps it in a CachedReader
+    smooth_combine_config : dict
+        configuration for smooth_combine
+    root_folder : string
+        root path of the output files
+    processes : int or None
+        number of worker processes, by default the number of cores
+    cache_maps : int
+        maximum number of maps in the cache of each worker
+    poll_interval : float
+        seconds between checks that the workers are alive
+    fingerprints : dict or None
+        fingerprint of each task, recorded when it completes, see fingerprint.py
+    out_of_core_config : dict or None
+        see tasks.run_task
+    cost : callable or None
+        expected wall time of a task, see Dispatcher
+    task_memory : callable or None
+        expected peak memory of a task in bytes, None if unknown
+    memory_limit : float or None
+        memory available to all the workers in bytes, a task is dispatched
+        only if its expected peak memory fits next to the running tasks,
+        or if no other task is running
+    task_stats : dict or None
+        filled with the stats returned by tasks.run_task for each completed task
+    task_threads : callable or None
+        number of transform threads of a task, see layout.py, by default
+        the workers keep the OpenMP default
+    cores : int or None
+        cores of the machine, a task is dispatched only if its threads fit
+        in the cores left by the running tasks, or if no other task is running
+    watchdog : watchdog.Watchdog or None
+        timeouts and retries of the tasks, a worker running a task past its
+        timeout or dying is replaced, by default tasks are not retried
+    log_collector : tuple or None
+        address of the collector of the log records of the workers, see logcollector.py
+    profile : bool
+        run each task under cProfile, see profiling.py
+    telemetry : telemetry.Telemetry or None
+        receives the start and the end of each task attempt
+
+    Returns
+    -------
+    results : list of tuples
+        (task, status, error) for each task, status is "done", "skipped" or "failed",
+        error is the exception message or traceback
+    """
+    if not tasks:
+        return []
+    fingerprints = fingerprints or {}
+    processes = min(processes or multiprocessing.cpu_count(), len(tasks))
+    dispatcher = Dispatcher(tasks, cost=cost)
+    workers = {}
+    stats = {}
+
+    def start_worker(worker_id):
+        # each worker has its own result queue: a worker killed while sending a
+        # result can leave the lock of its queue held, that queue is dropped with it
+        task_queue, result_queue = multiprocessing.Queue(), multiprocessing.Queue()
+        process = multiprocessing.Process(target=_worker, args=(worker_id, task_queue, result_queue,
+                                          mapreader, smooth_combine_config, root_folder, cache_maps,
+                                          out_of_core_config, log_collector, profile))
+        process.start()
+        workers[worker_id] = (process, task_queue, result_queue)
+        stats[worker_id] = WorkerStats()
+
+    def receive(timeout):
+        """Next message of any worker, None after timeout seconds"""
+        deadline = time.time() + timeout
+        while True:
+            for worker_id in sorted(workers):
+                try:
+                    return workers[worker_id][2].get_nowait()
+                except Queue.Empty:
+                    pass
+            if time.time() >= deadline:
+                return None
+            time.sleep(min(.05, timeout))
+
+    for worker_id in range(processes):
+        start_worker(worker_id)
+    results = [None] * len(tasks)
+    running = {}
+    started = {}
+    # the consumers of the store entries of a task are declared once, see runner.Run.execute,
+    # its retries declare themselves again since a failed attempt released them
+    dispatched = set()
+
+    def memory(task):
+        return (task_memory(task) if task_memory else None) or 0
+
+    def threads(task):
+        return task_threads(task) if task_threads else None
+
+    def fits(task):
+        if not running:
+            return True
+        if cores and task_threads and \
+                sum(threads(tasks[task_id]) for task_id in running.values()) + threads(task) > cores:
+            return False
+        if not memory_limit:
+            return True
+        return sum(memory(tasks[task_id]) for task_id in running.values()) + memory(task) <= memory_limit
+
+    def dispatch_idle():
+        if watchdog:
+            for task_id, task in watchdog.ready():
+                dispatcher.put(task_id, task)
+        for worker_id in sorted(workers):
+            if worker_id in running:
+                continue
+            worker_fits = fits
+            if watchdog:
+                # retries go to another worker if there is one
+                worker_fits = lambda task: fits(task) and not watchdog.avoid(task, worker_id, workers.keys())
+            item = dispatcher.next_task(worker_id, worker_fits)
+            if item is None:
+                continue
+            task_id, task = item
+            running[worker_id] = task_id
+            started[worker_id] = time.time()
+            workers[worker_id][1].put((task_id, task, fingerprints.get(task), threads(task), task_id in dispatched))
+            dispatched.add(task_id)
+            if telemetry:
+                telemetry.started(task, worker_id)
+
+    def task_failed(worker_id, task_id, error):
+        if watchdog:
+            if watchdog.failed(task_id, tasks[task_id], worker_id, error):
+                return
+            error = watchdog.error(tasks[task_id])
+        results[task_id] = (tasks[task_id], "failed", error)
+
+    def replace_worker(worker_id, error):
+        task_id = running.pop(worker_id)
+        del workers[worker_id]
+        if telemetry:
+            telemetry.completed(tasks[task_id], "failed", worker_id, time.time() - started[worker_id], error=error)
+        task_failed(worker_id, task_id, error)
+        if watchdog:
+            start_worker(max(stats) + 1)
+
+    def check_workers():
+        for worker_id, task_id in running.items():
+            process = workers[worker_id][0]
+            if not process.is_alive():
+                log.error("Worker %d died running %s" % (worker_id, task_name(tasks[task_id])))
+                replace_worker(worker_id, "Worker died with exit code %s" % str(process.exitcode))
+
+    run_start = time.time()
+    dispatch_idle()
+    while running or (watchdog and watchdog.delayed):
+        message = receive(poll_interval)
+        if message is not None and message[0] == "task":
+            _, worker_id, task_id, status, error, start, end, stats_of_task = message
+        else:
+            message = None
+        if message is not None and running.get(worker_id) == task_id:
+            del running[worker_id]
+            if stats_of_task is not None and task_stats is not None:
+                task_stats[tasks[task_id]] = stats_of_task
+            stats[worker_id].tasks += 1
+            stats[worker_id].busy += end - start
+            if telemetry:
+                telemetry.completed(tasks[task_id], status, worker_id, end - start, stats_of_task, error)
+            if status == "done":
+                log.info("Completed %s in %.1f s on worker %d" % (task_name(tasks[task_id]), end - start, worker_id))
+            else:
+                log.error("%s %s: %s" % (status.upper(), task_name(tasks[task_id]), error))
+            if status == "failed":
+                task_failed(worker_id, task_id, error)
+            else:
+                results[task_id] = (tasks[task_id], status, error)
+        if watchdog:
+            for worker_id, task_id in running.items():
+                if watchdog.expired(tasks[task_id], started[worker_id]):
+                    log.error("Worker %d timed out running %s, killed" % (worker_id, task_name(tasks[task_id])))
+                    error = watchdog.timeout_error(tasks[task_id], started[worker_id])
+                    workers[worker_id][0].terminate()
+                    workers[worker_id][0].join()
+                    stats[worker_id].tasks += 1
+                    stats[worker_id].busy += time.time() - started[worker_id]
+                    replace_worker(worker_id, error)
+        # checked at every message, results of the other workers do not delay it
+        check_workers()
+        dispatch_idle()
+    wall_time = time.time() - run_start
+    while len(dispatcher):
+        task_id, task = dispatcher.next_task(None)
+        results[task_id] = (task, "failed", "No worker left")
+
+    for process, task_queue, result_queue in workers.values():
+        task_queue.put(None)
+    # each worker sends its cache statistics before exiting, unless it dies
+    for worker_id, (process, task_queue, result_queue) in sorted(workers.items()):
+        while True:
+            try:
+                message = result_queue.get(timeout=poll_interval)
+            except Queue.Empty:
+                if not process.is_alive():
+                    log.warning("Worker %d exited without its cache statistics" % worker_id)
+                    break
+                continue
+            if message[0] == "stats":
+                stats[worker_id].cache_hits, stats[worker_id].cache_misses = message[2:]
+                break
+        process.join()
+
+    print_utilisation(stats, wall_time)
+    if watchdog:
+        watchdog.print_report()
+    return results
+
+def async_status(async_task):
+    """Status and error of a completed AsyncResult of tasks.run_task
+
+    Returns
+    -------
+    status : string
+        "done", "skipped" for missing inputs or "failed"
+    error : string or None
+        traceback of the remote exception
+    """
+    try:
+        async_task.get()
+        return "done", None
+    except exceptions.Exception as e:
+        # RemoteError has the name and traceback of the remote exception
+        ename = getattr(e, "ename", type(e).__name__)
+        status = "skipped" if ename in ["IOError", "NoOptionError"] else "failed"
+        return status, getattr(e, "traceback", None) or str(e)
+
+def wait_watched(client, tasks, async_tasks, submit, watchdog, poll_interval=1., telemetry=None):
+    """Wait for tasks submitted to IPython engines, retrying failed and timed out ones
+
+    the timeout of a task starts when an engine starts it, an engine
+    running a task past its timeout is left out of the run, see
+    watchdog.Watchdog.hung. Retries are submitted to a load balanced view of
+    the other engines, async_tasks is updated with their AsyncResult.
+
+    Parameters
+    ----------
+    client : IPython.parallel.Client
+        client of the cluster
+    tasks : list of Task
+        submitted tasks
+    async_tasks : list of AsyncResult
+        AsyncResult of each task
+    submit : callable
+        submit(view, task) submits task to a view, returning an AsyncResult
+    watchdog : watchdog.Watchdog
+        timeouts and retries
+    poll_interval : float
+        seconds between checks of the running tasks
+    telemetry : telemetry.Telemetry or None
+        receives the start and the end of each task attempt
+    """
+    engines = list(client.ids)
+    started = {}
+    pending = set(range(len(tasks)))
+    while pending or watchdog.delayed:
+        for task_id, task in watchdog.ready():
+            targets = [e for e in engines if not watchdog.avoid(task, e, engines)]
+            if not targets:
+                watchdog.abandon(task, "No engine left")
+                continue
+            async_tasks[task_id] = submit(client.load_balanced_view(targets=targets), task)
+            pending.add(task_id)
+        for task_id in sorted(pending):
+            task, async_task = tasks[task_id], async_tasks[task_id]
+            engine_id = async_task.metadata.get("engine_id")
+            if async_task.ready():
+                pending.remove(task_id)
+                start = started.pop(task_id, None)
+                status, error = async_status(async_task)
+                if telemetry:
+                    telemetry.completed(task, status, engine_id, start and time.time() - start,
+                                        async_task.get() if status == "done" else None, error)
+                if status == "failed":
+                    watchdog.failed(task_id, task, engine_id, error)
+                continue
+            if async_task.metadata.get("started") and task_id not in started:
+                started[task_id] = time.time()
+                if telemetry:
+                    telemetry.started(task, engine_id)
+            if task_id in started and watchdog.expired(task, started[task_id]):
+                log.error("Engine %s timed out running %s, left out of the run" % (str(engine_id), task_name(task)))
+                watchdog.hung.add(engine_id)
+                if engine_id in engines:
+                    engines.remove(engine_id)
+                pending.remove(task_id)
+                error = watchdog.timeout_error(task, started[task_id])
+                if telemetry:
+                    telemetry.completed(task, "failed", engine_id, time.time() - started[task_id], error=error)
+                watchdog.failed(task_id, task, engine_id, error)
+                del started[task_id]
+        time.sleep(poll_interval)
+
+def submit_packed(client, tasks, submit, worker_memory, task_memory, cost=None, poll_interval=1., watchdog=None, telemetry=None):
+    """Submit tasks to IPython engines without exceeding the memory of their nodes
+
+    each engine has a memory budget of worker_memory, a node can run tasks
+    whose expected peak memory adds up to the budgets of its engines. A task
+    is submitted to an idle engine only if it fits in the free memory of its
+    node, a node without running tasks accepts any task.
+
+    Parameters
+    ----------
+    client : IPython.parallel.Client
+        client of the cluster, engines are grouped by hostname
+    tasks : list of Task
+        tasks in order of submission
+    submit : callable
+        submit(view, task) submits task to the direct view of an engine,
+        returning an AsyncResult
+    worker_memory : float
+        memory budget of each engine in bytes
+    task_memory : callable
+        expected peak memory of a task in bytes, None if unknown, e.g. planner.estimate_peak_memory
+    cost : callable or None
+        expected wall time of a task, see Dispatcher
+    poll_interval : float
+        seconds between checks of the running tasks
+    watchdog : watchdog.Watchdog or None
+        timeouts and retries of the tasks, an engine running a task past its
+        timeout is left out of the run, see wait_watched
+    telemetry : telemetry.Telemetry or None
+        receives the start and the end of each task attempt
+
+    Returns
+    -------
+    async_tasks : list of AsyncResult
+        one for each task, the last attempt of retried tasks, all completed
+        except those that timed out, see watchdog.Watchdog.gave_up
+    """
+    engine_ids = list(client.ids)
+    hosts = client[engine_ids].apply_sync(socket.gethostname)
+    node = dict(zip(engine_ids, hosts))
+    capacity = {}
+    for engine_id in engine_ids:
+        capacity[node[engine_id]] = capacity.get(node[engine_id], 0) + worker_memory
+    log.info("Memory packing: %s" % ", ".join("%s %d engines %.0f MB" % (host, hosts.count(host), capacity[host] / 2.**20) for host in sorted(capacity)))
+
+    def memory(task):
+        return task_memory(task) or 0
+
+    dispatcher = Dispatcher(tasks, cost=cost)
+    async_tasks = [None] * len(tasks)
+    running = {}
+    started = {}
+    while len(dispatcher) or running or (watchdog and watchdog.delayed):
+        if watchdog:
+            for task_id, task in watchdog.ready():
+                dispatcher.put(task_id, task)
+        for engine_id in engine_ids:
+            if engine_id in running:
+                continue
+            host = node[engine_id]
+            used = [m for e, (task_id, m) in running.items() if node[e] == host]
+            fits = lambda task: (not used or sum(used) + memory(task) <= capacity[host]) and \
+                not (watchdog and watchdog.avoid(task, engine_id, engine_ids))
+            item = dispatcher.next_task(engine_id, fits)
+            if item is None:
+                continue
+            task_id, task = item
+            if memory(task) > capacity[host]:
+                log.warning("%s needs %.0f MB, more than the %.0f MB of %s" % (task_name(task), memory(task) / 2.**20, capacity[host] / 2.**20, host))
+            async_tasks[task_id] = submit(client[engine_id], task)
+            running[engine_id] = (task_id, memory(task))
+            started[engine_id] = time.time()
+            if telemetry:
+                telemetry.started(task, engine_id)
+        completed = [engine_id for engine_id, (task_id, m) in running.items() if async_tasks[task_id].ready()]
+        for engine_id in completed:
+            task_id, m = running.pop(engine_id)
+            status, error = async_status(async_tasks[task_id])
+            if telemetry:
+                telemetry.completed(tasks[task_id], status, engine_id, time.time() - started[engine_id],
+                                    async_tasks[task_id].get() if status == "done" else None, error)
+            if watchdog and status == "failed":
+                watchdog.failed(task_id, tasks[task_id], engine_id, error)
+        if watchdog:
+            for engine_id, (task_id, m) in running.items():
+                if watchdog.expired(tasks[task_id], started[engine_id]):
+                    log.error("Engine %d timed out running %s, left out of the run" % (engine_id, task_name(tasks[task_id])))
+                    del running[engine_id]
+                    engine_ids.remove(engine_id)
+                    watchdog.hung.add(engine_id)
+                    error = watchdog.timeout_error(tasks[task_id], started[engine_id])
+                    if telemetry:
+                        telemetry.completed(tasks[task_id], "failed", engine_id, time.time() - started[engine_id], error=error)
+                    watchdog.failed(task_id, tasks[task_id], engine_id, error)
+            if not engine_ids:
+                for task_id, task in watchdog.ready(now=float("inf")):
+                    dispatcher.put(task_id, task)
+                while len(dispatcher):
+                    task_id, task = dispatcher.next_task(None)
+                    watchdog.abandon(task, "No engine left")
+                break
+        if not completed:
+            time.sleep(poll_interval)
+    return async_tasks
@@ -0,0 +1,229 @@
+"""Interactive null tests session
+
+    from plancknull.session import NullTestSession
+    session = NullTestSession.from_config("run_dx11.conf")
+    result = session.halfrings(70, "LFI18", "full", pol="IQU")
+    result.map, result.cl, result.metadata
+    for result in session.surveydiff(30, "", [1, 2, 3], fwhm=np.radians(5)):
+        result.write("out/")
+
+Unlike the functions of differences.py, the methods of a session return the
+outputs of smooth_combine as NullTestResult objects and write files only when
+asked. Maps and masks are read once through a CachedReader, the alms of the
+maps being smoothed are kept by an AlmCache, so changing the smoothing only
+costs the inverse transforms, and a call already made with the same
+parameters returns the same result.
+"""
+
+import os
+import hashlib
+import itertools
+from collections import OrderedDict
+import numpy as np
+import healpy as hp
+
+import differences
+from reader import CachedReader
+
+class AlmCache(object):
+    """Smoothing that keeps the alms of the most recently smoothed maps
+
+    Parameters
+    ----------
+    max_alms : int
+        maximum number of maps, or IQU triplets, whose alms are kept
+    """
+
+    def __init__(self, max_alms=32):
+        self.max_alms = max_alms
+        self.alms = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def key(self, maps):
+        """Digest of the pixels of maps, masked pixels included as UNSEEN"""
+        digest = hashlib.md5()
+        for m in (maps if isinstance(maps, list) else [maps]):
+            digest.update(np.ascontiguousarray(np.ma.filled(m, hp.UNSEEN)).view(np.uint8))
+        return digest.hexdigest()
+
+    def map2alm(self, maps):
+        key = self.key(maps)
+        if key in self.alms:
+            self.hits += 1
+            alms = self.alms.pop(key)
+        else:
+            self.misses += 1
+            alms = hp.map2alm(maps)
+        self.alms[key] = alms
+        while len(self.alms) > self.max_alms:
+            self.alms.popitem(last=False)
+        return alms
+
+    def smoothing(self, maps, fwhm):
+        """Same as hp.smoothing(maps, fwhm=fwhm), a single map in a list is smoothed as a map"""
+        if isinstance(maps, list) and len(maps) == 1:
+            maps = maps[0]
+        # as hp.smoothing, masked pixels are UNSEEN in the input and in the output
+        return_ma = isinstance(maps[0] if isinstance(maps, list) else maps, np.ma.MaskedArray)
+        if isinstance(maps, list):
+            maps = [np.ma.filled(m, hp.UNSEEN) for m in maps]
+        else:
+            maps = np.ma.filled(maps, hp.UNSEEN)
+        masks = hp.mask_bad(maps)
+        smoothed_alms = hp.smoothalm(self.map2alm(maps), fwhm=fwhm, inplace=False, verbose=False)
+        smoothed = hp.alm2map(smoothed_alms, hp.get_nside(maps), pixwin=False, verbose=False)
+        smoothed[masks] = hp.UNSEEN
+        return hp.ma(smoothed) if return_ma else smoothed
+
+class NullTestResult(object):
+    """Outputs of a null test, see differences.smooth_combine_maps
+
+    Attributes
+    ----------
+    base_filename : string
+        path of the output files relative to a root folder, without suffix
+    map : array or list of arrays
+        smoothed and degraded I map or IQU maps
+    cl : array or None
+        angular power spectra, None without spectra
+    metadata : dict
+        metadata of the map, as in the `_map.json` files
+    """
+
+    def __init__(self, base_filename, outputs):
+        self.base_filename = base_filename
+        self.outputs = outputs
+        self.map = outputs["map"]
+        self.cl = outputs["cl"]
+        self.metadata = outputs["metadata"]
+
+    def __repr__(self):
+        return "<NullTestResult %s>" % self.base_filename
+
+    def write(self, root_folder, summary_db=None, run_id=""):
+        """Write the same files as smooth_combine under root_folder"""
+        try:
+            os.makedirs(os.path.dirname(os.path.join(root_folder, self.base_filename)))
+        except OSError:
+            pass
+        differences.write_outputs(self.outputs, self.base_filename, root_folder, summary_db=summary_db, run_id=run_id)
+
+class NullTestSession(object):
+    """Null tests sharing maps, masks, alms and results
+
+    Parameters
+    ----------
+    mapreader : BaseMapReader
+        reader, wrapped in a CachedReader
+    fwhm, degraded_nside, spectra, chi2 : see differences.smooth_combine
+        defaults of the null tests, each method accepts them as keyword arguments
+    max_maps : int
+        maximum number of maps in the cache
+    max_alms : int
+        maximum number of alms in the cache, see AlmCache
+    """
+
+    def __init__(self, mapreader, fwhm=np.radians(2.0), degraded_nside=32, spectra=True, chi2=False, max_maps=32, max_alms=32):
+        self.mapreader = CachedReader(mapreader, max_maps=max_maps)
+        self.smooth_combine_config = dict(fwhm=fwhm, degraded_nside=degraded_nside, spectra=spectra, chi2=chi2)
+        self.alm_cache = AlmCache(max_alms)
+        self.results = {}
+
+    @classmethod
+    def from_config(cls, config_filename, **kwargs):
+        """Session with the reader and smooth_combine configuration of a run configuration file"""
+        from runner import Run
+        run = Run(config_filename)
+        config = dict((k, v) for k, v in run.smooth_combine_config.items() if k in ["fwhm", "degraded_nside", "spectra", "chi2"])
+        config.update(kwargs)
+        return cls(run.mapreader, **config)
+
+    def combine(self, terms, freq, base_filename="combination", metadata=None, **config):
+        """Null test of a custom combination of maps
+
+        Parameters
+        ----------
+        terms : list of tuples
+            (read, weight), read is a dict of the arguments of the reader,
+            surv and optionally chtag, halfring, pol, bp_corr, e.g.
+            [(dict(surv=1, chtag="LFI18M"), 1), (dict(surv=2, chtag="LFI18M"), -1)],
+            variance maps are combined with the weights squared
+        freq : int
+            frequency of the maps and of the masks
+        base_filename : string
+            base filename of the outputs, see NullTestResult.write
+        metadata : dict or None
+            initial metadata, with at least file_type
+        config : keyword arguments
+            overrides of the smooth_combine configuration of the session
+
+        Returns
+        -------
+        result : NullTestResult
+        """
+        config = dict(self.smooth_combine_config, **config)
+        key = (freq, tuple((tuple(sorted(read.items())), weight) for read, weight in terms),
+               base_filename, tuple(sorted(config.items())))
+        if key in self.results:
+            return self.results[key]
+
+        reads = [dict(dict(chtag="", halfring=0, pol="I", bp_corr=False), **read) for read, weight in terms]
+        maps_and_weights = [(self.mapreader(freq, **read), weight) for read, (r, weight) in zip(reads, terms)]
+        variance_maps_and_weights = None
+        if config.pop("chi2"):
+            # for I only read sigma_II, else read sigma_II, sigma_QQ, sigma_UU
+            variance_maps_and_weights = [(self.mapreader(freq, read["surv"], read["chtag"], halfring=read["halfring"],
+                                                         pol='A' if len(read["pol"]) == 1 else 'ADF', bp_corr=False), weight**2)
+                                         for read, (r, weight) in zip(reads, terms)]
+        ps_mask, union_mask, galaxy_mask = self.mapreader.read_masks(freq)
+        outputs = differences.smooth_combine_maps(maps_and_weights, variance_maps_and_weights,
+                                                  smooth_mask=ps_mask, spectra_mask=union_mask, galaxy_mask=galaxy_mask,
+                                                  base_filename=base_filename,
+                                                  metadata=dict(metadata or dict(file_type="combination", title=base_filename)),
+                                                  smoothing=self.alm_cache.smoothing, **config)
+        self.results[key] = NullTestResult(base_filename, outputs)
+        return self.results[key]
+
+    def halfrings(self, freq, chtag, surv, pol="I", **config):
+        """Half ring difference, see differences.halfrings"""
+        base_filename, metadata = differences.halfrings_output(freq, chtag, surv)
+        return self.combine([(dict(surv=surv, chtag=chtag, halfring=1, pol=pol), 1),
+                             (dict(surv=surv, chtag=chtag, halfring=2, pol=pol), -1)],
+                            freq, base_filename, metadata, **config)
+
+    def surveydiff(self, freq, chtag, survlist, pol="I", bp_corr=False, **config):
+        """Survey differences of all the couples of survlist, see differences.surveydiff
+
+        Returns
+        -------
+        results : list of NullTestResult
+        """
+        results = []
+        for couple in itertools.combinations(survlist, 2):
+            comb, base_filename, metadata = differences.surveydiff_output(freq, chtag, couple, bp_corr)
+            results.append(self.combine([(dict(surv=comb[0], chtag=chtag, pol=pol, bp_corr=bp_corr), 1),
+                                         (dict(surv=comb[1], chtag=chtag, pol=pol, bp_corr=bp_corr), -1)],
+                                        freq, base_filename, metadata, **config))
+        return results
+
+    def chdiff(self, freq, chlist, surv, pol="I", **config):
+        """Channel differences of all the couples of chlist, see differences.chdiff
+
+        Returns
+        -------
+        results : list of NullTestResult
+        """
+        results = []
+        for couple in itertools.combinations(chlist, 2):
+            base_filename, metadata = differences.chdiff_output(freq, couple, surv)
+            results.append(self.combine([(dict(surv=surv, chtag=couple[0], pol=pol), 1),
+                                         (dict(surv=surv, chtag=couple[1], pol=pol), -1)],
+                                        freq, base_filename, metadata, **config))
+        return results
+
+    def stats(self):
+        """Hits and misses of the map and alm caches and number of results"""
+        return dict(map_hits=self.mapreader.hits, map_misses=self.mapreader.misses,
+                    alm_hits=self.alm_cache.hits, alm_misses=self.alm_cache.misses,
+                    results=len(self.results))
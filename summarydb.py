@@ -0,0 +1,210 @@
+"""SQLite database of null tests metadata
+
+Every metadata dictionary written by `differences.smooth_combine` to a
+`*_map.json` file can also be stored in an indexed SQLite table, one row
+per Stokes component, so that report generators can build summary tables
+with a single query instead of opening thousands of json files.
+
+Usage:
+    python summarydb.py database.sqlite run_id output_folder
+
+imports all the `*_map.json` files of an existing run.
+"""
+
+import os
+import sys
+import json
+import sqlite3
+from glob import glob
+import logging as log
+
+# statistics stored as columns, the other metadata are kept in the json blob
+STATISTICS = ["map_chi2", "map_unsm_chi2", "map_chi2_galmask", "map_p2p", "map_std"]
+KEYS = ["run_id", "test_type", "channel", "surveys", "component"]
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS nulltests (
+    run_id TEXT NOT NULL,
+    test_type TEXT NOT NULL,
+    channel_set TEXT,
+    channel TEXT NOT NULL,
+    surveys TEXT NOT NULL,
+    component TEXT NOT NULL,
+    base_file_name TEXT NOT NULL,
+    %s,
+    metadata TEXT,
+    UNIQUE (run_id, base_file_name, component)
+);
+CREATE INDEX IF NOT EXISTS nulltests_keys ON nulltests (run_id, test_type, channel, surveys, component);
+CREATE INDEX IF NOT EXISTS nulltests_test_type ON nulltests (test_type, run_id);
+""" % ",\n    ".join("%s REAL" % stat for stat in STATISTICS)
+
+def join_tag(tag):
+    """Channel or survey tag as a string, lists are joined with -"""
+    if isinstance(tag, (list, tuple)):
+        return "-".join(str(t) for t in tag)
+    return str(tag)
+
+def rows_from_metadata(metadata, run_id):
+    """Split a map metadata dictionary in one row per component
+
+    Parameters
+    ----------
+    metadata : dict
+        metadata as written to the `*_map.json` files by smooth_combine
+    run_id : string
+        identifier of the run, e.g. "dx11"
+
+    Returns
+    -------
+    rows : list of dict
+        one dictionary per component with the KEYS and STATISTICS columns
+    """
+    base_file_name = metadata["base_file_name"]
+    test_type = base_file_name.split("/")[0]
+    channel_set = metadata.get("file_type", "").replace("_map", "")
+    surveys = metadata.get("surveys", metadata.get("survey", ""))
+    components = [comp for comp in "IQU" if "map_std_%s" % comp in metadata]
+    blob = json.dumps(metadata)
+    rows = []
+    for comp in components:
+        row = dict(run_id=run_id, test_type=test_type, channel_set=channel_set,
+                   channel=join_tag(metadata["channel"]), surveys=join_tag(surveys),
+                   component=comp, base_file_name=base_file_name, metadata=blob)
+        for stat in STATISTICS:
+            # I only maps have the chi2 statistics without component suffix
+            value = metadata.get("%s_%s" % (stat, comp), metadata.get(stat) if len(components) == 1 else None)
+            row[stat] = None if value is None else float(value)
+        rows.append(row)
+    return rows
+
+class SummaryDB(object):
+    """Indexed SQLite table of null tests metadata
+
+    Parameters
+    ----------
+    filename : string
+        path to the SQLite database, created if missing
+    timeout : float
+        seconds to wait for the lock held by other processes writing
+        to the same database, e.g. parallel engines
+    """
+
+    def __init__(self, filename, timeout=120.):
+        self.filename = filename
+        self.conn = sqlite3.connect(filename, timeout=timeout)
+        self.conn.row_factory = sqlite3.Row
+        self.conn.executescript(SCHEMA)
+
+    def close(self):
+        self.conn.close()
+
+    def insert(self, metadata, run_id=""):
+        """Insert or replace the rows of a `*_map.json` metadata dictionary"""
+        rows = rows_from_metadata(metadata, run_id)
+        columns = ["run_id", "test_type", "channel_set", "channel", "surveys", "component", "base_file_name"] + STATISTICS + ["metadata"]
+        with self.conn:
+            self.conn.executemany("INSERT OR REPLACE INTO nulltests (%s) VALUES (%s)" % (", ".join(columns), ", ".join("?" * len(columns))),
+                                  [[row[c] for c in columns] for row in rows])
+        log.debug("Summary db: stored %d rows for %s" % (len(rows), metadata["base_file_name"]))
+
+    def import_folder(self, root_folder, run_id=""):
+        """Import all the `*_map.json` files of an output folder
+
+        Returns
+        -------
+        n : int
+            number of imported json files
+        """
+        filenames = sorted(glob(os.path.join(root_folder, "*", "*_map.json")))
+        for filename in filenames:
+            with open(filename) as f:
+                self.insert(json.load(f), run_id)
+        return len(filenames)
+
+    def query(self, **keys):
+        """Select rows matching the given keys
+
+        Parameters
+        ----------
+        run_id, test_type, channel, surveys, component : string or list
+            values of the keys to match, lists select any of the values,
+            channel and surveys lists, e.g. ("LFI18M", "LFI18S"), are joined with -
+
+        Returns
+        -------
+        rows : list of dict
+            rows ordered by run_id, test_type, channel, surveys, component,
+            the full metadata dictionary is in the "metadata" field
+        """
+        conditions = []
+        values = []
+        for key, value in keys.items():
+            if key not in KEYS + ["channel_set"]:
+                raise ValueError("Unknown key " + key)
+            if isinstance(value, list):
+                conditions.append("%s IN (%s)" % (key, ", ".join("?" * len(value))))
+                values += [join_tag(v) for v in value]
+            else:
+                conditions.append("%s = ?" % key)
+                values.append(join_tag(value))
+        sql = "SELECT * FROM nulltests"
+        if conditions:
+            sql += " WHERE " + " AND ".join(conditions)
+        sql += " ORDER BY " + ", ".join(KEYS)
+        rows = []
+        for row in self.conn.execute(sql, values):
+            row = dict(zip(row.keys(), row))
+            row["metadata"] = json.loads(row["metadata"])
+            rows.append(row)
+        return rows
+
+    def chi2_table(self, run_id, test_type, statistic="map_chi2", **keys):
+        """Summary table of a statistic, one row per test, one column per component
+
+        Returns
+        -------
+        table : list of tuples
+            (channel, surveys, base_file_name, {component: value})
+            in the same order as the query
+        """
+        if statistic not in STATISTICS:
+            raise ValueError("Unknown statistic " + statistic)
+        sql = "SELECT channel, surveys, base_file_name, component, %s FROM nulltests WHERE run_id = ? AND test_type = ?" % statistic
+        values = [run_id, test_type]
+        for key, value in keys.items():
+            if key not in KEYS:
+                raise ValueError("Unknown key " + key)
+            sql += " AND %s = ?" % key
+            values.append(join_tag(value))
+        sql += " ORDER BY channel, surveys, base_file_name, component"
+        table = []
+        for channel, surveys, base_file_name, comp, value in self.conn.execute(sql, values):
+            if not table or table[-1][2] != base_file_name:
+                table.append((channel, surveys, base_file_name, {}))
+            table[-1][3][comp] = value
+        return table
+
+    def compare_runs(self, run_ids, test_type, statistic="map_chi2"):
+        """Compare a statistic across runs, e.g. DX10 and DX11
+
+        Returns
+        -------
+        comparison : dict
+            {(channel, surveys, component): {run_id: value}}
+        """
+        if statistic not in STATISTICS:
+            raise ValueError("Unknown statistic " + statistic)
+        sql = "SELECT run_id, channel, surveys, component, %s FROM nulltests WHERE test_type = ? AND run_id IN (%s)" % (statistic, ", ".join("?" * len(run_ids)))
+        comparison = {}
+        for run_id, channel, surveys, comp, value in self.conn.execute(sql, [test_type] + list(run_ids)):
+            comparison.setdefault((channel, surveys, comp), {})[run_id] = value
+        return comparison
+
+if __name__ == "__main__":
+    if len(sys.argv) < 4:
+        print "Launch script as: python summarydb.py database.sqlite run_id output_folder"
+        sys.exit(1)
+    db = SummaryDB(sys.argv[1])
+    print "Imported %d files" % db.import_folder(sys.argv[3], sys.argv[2])
+    db.close()
@@ -0,0 +1,252 @@
+"""Synthetic DX release to run and benchmark the null tests without the real maps
+
+write_release writes white noise maps with their covariance in the layout
+of the templates of read_dx11.conf, at any nside, and a reader configuration
+pointing to them:
+
+ * frequency maps of the full mission, the nominal mission and each survey,
+   and the halfrings of the full and nominal missions, IQU
+ * radiometer maps of the full and nominal missions and of each survey, I
+ * quadruplet maps at 70 GHz, same as the frequency maps
+ * point source, spectra (union) and galaxy masks of each frequency
+
+IQU maps have the 10 columns "IQUHABCDEF" of reader.stokes_IQU and I maps the
+3 columns "IHA" of reader.stokes_I: the hits H follow a smooth scanning
+pattern, the variances are sigma**2 / H and the maps are white noise drawn
+from them, independent in each file, so that the chi2 of every null map is
+about 1.
+
+    python synthetic.py /tmp/dx --nside 64 --freq 30 70
+
+writes the release in /tmp/dx and its reader configuration /tmp/dx/read_synthetic.conf,
+make_run_config writes a run configuration for it, see benchmark.py.
+"""
+
+import os
+import json
+import tempfile
+import argparse
+import numpy as np
+import healpy as hp
+import logging as log
+
+import utils
+from tasks import SURVS
+
+READER_CONF = "read_synthetic.conf"
+RUN_CONF = "run_synthetic.conf"
+QUADRUPLETS = {70: ["18_23", "19_22", "20_21"]}
+# white noise per hit in K_CMB and mean hits per pixel of a full mission map
+SIGMA = {30: 2.5e-3, 44: 3.2e-3, 70: 4.e-3}
+FULL_HITS = 1000.
+# fraction of the full mission hits in each map
+NOMINAL_FRACTION = .6
+
+TEMPLATES = """[Templates]
+base_dir = {base_dir}
+
+map_frequency = %(base_dir)s/LFI_SkyMap_{{frequency:03d}}_????_*_{{survey}}.fits
+map_frequency_halfring = %(base_dir)s/RingHalf/LFI_SkyMap_{{frequency:03d}}_*_{{survey}}_ringhalf_{{halfring}}.fits
+map_frequency_survey = %(base_dir)s/Surveys/LFI_SkyMap_{{frequency:03d}}_*_survey_{{survey}}.fits
+map_channel = %(base_dir)s/Single_Radiometer/LFI_SkyMap_{{frequency:03d}}-{{channel}}_*_{{survey}}.fits
+map_channel_survey = %(base_dir)s/Single_Radiometer/LFI_SkyMap_{{frequency:03d}}-{{channel}}_*_survey_{{survey}}.fits
+
+map_detset = %(base_dir)s/Couple_horn/LFI_SkyMap_{{frequency:03d}}-{{channel}}_*_{{survey}}.fits
+map_detset_halfring = %(base_dir)s/Couple_horn_HalfRing/LFI_SkyMap_{{frequency:03d}}-{{channel}}_*_{{survey}}_ringhalf_{{halfring}}.fits
+map_detset_survey = %(base_dir)s/Couple_horn_Surveys/LFI_SkyMap_{{frequency:03d}}-{{channel}}_*_survey_{{survey}}.fits
+
+ps_mask = %(base_dir)s/MASKs/mask_ps_{{frequency}}GHz_*.fits
+spectra_mask = %(base_dir)s/MASKs/union_mask_{{frequency}}.fits
+galaxy_mask = %(base_dir)s/MASKs/mask_madam_{{frequency}}GHz.fits
+"""
+
+def hits_map(nside, hits):
+    """Hits of a map, higher close to the ecliptic poles as for the Planck scanning
+
+    Parameters
+    ----------
+    nside : int
+        HEALPix nside
+    hits : float
+        mean hits per pixel
+    """
+    theta, phi = hp.pix2ang(nside, np.arange(hp.nside2npix(nside)))
+    pattern = 1. / np.maximum(np.sin(theta), .2)
+    return hits * pattern / pattern.mean()
+
+def noise_map(nside, hits, sigma, pol, rng):
+    """White noise map with its hits and covariance
+
+    Parameters
+    ----------
+    nside : int
+        HEALPix nside
+    hits : float
+        mean hits per pixel, see hits_map
+    sigma : float
+        white noise per hit
+    pol : bool
+        IQU map with the 6 components of the covariance, else I with its variance
+    rng : numpy.random.RandomState
+        random generator
+
+    Returns
+    -------
+    columns : list of arrays
+        columns "IQUHABCDEF" if pol else "IHA", see reader.stokes_IQU
+    """
+    h = hits_map(nside, hits)
+    var_I = sigma**2 / h
+    I = rng.standard_normal(len(h)) * np.sqrt(var_I)
+    if not pol:
+        return [I, h, var_I]
+    # polarized detectors sample Q and U with half of the hits
+    var_P = 2 * var_I
+    Q, U = [rng.standard_normal(len(h)) * np.sqrt(var_P) for i in range(2)]
+    zeros = np.zeros_like(h)
+    return [I, Q, U, h, var_I, zeros, zeros, var_P, zeros, var_P]
+
+def masks(nside, freq, rng, n_sources=50):
+    """Point source, galaxy and union masks, 1 for the pixels to keep
+
+    the galactic plane is masked within 10 + freq / 10 degrees and each
+    point source within a disc of 2 degrees
+    """
+    theta, phi = hp.pix2ang(nside, np.arange(hp.nside2npix(nside)))
+    galaxy_mask = (np.abs(np.pi / 2 - theta) > np.radians(10 + freq / 10.)).astype(np.float64)
+    ps_mask = np.ones_like(galaxy_mask)
+    for vec in rng.standard_normal((n_sources, 3)):
+        ps_mask[hp.query_disc(nside, vec / np.linalg.norm(vec), np.radians(2.))] = 0
+    return ps_mask, galaxy_mask * ps_mask, galaxy_mask
+
+def write_map(filename, columns):
+    try:
+        os.makedirs(os.path.dirname(filename))
+    except OSError:
+        pass
+    hp.write_map(filename, columns)
+    return filename
+
+def write_release(base_dir, nside=64, freqs=[30, 44, 70], survs=SURVS, seed=0):
+    """Write a synthetic release and its reader configuration
+
+    Parameters
+    ----------
+    base_dir : string
+        output folder, created if missing
+    nside : int
+        nside of the maps
+    freqs : list of ints
+        LFI frequencies
+    survs : list of ints
+        surveys, the full and nominal missions are always written
+    seed : int
+        seed of the noise, the same parameters give the same release
+
+    Returns
+    -------
+    reader_conf : string
+        path of the reader configuration, see reader.DXReader
+    """
+    rng = np.random.RandomState(seed)
+    tag = "%04d_SYNTH" % nside
+    n_files = 0
+    for freq in freqs:
+        sigma = SIGMA[freq]
+        mission_hits = [("full", FULL_HITS), ("nominal", FULL_HITS * NOMINAL_FRACTION)]
+        survey_hits = [(surv, FULL_HITS / len(SURVS)) for surv in survs]
+        # frequency maps
+        for surv, hits in mission_hits:
+            write_map(os.path.join(base_dir, "LFI_SkyMap_%03d_%s_%s.fits" % (freq, tag, surv)), noise_map(nside, hits, sigma, True, rng))
+            for halfring in [1, 2]:
+                write_map(os.path.join(base_dir, "RingHalf", "LFI_SkyMap_%03d_%s_%s_ringhalf_%d.fits" % (freq, tag, surv, halfring)),
+                          noise_map(nside, hits / 2, sigma, True, rng))
+        for surv, hits in survey_hits:
+            write_map(os.path.join(base_dir, "Surveys", "LFI_SkyMap_%03d_%s_survey_%d.fits" % (freq, tag, surv)), noise_map(nside, hits, sigma, True, rng))
+        n_files += 2 * 3 + len(survs)
+        # radiometers, each with its share of the hits
+        channels = utils.chlist(freq)
+        for channel in channels:
+            prefix = os.path.join(base_dir, "Single_Radiometer", "LFI_SkyMap_%03d-%s_%s_" % (freq, channel.translate(None, "LFI"), tag))
+            for surv, hits in mission_hits:
+                write_map(prefix + "%s.fits" % surv, noise_map(nside, hits / len(channels), sigma, False, rng))
+            for surv, hits in survey_hits:
+                write_map(prefix + "survey_%d.fits" % surv, noise_map(nside, hits / len(channels), sigma, False, rng))
+            n_files += 2 + len(survs)
+        # quadruplets, 4 of the radiometers
+        for quadruplet in QUADRUPLETS.get(freq, []):
+            share = 4. / len(channels)
+            name = "LFI_SkyMap_%03d-%s_%s_" % (freq, quadruplet, tag)
+            for surv, hits in mission_hits:
+                write_map(os.path.join(base_dir, "Couple_horn", name + "%s.fits" % surv), noise_map(nside, hits * share, sigma, True, rng))
+                for halfring in [1, 2]:
+                    write_map(os.path.join(base_dir, "Couple_horn_HalfRing", name + "%s_ringhalf_%d.fits" % (surv, halfring)),
+                              noise_map(nside, hits * share / 2, sigma, True, rng))
+            for surv, hits in survey_hits:
+                write_map(os.path.join(base_dir, "Couple_horn_Surveys", name + "survey_%d.fits" % surv), noise_map(nside, hits * share, sigma, True, rng))
+            n_files += 2 * 3 + len(survs)
+        ps_mask, union_mask, galaxy_mask = masks(nside, freq, rng)
+        write_map(os.path.join(base_dir, "MASKs", "mask_ps_%dGHz_SYNTH.fits" % freq), ps_mask)
+        write_map(os.path.join(base_dir, "MASKs", "union_mask_%d.fits" % freq), union_mask)
+        write_map(os.path.join(base_dir, "MASKs", "mask_madam_%dGHz.fits" % freq), galaxy_mask)
+        n_files += 3
+    reader_conf = os.path.join(base_dir, READER_CONF)
+    with open(reader_conf, "w") as f:
+        f.write(TEMPLATES.format(base_dir=os.path.abspath(base_dir)))
+    log.info("Wrote %d maps at nside %d in %s" % (n_files, nside, base_dir))
+    return reader_conf
+
+def make_release(nside=64, freqs=[30, 44, 70], survs=SURVS, seed=0, base_dir=None):
+    """write_release in a new temporary folder, the caller removes it
+
+    Returns
+    -------
+    reader_conf : string
+        path of the reader configuration, in the folder of the release
+    """
+    return write_release(base_dir or tempfile.mkdtemp(prefix="plancknull_dx_"), nside, freqs, survs, seed)
+
+def make_run_config(reader_conf, output_folder, nside, freqs=[30, 44, 70], degraded_nside=None, smoothing=10.,
+                    halfrings=True, surveydiff=True, chdiff=False, options={}):
+    """Write a run configuration for a synthetic release, next to its reader configuration
+
+    Parameters
+    ----------
+    reader_conf : string
+        see write_release
+    output_folder : string
+        output folder of the run
+    nside : int
+        nside of the run, the maps are downgraded if lower than the nside of the release
+    degraded_nside : int or None
+        by default nside / 4
+    smoothing : float
+        smoothing fwhm in degrees
+    options : dict
+        other options of the [run] section, e.g. dict(backend="local")
+
+    Returns
+    -------
+    run_conf : string
+        path of the run configuration
+    """
+    run_options = dict(debug="false", paral="false", frequency=json.dumps(list(freqs)), reader_conf=reader_conf,
+                       output_folder=output_folder, run_halfrings=str(halfrings).lower(),
+                       run_surveydiff=str(surveydiff).lower(), run_chdiff=str(chdiff).lower())
+    run_options.update(options)
+    lines = ["[smooth_combine]", "nside = %d" % nside, "smoothing = %g" % smoothing,
+             "degraded_nside = %d" % (degraded_nside or max(1, nside // 4)), "spectra = true", "chi2 = true", "[run]"]
+    lines += ["%s = %s" % item for item in sorted(run_options.items())]
+    run_conf = os.path.join(os.path.dirname(reader_conf), RUN_CONF)
+    with open(run_conf, "w") as f:
+        f.write("\n".join(lines) + "\n")
+    return run_conf
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Write a synthetic DX release of white noise maps and masks")
+    parser.add_argument("folder", help="output folder of the release")
+    parser.add_argument("--nside", type=int, default=64, help="nside of the maps")
+    parser.add_argument("--freq", type=int, nargs="+", default=[30, 44, 70], help="LFI frequencies")
+    parser.add_argument("--seed", type=int, default=0, help="seed of the noise")
+    args = parser.parse_args()
+    print write_release(args.folder, args.nside, args.freq, seed=args.seed)
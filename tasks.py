@@ -0,0 +1,249 @@
+"""Null tests task descriptors
+
+A task is a single call to one of the null tests functions of differences.py,
+run_null.py builds the list of tasks from the configuration file and then
+executes them either serially or in parallel.
+"""
+
+import json
+import itertools
+from collections import namedtuple
+
+import differences
+import fingerprint
+import history
+import layout
+import logcollector
+import memory
+import profiling
+import timings
+import utils
+
+SURVS = [1,2,3,4,5,6,7,8]
+
+# chtag is a tuple of channels and surv a single survey for chdiff,
+# surv is a tuple of surveys for surveydiff
+Task = namedtuple("Task", ["test_type", "freq", "chtag", "surv", "pol", "bp_corr"])
+
+def is_pair_task(task):
+    """Whether task is a single couple of surveys or channels, see split_task"""
+    if task.test_type == "surveydiff":
+        return len(task.surv) == 2
+    if task.test_type == "chdiff":
+        return len(task.chtag) == 2
+    return False
+
+def task_name(task):
+    """Name of the task, same as the base filename of its log file"""
+    if is_pair_task(task):
+        return task_outputs(task)[0]
+    if task.test_type == "chdiff":
+        return "chdiff/%d_SS%s" % (task.freq, str(task.surv))
+    chtag = task.chtag or str(task.freq)
+    if task.test_type == "surveydiff":
+        name = "surveydiff/%s_SSdiff" % chtag
+        if task.bp_corr:
+            name += "_bpcorr"
+        return name
+    return "halfrings/%s_SS%s" % (chtag, str(task.surv))
+
+def build_tasks(config):
+    """List of tasks from the [run] section of a run configuration
+
+    Parameters
+    ----------
+    config : SafeConfigParser
+        run configuration, see for example run_dx11.conf
+
+    Returns
+    -------
+    tasks : list of Task
+        halfrings, surveydiff and chdiff tasks in this order
+    """
+    freqs = json.loads(config.get("run", "frequency"))
+    tasks = []
+
+    if config.getboolean("run", "run_halfrings"):
+        halfrings_survs = ["full"]
+        for freq in freqs:
+            chtags = [""]
+            pol = "IQU"
+            if freq == 70:
+                chtags += ["18_23", "19_22", "20_21"]
+            if freq >= 545:
+                pol = "I"
+            for chtag in chtags:
+                for surv in halfrings_survs:
+                    tasks.append(Task("halfrings", freq, chtag, surv, pol, False))
+
+    if config.getboolean("run", "run_surveydiff"):
+        for bp_corr in [False]:
+            for freq in freqs:
+                chtags = [""]
+                if freq == 70:
+                    chtags += ["18_23", "19_22", "20_21"]
+                chtags += utils.chlist(freq)
+                for chtag in chtags:
+                    if bp_corr and chtag: # no corr for single ch
+                        continue
+                    if (freq >= 545) or (chtag and chtag.find("_") < 0):
+                        pol='I'
+                    else:
+                        pol="IQU"
+                    tasks.append(Task("surveydiff", freq, chtag, tuple(SURVS), pol, bp_corr))
+
+    if config.getboolean("run", "run_chdiff"):
+        for freq in freqs:
+            for surv in SURVS:
+                tasks.append(Task("chdiff", freq, tuple("LFI%d" % h for h in utils.HORNS[freq]), surv, 'I', False))
+
+    return tasks
+
+def split_task(task, max_resident=None):
+    """Split a surveydiff or chdiff task in one task per couple
+
+    the couples of a task read the same maps, they should run on workers
+    sharing a map cache, see reader.CachedReader and mapstore.SharedStoreReader
+
+    Parameters
+    ----------
+    task : Task
+        halfrings tasks are not split
+    max_resident : int or None
+        number of surveys or channels whose maps fit in the cache of a worker,
+        if given the couples are ordered by differences.blocked_pairs
+
+    Returns
+    -------
+    tasks : list of Task
+        the couples have the same fields of task except surv for surveydiff
+        and chtag for chdiff, that are couples of surveys or channels
+    """
+    if task.test_type == "surveydiff":
+        field, items = "surv", task.surv
+    elif task.test_type == "chdiff":
+        field, items = "chtag", task.chtag
+    else:
+        return [task]
+    if max_resident:
+        couples = differences.blocked_pairs(list(items), max_resident)
+    else:
+        couples = itertools.combinations(items, 2)
+    return [task._replace(**{field: couple}) for couple in couples]
+
+def task_reads(task, chi2):
+    """Reader calls performed by a task
+
+    Returns
+    -------
+    reads : list of tuples
+        (freq, surv, chtag, halfring, pol, bp_corr) arguments of each call to the map reader,
+        masks are not included, each task reads the masks of task.freq
+    """
+    var_pol = 'A' if len(task.pol) == 1 else 'ADF'
+    reads = []
+    if task.test_type == "halfrings":
+        reads += [(task.freq, task.surv, task.chtag, halfring, task.pol, False) for halfring in [1, 2]]
+        if chi2:
+            reads += [(task.freq, task.surv, task.chtag, halfring, var_pol, False) for halfring in [1, 2]]
+    elif task.test_type == "surveydiff":
+        reads += [(task.freq, surv, task.chtag, 0, task.pol, task.bp_corr) for surv in task.surv]
+        if chi2:
+            reads += [(task.freq, surv, task.chtag, 0, var_pol, False) for surv in task.surv]
+    elif task.test_type == "chdiff":
+        reads += [(task.freq, task.surv, ch, 0, task.pol, False) for ch in task.chtag]
+        if chi2:
+            reads += [(task.freq, task.surv, ch, 0, var_pol, False) for ch in task.chtag]
+    return reads
+
+def task_couples(task):
+    """Output couples of a task
+
+    Returns
+    -------
+    couples : list of tuples
+        (base_filename, metadata, read1, read2) with reads as (surv, chtag, halfring)
+    """
+    couples = []
+    if task.test_type == "halfrings":
+        base_filename, metadata = differences.halfrings_output(task.freq, task.chtag, task.surv)
+        couples.append((base_filename, metadata, (task.surv, task.chtag, 1), (task.surv, task.chtag, 2)))
+    elif task.test_type == "surveydiff":
+        for comb in itertools.combinations(task.surv, 2):
+            comb, base_filename, metadata = differences.surveydiff_output(task.freq, task.chtag, comb, task.bp_corr)
+            couples.append((base_filename, metadata, (comb[0], task.chtag, 0), (comb[1], task.chtag, 0)))
+    elif task.test_type == "chdiff":
+        for comb in itertools.combinations(task.chtag, 2):
+            base_filename, metadata = differences.chdiff_output(task.freq, comb, task.surv)
+            couples.append((base_filename, metadata, (task.surv, comb[0], 0), (task.surv, comb[1], 0)))
+    return couples
+
+def task_outputs(task):
+    """Base filenames of the outputs of a task, relative to root_folder"""
+    return [couple[0] for couple in task_couples(task)]
+
+def run_task(task, mapreader, smooth_combine_config, root_folder, log_to_file=False, task_fingerprint=None, out_of_core_config=None, threads=None, log_collector=None, profile=False, acquire=False):
+    """Execute a task calling the corresponding function of differences.py
+
+    if mapreader reads through a shared store, see mapstore.py, the store
+    entries read by the task are released when it completes, with acquire the
+    task also declares itself a consumer of them when it starts, on the back
+    ends whose dispatch side does not share the store of the node, ipython and mpi.
+    if task_fingerprint is given, it is recorded when the task completes,
+    see fingerprint.py
+    out_of_core_config, e.g. {"memory_budget": 4000}, are the memory_budget and
+    scratch_folder arguments of surveydiff and chdiff, see differences.pairs_of_maps
+    threads, if given, is the number of OpenMP threads of the transforms, see layout.py
+    log_collector, if given, is the address of a log collector receiving the
+    records of the task instead of its log file, see logcollector.py
+    with profile, the task runs under cProfile, see profiling.py
+
+    Returns
+    -------
+    stats : dict
+        wall_time in seconds and peak_memory in bytes of the task, see history.TaskMonitor
+    """
+    out_of_core_config = out_of_core_config or {}
+    if threads:
+        layout.set_threads(threads)
+    if log_collector:
+        logcollector.start_task(log_collector, task_name(task))
+        log_to_file = False
+    # stages of a previous task that failed, see timings.py
+    timings.reset()
+    monitor = history.TaskMonitor()
+    store_keys = None
+    if hasattr(mapreader, "release"):
+        store_keys = mapreader.task_keys(task_reads(task, smooth_combine_config["chi2"]), [task.freq])
+        if acquire:
+            mapreader.acquire(store_keys)
+    try:
+        with profiling.TaskProfile(profile and profiling.profile_filename(root_folder, task_name(task))):
+            if task.test_type == "halfrings":
+                differences.halfrings(task.freq, task.chtag, task.surv, pol=task.pol,
+                                      smooth_combine_config=smooth_combine_config,
+                                      root_folder=root_folder, log_to_file=log_to_file,
+                                      mapreader=mapreader)
+            elif task.test_type == "surveydiff":
+                differences.surveydiff(task.freq, task.chtag, list(task.surv), pol=task.pol,
+                                       smooth_combine_config=smooth_combine_config,
+                                       root_folder=root_folder, log_to_file=log_to_file,
+                                       bp_corr=task.bp_corr, mapreader=mapreader,
+                                       **out_of_core_config)
+            elif task.test_type == "chdiff":
+                differences.chdiff(task.freq, list(task.chtag), task.surv, pol=task.pol,
+                                   smooth_combine_config=smooth_combine_config,
+                                   root_folder=root_folder, log_to_file=log_to_file,
+                                   mapreader=mapreader, **out_of_core_config)
+            else:
+                raise ValueError("Unknown test type " + task.test_type)
+        if task_fingerprint:
+            fingerprint.write_stamp(root_folder, task, task_fingerprint)
+        return monitor.stats()
+    finally:
+        if store_keys:
+            mapreader.release(store_keys)
+        # tracemalloc snapshot with memory_trace, see memory.py
+        memory.dump_snapshot(root_folder, task_name(task))
+        if log_collector:
+            logcollector.end_task()
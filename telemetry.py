@@ -0,0 +1,198 @@
+"""Machine readable telemetry of a run
+
+With `telemetry = true` in the [run] section, or `run_null.py --telemetry`,
+the runner appends one json line per event to `events_file`, by default
+run_events.jsonl in the output folder:
+
+ * queued: a task is submitted, with the bytes of its input files
+ * started: a worker starts a task
+ * finished, skipped or failed: a task attempt ends, with its wall time,
+   peak memory, the seconds of each stage of its outputs, see timings.py,
+   and the map cache hits and misses of its worker so far
+ * run_started, run_finished: with the number of tasks by status
+
+e.g.
+
+    {"t": 1400000000.1, "event": "finished", "task": "halfrings/30_SSfull", "worker": 2, "wall_time": 35.2, ...}
+
+Every `metrics_interval` seconds (default 15) and at the end of the run the
+totals are written in the Prometheus text format to `metrics_file`, by
+default run_metrics.prom in the output folder, e.g. for the textfile
+collector of the node exporter: tasks by status, running tasks, bytes read,
+cache hits and misses, seconds of each stage and the time of the last
+event, to spot stalls.
+
+Events are emitted by the process that dispatches the tasks, the ipython
+client or MPI rank 0, as the back ends see them: the local and mpi back
+ends start a task when they dispatch it, ipython when the engine reports it
+started, the graph back end only reports the outcome of the tasks at the
+end of the run.
+"""
+
+import os
+import json
+import time
+import threading
+import exceptions
+import logging as log
+
+from tasks import task_name, task_outputs
+
+EVENTS_FILENAME = "run_events.jsonl"
+METRICS_FILENAME = "run_metrics.prom"
+PREFIX = "plancknull_"
+STATUS_EVENTS = {"done": "finished", "skipped": "skipped", "failed": "failed", "up to date": "up_to_date"}
+
+def stage_seconds(root_folder, task):
+    """Seconds of each stage of the outputs of a task, see timings.py"""
+    seconds = {}
+    for base_filename in task_outputs(task):
+        try:
+            with open(os.path.join(root_folder, base_filename + "_map.json")) as f:
+                output_timings = json.load(f).get("timings") or {}
+        except (exceptions.IOError, exceptions.ValueError):
+            continue
+        for stage, value in output_timings.items():
+            seconds[stage] = seconds.get(stage, 0.) + value
+    return dict((stage, round(value, 4)) for stage, value in seconds.items())
+
+class Telemetry(object):
+    """Event stream and metrics file of a run
+
+    Parameters
+    ----------
+    events_filename : string
+        json lines file, events are appended
+    metrics_filename : string or None
+        Prometheus text file, rewritten every interval seconds by a thread
+    root_folder : string or None
+        root path of the output files, to read the stage timings of the tasks
+    interval : float
+        seconds between writes of the metrics file
+    """
+
+    def __init__(self, events_filename, metrics_filename=None, root_folder=None, interval=15.):
+        self.events = open(events_filename, "a")
+        self.metrics_filename = metrics_filename
+        self.root_folder = root_folder
+        self.lock = threading.Lock()
+        self.start_time = self.last_event = time.time()
+        self.counts = dict((event, 0) for event in ["queued", "started", "finished", "skipped", "failed", "up_to_date"])
+        self.running = set()
+        self.reported = set()
+        self.bytes_read = 0
+        self.task_bytes = {}
+        self.stage_seconds = {}
+        # cumulative cache hits and misses of each worker
+        self.cache = {}
+        self.stop = threading.Event()
+        self.thread = None
+        if metrics_filename:
+            self.thread = threading.Thread(target=self.write_periodically, args=(interval,))
+            self.thread.daemon = True
+            self.thread.start()
+
+    def event(self, event, **fields):
+        """Append an event to the stream"""
+        with self.lock:
+            self.last_event = time.time()
+            fields.update(t=round(self.last_event, 3), event=event)
+            self.events.write(json.dumps(fields, sort_keys=True) + "\n")
+            self.events.flush()
+
+    def run_started(self, backend, n_tasks):
+        self.event("run_started", backend=backend, tasks=n_tasks, pid=os.getpid())
+
+    def queued(self, task, bytes_read=None):
+        """A task is submitted, bytes_read are the bytes of its input files, see planner.plan_task"""
+        self.counts["queued"] += 1
+        self.task_bytes[task] = bytes_read or 0
+        self.event("queued", task=task_name(task), test_type=task.test_type, bytes=bytes_read)
+
+    def started(self, task, worker=None):
+        self.counts["started"] += 1
+        self.running.add(task)
+        self.event("started", task=task_name(task), worker=worker)
+
+    def completed(self, task, status, worker=None, wall_time=None, stats=None, error=None):
+        """A task attempt ended, status is "done", "skipped", "failed" or "up to date"
+
+        Parameters
+        ----------
+        stats : dict or None
+            see tasks.run_task, with the cache_hits and cache_misses of the worker
+        error : string or None
+            error or traceback, only its last line is in the event
+        """
+        event = STATUS_EVENTS[status]
+        self.counts[event] += 1
+        self.running.discard(task)
+        self.reported.add(task)
+        fields = dict(task=task_name(task), worker=worker, wall_time=wall_time)
+        stats = stats or {}
+        if "peak_memory" in stats:
+            fields["peak_memory"] = stats["peak_memory"]
+        if "cache_hits" in stats:
+            self.cache[worker] = (stats["cache_hits"], stats["cache_misses"])
+            fields.update(cache_hits=stats["cache_hits"], cache_misses=stats["cache_misses"])
+        if status == "done":
+            self.bytes_read += self.task_bytes.get(task, 0)
+            if self.root_folder:
+                fields["stages"] = stage_seconds(self.root_folder, task)
+                for stage, seconds in fields["stages"].items():
+                    self.stage_seconds[stage] = self.stage_seconds.get(stage, 0.) + seconds
+        if error:
+            fields["error"] = error.strip().splitlines()[-1]
+        self.event(event, **fields)
+
+    def metrics(self):
+        """Text of the metrics in the Prometheus exposition format"""
+        with self.lock:
+            lines = ["# TYPE %stasks_total counter" % PREFIX]
+            lines += ['%stasks_total{status="%s"} %d' % (PREFIX, event, n) for event, n in sorted(self.counts.items())]
+            lines += ["# TYPE %stasks_running gauge" % PREFIX, "%stasks_running %d" % (PREFIX, len(self.running)),
+                      "# TYPE %sbytes_read_total counter" % PREFIX, "%sbytes_read_total %d" % (PREFIX, self.bytes_read),
+                      "# TYPE %scache_hits_total counter" % PREFIX,
+                      "%scache_hits_total %d" % (PREFIX, sum(hits for hits, misses in self.cache.values())),
+                      "# TYPE %scache_misses_total counter" % PREFIX,
+                      "%scache_misses_total %d" % (PREFIX, sum(misses for hits, misses in self.cache.values())),
+                      "# TYPE %sstage_seconds_total counter" % PREFIX]
+            lines += ['%sstage_seconds_total{stage="%s"} %.3f' % (PREFIX, stage, seconds) for stage, seconds in sorted(self.stage_seconds.items())]
+            lines += ["# TYPE %srun_start_timestamp_seconds gauge" % PREFIX, "%srun_start_timestamp_seconds %.3f" % (PREFIX, self.start_time),
+                      "# TYPE %slast_event_timestamp_seconds gauge" % PREFIX, "%slast_event_timestamp_seconds %.3f" % (PREFIX, self.last_event)]
+        return "\n".join(lines) + "\n"
+
+    def write_metrics(self):
+        """Write the metrics file atomically, so that a scraper never reads half of it"""
+        tmp_filename = "%s.tmp%d" % (self.metrics_filename, os.getpid())
+        with open(tmp_filename, "w") as f:
+            f.write(self.metrics())
+        os.rename(tmp_filename, self.metrics_filename)
+
+    def write_periodically(self, interval):
+        while not self.stop.wait(interval):
+            try:
+                self.write_metrics()
+            except exceptions.Exception:
+                log.exception("Cannot write the metrics file " + self.metrics_filename)
+
+    def close(self, results=()):
+        """End of the run, results are reported if they were not yet, e.g. by the graph back end
+
+        Parameters
+        ----------
+        results : list of tuples
+            (task, status, error) of all the tasks, see runner.Run.execute
+        """
+        counts = {}
+        for task, status, error in results:
+            if task not in self.reported:
+                self.completed(task, status, error=error)
+            counts[status] = counts.get(status, 0) + 1
+        self.event("run_finished", wall_time=time.time() - self.start_time, **dict((STATUS_EVENTS[s], n) for s, n in counts.items()))
+        self.stop.set()
+        if self.thread:
+            self.thread.join()
+        if self.metrics_filename:
+            self.write_metrics()
+        self.events.close()
@@ -0,0 +1,18 @@
+import sys
+sys.path.append("../../")
+from plancknull import benchmark
+
+def test_compare(tmpdir):
+
+    filename = str(tmpdir.join(benchmark.FILENAME))
+    assert benchmark.compare(benchmark.load(filename)) == "No benchmark records"
+    benchmark.record([dict(benchmark="read_map", nside=32, best=2., mean=2.5, repeat=3)], filename, label="base")
+    benchmark.record([dict(benchmark="read_map", nside=32, best=1., mean=1.5, repeat=3),
+                      dict(benchmark="run_null", nside=32, best=10., mean=10., repeat=1)], filename)
+
+    records = benchmark.load(filename)
+    assert [entry["label"] for entry in records] == ["base", None]
+    table = benchmark.compare(records, "base")
+    assert "0.50" in table.splitlines()[2]
+    assert table.splitlines()[3].split()[2] == "-"
+    assert benchmark.compare(records, "missing") == "No baseline record to compare with"
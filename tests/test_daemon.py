@@ -0,0 +1,94 @@
+import os
+import stat
+import threading
+import pytest
+from multiprocessing import AuthenticationError
+
+import sys
+sys.path.append("../../")
+from plancknull.daemon import NullTestDaemon, DaemonClient, key_filename, private_folder
+from plancknull import synthetic
+
+RUN_CONF = """[smooth_combine]
+nside = 16
+smoothing = 10
+degraded_nside = 8
+spectra = true
+chi2 = false
+[run]
+debug = false
+paral = false
+frequency = [30]
+reader_conf = %s
+output_folder = %s
+run_halfrings = true
+run_surveydiff = false
+run_chdiff = false
+"""
+
+def start_daemon(tmpdir, reader_conf):
+    config_filename = tmpdir.join("run.conf")
+    config_filename.write(RUN_CONF % (reader_conf, tmpdir.join("out")))
+    address = str(tmpdir.join("daemon.sock"))
+    server = threading.Thread(target=NullTestDaemon(str(config_filename), address).serve)
+    server.start()
+    for i in range(50):
+        if tmpdir.join("daemon.sock").check():
+            break
+        server.join(0.1)
+    return server, DaemonClient(address)
+
+def test_daemon(tmpdir):
+
+    reader_conf = tmpdir.join("read.conf")
+    reader_conf.write("[Templates]\nps_mask = %s/mask_ps_{frequency}.fits\n" % tmpdir)
+    server, client = start_daemon(tmpdir, reader_conf)
+    try:
+        # the failure is reported to the client, the daemon keeps serving
+        with pytest.raises(RuntimeError) as error:
+            client.halfrings(30, "", "full")
+        assert "spectra_mask" in str(error.value)
+        assert client.stats()["requests"] == 2
+    finally:
+        client.shutdown()
+        server.join()
+    assert not tmpdir.join("daemon.sock").check()
+    assert not tmpdir.join("daemon.sock.key").check()
+
+def test_daemon_requests(tmpdir):
+
+    reader_conf = synthetic.write_release(str(tmpdir.join("release")), nside=16, freqs=[30], survs=[1, 2])
+    server, client = start_daemon(tmpdir, reader_conf)
+    try:
+        # socket and key are private to the owner, clients without the key are rejected
+        for filename in [client.address, key_filename(client.address)]:
+            assert stat.S_IMODE(os.stat(filename).st_mode) & 0077 == 0
+        with pytest.raises(AuthenticationError):
+            DaemonClient(client.address, authkey="wrong key").stats()
+
+        result = client.halfrings(30, "", "full", pol="IQU", arrays=True)
+        assert not result["cached"]
+        assert result["outputs"] == [str(tmpdir.join("out", "halfrings", "30_SSfull"))]
+        assert result["metadata"][0]["channel"] == "30"
+        assert len(result["maps"][0]) == 3
+
+        # the same request is served from the existing outputs
+        repeated = client.halfrings(30, "", "full", pol="IQU")
+        assert repeated["cached"]
+        assert repeated["metadata"] == result["metadata"]
+        stats = client.stats()
+        assert stats["served"] == 1
+        # read once: the 2 halfrings and the masks
+        assert stats["cache_misses"] == 3
+    finally:
+        client.shutdown()
+        server.join()
+
+def test_private_folder(tmpdir):
+
+    folder = tmpdir.join("private")
+    private_folder(str(folder))
+    assert stat.S_IMODE(folder.stat().mode) == 0700
+    folder.chmod(0755)
+    with pytest.raises(OSError):
+        private_folder(str(folder))
@@ -0,0 +1,58 @@
+import pickle
+import pytest
+
+import sys
+sys.path.append("../../")
+from plancknull.tasks import Task
+from plancknull.reader import CachedReader
+from plancknull.runner import Run
+from plancknull import engine
+
+RUN_CONF = """[smooth_combine]
+nside = 16
+smoothing = 10
+degraded_nside = 8
+spectra = true
+chi2 = false
+[run]
+debug = false
+paral = true
+frequency = [30]
+reader_conf = %s
+output_folder = %s
+run_halfrings = true
+run_surveydiff = false
+run_chdiff = false
+"""
+
+def test_engine_context(tmpdir):
+
+    reader_conf = tmpdir.join("read.conf")
+    reader_conf.write("[Templates]\nmap_frequency = %s/map_{frequency:03d}_{survey}.fits\n" % tmpdir)
+    config_filename = str(tmpdir.join("run.conf"))
+    with open(config_filename, "w") as f:
+        f.write(RUN_CONF % (reader_conf, tmpdir.join("out")))
+    run = Run(config_filename)
+
+    # the context is pickled to the engines once per run
+    args = pickle.loads(pickle.dumps(("run1", run.mapreader, run.smooth_combine_config, run.root_folder), 2))
+    engine.set_context(*args, cache_maps=run.cache_maps, out_of_core_config=run.out_of_core_config, profile=run.profile)
+    context = engine.get_context("run1")
+    engine.set_context(*args)
+    assert engine.get_context("run1") is context
+    # maps and masks are cached between tasks
+    assert isinstance(context.mapreader, CachedReader)
+    assert context.mapreader.nside == 16
+    assert context.mapreader.max_maps == run.cache_maps
+    assert context.root_folder == str(tmpdir.join("out"))
+    assert context.smooth_combine_config == run.smooth_combine_config
+
+    task = Task("halfrings", 30, "", "full", "IQU", False)
+    # the payload is the descriptor, not the reader with its configuration
+    assert len(pickle.dumps(("run1", tuple(task)), 2)) < len(pickle.dumps(context.mapreader.reader, 2)) / 2
+
+    # a new run replaces the context, e.g. a quick-look stage at another nside
+    engine.set_context("run2", run.make_reader(8), run.smooth_combine_config, run.root_folder)
+    assert engine.get_context("run2").mapreader.nside == 8
+    with pytest.raises(RuntimeError):
+        engine.run_descriptor("run1", tuple(task))
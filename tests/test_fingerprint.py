@@ -0,0 +1,66 @@
+import os
+import json
+
+import sys
+sys.path.append("../../")
+from plancknull import runner, fingerprint, synthetic
+from plancknull.runner import Run
+
+def test_resume(tmpdir, monkeypatch):
+
+    reader_conf = synthetic.write_release(str(tmpdir.join("release")), nside=8, freqs=[30], survs=[1, 2])
+    root_folder = str(tmpdir.join("out"))
+    run_conf = synthetic.make_run_config(reader_conf, root_folder, 8, freqs=[30], surveydiff=False,
+                                         options=dict(backend="serial", resume="true"))
+    # chi2 is not supported by recent healpy versions
+    with open(run_conf) as f:
+        conf = f.read().replace("chi2 = true", "chi2 = false")
+    with open(run_conf, "w") as f:
+        f.write(conf)
+
+    executed = []
+    run_task = runner.run_task
+    def counting_run_task(task, *args, **kwargs):
+        executed.append(task)
+        return run_task(task, *args, **kwargs)
+    monkeypatch.setattr(runner, "run_task", counting_run_task)
+
+    def resume(expected_status):
+        del executed[:]
+        results = Run(run_conf).execute()
+        assert [status for task, status, error in results] == [expected_status]
+        assert len(executed) == (expected_status == "done")
+        return results[0][0]
+
+    # the stamp is written when the task completes
+    task = resume("done")
+    filename = fingerprint.stamp_filename(root_folder, task)
+    with open(filename) as f:
+        stamp = json.load(f)
+    assert stamp["outputs"] == ["halfrings/30_SSfull"]
+    run = Run(run_conf)
+    assert stamp["fingerprint"] == fingerprint.task_fingerprint(task, run.mapreader, run.smooth_combine_config)
+
+    # up to date tasks are not executed
+    resume("up to date")
+
+    # changed input file
+    input_file = os.path.join(os.path.dirname(reader_conf), "RingHalf", "LFI_SkyMap_030_0008_SYNTH_full_ringhalf_1.fits")
+    os.utime(input_file, (os.path.getatime(input_file), os.path.getmtime(input_file) + 10))
+    resume("done")
+    resume("up to date")
+
+    # changed configuration
+    with open(run_conf, "w") as f:
+        f.write(conf.replace("smoothing = 10", "smoothing = 5"))
+    resume("done")
+    resume("up to date")
+
+    # changed code
+    monkeypatch.setattr(fingerprint, "code_hash", lambda: "changed")
+    resume("done")
+    resume("up to date")
+
+    # missing outputs
+    os.remove(os.path.join(root_folder, "halfrings", "30_SSfull_map.json"))
+    resume("done")
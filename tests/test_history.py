@@ -0,0 +1,39 @@
+import sys
+sys.path.append("../../")
+from plancknull.tasks import Task
+from plancknull.history import History, TaskMonitor
+from plancknull.scheduler import Dispatcher
+
+def test_history(tmpdir):
+
+    filename = str(tmpdir.join("task_history.json"))
+    tasks = [Task("halfrings", 30, "", "full", "IQU", False),
+             Task("surveydiff", 70, "", (1, 2, 3), "IQU", False),
+             Task("chdiff", 30, ("LFI27", "LFI28"), 1, "I", False)]
+    history = History(filename, nside=16)
+    assert history.order(tasks) == tasks
+
+    stats = TaskMonitor().stats()
+    assert stats["peak_memory"] > 0
+    history.update(tasks[0], dict(wall_time=10., peak_memory=2e9))
+    history.update(tasks[1], dict(wall_time=100., peak_memory=4e9))
+    history.save()
+
+    history = History(filename, nside=16)
+    assert history.wall_time(tasks[1]) == 100.
+    assert history.get(tasks[1])["runs"] == 1
+    # tasks never run first, then longest first
+    assert history.order(tasks) == [tasks[2], tasks[1], tasks[0]]
+    # entries at another nside are ignored
+    assert History(filename, nside=32).order(tasks) == tasks
+
+def test_dispatcher_memory():
+
+    tasks = [Task("chdiff", 30, ("LFI27", "LFI28"), surv, "I", False) for surv in [1, 2, 3]]
+    memory = {1: 3, 2: 1, 3: 2}
+    dispatcher = Dispatcher(tasks)
+    fits = lambda task: memory[task.surv] <= 2
+    assert dispatcher.next_task(0, fits)[1].surv == 2
+    assert dispatcher.next_task(1, fits)[1].surv == 3
+    assert dispatcher.next_task(2, lambda task: False) is None
+    assert len(dispatcher) == 1
@@ -0,0 +1,32 @@
+import os
+import healpy
+
+import sys
+sys.path.append("../../")
+from plancknull.tasks import Task
+from plancknull.layout import plan_layout, set_threads, task_class
+
+def test_plan_layout():
+
+    tasks = [Task("halfrings", 30, "", "full", "IQU", False),
+             Task("chdiff", 30, ("LFI27", "LFI28"), 1, "I", False)]
+    assert [task_class(task) for task in tasks] == ["IQU", "I"]
+
+    layout = plan_layout(tasks, 1024, 16)
+    assert layout["threads"] == {"I": 2, "IQU": 4}
+    assert layout["processes"] == 8
+
+    # low resolution, one worker per core
+    layout = plan_layout(tasks, 128, 16)
+    assert layout["threads"] == {"I": 1, "IQU": 1}
+    assert layout["processes"] == 16
+
+    layout = plan_layout(tasks[:1], 1024, 16, threads={"IQU": 32}, processes=2)
+    assert layout == dict(cores=16, processes=2, threads={"IQU": 16})
+
+def test_set_threads():
+
+    libraries = set_threads(1)
+    assert os.environ["OMP_NUM_THREADS"] == "1"
+    # healpy, imported above, is built with OpenMP
+    assert any("omp" in os.path.basename(library) for library in libraries)
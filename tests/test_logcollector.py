@@ -0,0 +1,37 @@
+import json
+import multiprocessing
+import logging as log
+
+import sys
+sys.path.append("../../")
+from plancknull import logcollector
+
+def log_tasks(address, names):
+    for name in names:
+        logcollector.start_task(address, name)
+        log.info("Running " + name)
+        logcollector.end_task()
+
+def test_log_collector(tmpdir):
+
+    filename = str(tmpdir.join(logcollector.FILENAME))
+    collector = logcollector.LogCollector(filename)
+    workers = [multiprocessing.Process(target=log_tasks, args=(collector.address, names))
+               for names in [["halfrings/30_SSfull", "surveydiff/30_SS1-SS2"], ["chdiff/70_LFI18-LFI19_SS1"]]]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    collector.stop()
+
+    records = [json.loads(line) for line in open(filename)]
+    assert len(records) == 6
+    assert set(record["task"] for record in records) == set(["halfrings/30_SSfull", "surveydiff/30_SS1-SS2", "chdiff/70_LFI18-LFI19_SS1"])
+    assert len(set(record["worker"] for record in records)) == 2
+
+    # one log file per test, as written by differences.configure_file_logger
+    filenames = logcollector.split_log(filename)
+    assert len(filenames) == 3
+    lines = tmpdir.join("surveydiff", "30_SS1-SS2.log").read().splitlines()
+    assert lines[0].endswith("INFO     Start logging")
+    assert lines[1].endswith("INFO     Running surveydiff/30_SS1-SS2")
@@ -0,0 +1,124 @@
+import os
+import numpy as np
+
+import sys
+sys.path.append("../../")
+from plancknull.mapstore import SharedMapStore, ScratchMaps, SharedStoreReader
+from plancknull.reader import BaseMapReader, DXReader, CachedReader
+from plancknull.tasks import Task, run_task, task_reads
+from plancknull.scheduler import run_local
+from plancknull.watchdog import Watchdog
+from plancknull.runner import Run
+from plancknull import synthetic
+
+def test_mapstore(tmpdir):
+
+    store = SharedMapStore(str(tmpdir.join("store")))
+    m = np.ma.MaskedArray(np.arange(12.), mask=np.arange(12) % 2 == 0)
+    loads = []
+    def loader():
+        loads.append(1)
+        return [m, np.ones(12, dtype=np.bool)]
+
+    key = ("map", 30, 1, "", 0, "I", False, 1)
+    store.incref(key, 2)
+    for consumer in range(2):
+        value = store.get(key, loader)
+        assert isinstance(value, list)
+        assert np.all(value[0] == m) and np.all(value[0].mask == m.mask)
+        assert not value[0].data.flags.writeable
+    assert len(loads) == 1
+
+    # no consumer declared, no eviction
+    assert store.incref(key, 0) is None
+    assert key in store
+    assert store.release(key) == 1
+    assert key in store
+    # evicted after the last consumer, attached views stay valid
+    assert store.release(key) == 0
+    assert key not in store
+    assert value[1].sum() == 12
+
+def test_scratchmaps(tmpdir):
+
+    scratch = ScratchMaps(str(tmpdir), max_resident=2)
+    for surv in range(4):
+        scratch[surv] = [np.ma.MaskedArray(np.arange(12.) + surv, fill_value=-1.6375e30)]
+    for surv in [0, 1, 0, 2, 3]:
+        m = scratch[surv][0]
+        assert m[0] == surv
+        assert m.fill_value == -1.6375e30
+    assert len(scratch.resident) == 2
+    assert scratch.loads == 4
+    scratch.close()
+    assert not tmpdir.listdir()
+
+def test_engine_consumers(tmpdir):
+
+    reader_conf = synthetic.write_release(str(tmpdir.join("release")), nside=8, freqs=[30], survs=[1, 2])
+    folder = str(tmpdir.join("store"))
+    mapreader = CachedReader(SharedStoreReader(DXReader(reader_conf, nside=8), folder))
+    smooth_combine_config = dict(fwhm=np.radians(10.), degraded_nside=4, spectra=False, chi2=False)
+    task = Task("halfrings", 30, "", "full", "IQU", False)
+    keys = mapreader.task_keys([(30, "full", "", 1, "IQU", False)], [30])
+
+    # consumers never declared, e.g. interactive use: kept until clear()
+    run_task(task, mapreader, smooth_combine_config, str(tmpdir.join("interactive")))
+    store = SharedMapStore(folder)
+    assert all(key in store for key in keys)
+    store.clear()
+
+    # an engine declares the task it receives, the entries are evicted when it completes
+    mapreader.maps.clear()
+    mapreader.masks.clear()
+    run_task(task, mapreader, smooth_combine_config, str(tmpdir.join("out")), acquire=True)
+    store = SharedMapStore(folder)
+    assert not any(key in store for key in keys)
+    assert tmpdir.join("out", "halfrings", "30_SSfull_map.json").check()
+
+class FlakyReader(BaseMapReader):
+    """Reader failing on its first map read, flag is created then"""
+
+    def __init__(self, reader, flag):
+        self.reader = reader
+        self.nside = reader.nside
+        self.flag = flag
+
+    def read_masks(self, freq):
+        return self.reader.read_masks(freq)
+
+    def __call__(self, *args, **kwargs):
+        if not os.path.exists(self.flag):
+            open(self.flag, "w").close()
+            raise RuntimeError("transient failure")
+        return self.reader(*args, **kwargs)
+
+def test_retry_consumers(tmpdir):
+
+    reader_conf = synthetic.write_release(str(tmpdir.join("release")), nside=8, freqs=[30], survs=[1, 2])
+    folder = str(tmpdir.join("store"))
+    mapreader = SharedStoreReader(FlakyReader(DXReader(reader_conf, nside=8), str(tmpdir.join("flag"))), folder)
+    smooth_combine_config = dict(fwhm=np.radians(10.), degraded_nside=4, spectra=False, chi2=False)
+    task = Task("halfrings", 30, "", "full", "IQU", False)
+    keys = mapreader.task_keys(task_reads(task, False), [30])
+    store = SharedMapStore(folder)
+    # declared once, see runner.Run.execute
+    for key in keys:
+        store.incref(key)
+
+    results = run_local([task], mapreader, smooth_combine_config, str(tmpdir.join("out")), processes=1,
+                        poll_interval=.1, watchdog=Watchdog(timeout=lambda task: None, retries=1, backoff=0.))
+    assert results[0][1] == "done"
+    # the first attempt released the entries, the retry declared itself again
+    assert not any(key in store for key in keys)
+
+def test_run_clears_store(tmpdir):
+
+    reader_conf = synthetic.write_release(str(tmpdir.join("release")), nside=8, freqs=[30], survs=[])
+    folder = str(tmpdir.join("store"))
+    for backend in ["serial", "local", "graph"]:
+        run_conf = synthetic.make_run_config(reader_conf, str(tmpdir.join(backend)), 8, freqs=[30], surveydiff=False,
+                                             options=dict(backend=backend, shared_store=folder, processes="1"))
+        results = Run(run_conf).execute()
+        assert [status for task, status, error in results] == ["done"]
+        assert not os.path.exists(folder)
@@ -0,0 +1,75 @@
+import json
+import threading
+import numpy as np
+
+import sys
+sys.path.append("../../")
+from plancknull import memory
+from plancknull.timings import timed
+
+def test_stage_peaks():
+
+    memory.start_task()
+    with timed("smoothing"):
+        maps = np.ones(2**25)
+        del maps
+    with timed("write"):
+        pass
+    peaks, traced_peaks = memory.take()
+    assert sorted(peaks) == ["smoothing", "write"]
+    if memory.reset_peak_memory():
+        # 256 MB allocated and freed in smoothing only
+        assert peaks["smoothing"] - peaks["write"] > 200 * 2**20
+    assert memory.task_peak() >= peaks["smoothing"]
+    assert memory.take() == ({}, {})
+
+def test_write_summary(tmpdir):
+
+    tmpdir.mkdir("halfrings")
+    outputs = []
+    for surv, peak in [("full", 3 * 2**20), ("1", 2**20)]:
+        base_filename = "halfrings/30_SS" + surv
+        tmpdir.join(base_filename + "_map.json").write(json.dumps(dict(memory=dict(anafast=peak))))
+        outputs.append(("halfrings", base_filename))
+
+    rows = memory.aggregate(str(tmpdir), outputs)
+    assert [row[:3] for row in rows] == [("halfrings", "anafast", 2)]
+    assert rows[0][5] == 3 * 2**20
+
+    summary = memory.write_summary(str(tmpdir), outputs, {"halfrings/30_SS1": 2**20, "halfrings/30_SSfull": 3 * 2**20})
+    assert tmpdir.join(memory.FILENAME).read().startswith(summary)
+    # tasks with the highest peak first
+    assert summary.index("30_SSfull") < summary.index("30_SS1 ")
+
+def test_thread_stage_peaks(monkeypatch):
+
+    resets = []
+    monkeypatch.setattr(memory, "reset_peak_memory", lambda: resets.append(1))
+    monkeypatch.setattr(memory, "current_memory", lambda: 1)
+    monkeypatch.setattr(memory, "peak_memory", lambda: 2)
+    started, finished = threading.Event(), threading.Event()
+    peaks = {}
+
+    def other():
+        with timed("smoothing"):
+            started.set()
+            finished.wait()
+        peaks.update(memory.take()[0])
+
+    thread = threading.Thread(target=other)
+    thread.start()
+    started.wait()
+    # a stage overlapping the stage of the other thread does not reset the
+    # high-water mark of the process and records its resident memory
+    memory.start_task()
+    with timed("write"):
+        pass
+    assert resets == [1]
+    assert memory.take()[0] == {"write": 1}
+    finished.set()
+    thread.join()
+    assert "smoothing" in peaks
+    with timed("write"):
+        pass
+    assert len(resets) == 2
+    assert memory.take()[0] == {"write": 2}
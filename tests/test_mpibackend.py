@@ -0,0 +1,48 @@
+import logging
+import numpy as np
+import pytest
+
+import sys
+sys.path.append("../../")
+MPI = pytest.importorskip("mpi4py.MPI")
+from plancknull.tasks import Task
+from plancknull.reader import BaseMapReader
+from plancknull.mapstore import SharedStoreReader
+from plancknull.mpibackend import share_masks, finish, run_mpi
+
+class CorruptReader(BaseMapReader):
+    """Reads the masks, fails reading maps"""
+
+    nside = 1
+
+    def read_masks(self, freq):
+        return tuple(np.ones(12, dtype=np.bool) for mask in range(3))
+
+    def __call__(self, freq, surv, chtag='', halfring=0, pol="I", bp_corr=False):
+        raise ValueError("corrupt map")
+
+def test_share_masks(tmpdir):
+
+    mapreader = SharedStoreReader(CorruptReader(), str(tmpdir.join("store")))
+    node = share_masks(MPI.COMM_WORLD, mapreader, [30, 44])
+    assert mapreader.masks_key(44) in mapreader.store
+    assert len(mapreader.read_masks(30)) == 3
+    finish(MPI.COMM_WORLD, node, mapreader.folder)
+    assert not tmpdir.join("store").check()
+
+def test_run_mpi_failure(tmpdir):
+
+    mapreader = SharedStoreReader(CorruptReader(), str(tmpdir.join("store")))
+    config = dict(fwhm=0., degraded_nside=1, spectra=False, chi2=False)
+    # tasks log to their own file, closing the handlers of the root logger
+    handlers = logging.root.handlers[:]
+    logging.root.handlers = [logging.FileHandler(str(tmpdir.join("test.log")))]
+    try:
+        results = run_mpi([Task("halfrings", 30, "", "full", "I", False)], mapreader, config, str(tmpdir))
+    finally:
+        logging.root.handlers = handlers
+    task, status, error = results[0]
+    assert status == "failed"
+    # with the rank and host that ran the task
+    assert error.startswith("rank 0 on ")
+    assert "corrupt map" in error
@@ -0,0 +1,84 @@
+import os
+import json
+import itertools
+import numpy as np
+import healpy as hp
+
+import sys
+sys.path.append("../../")
+from plancknull.differences import blocked_pairs, pairs_of_maps
+from plancknull.reader import DXReader
+from plancknull.tasks import Task, run_task
+from plancknull.runner import Run
+from plancknull import synthetic
+
+def test_blocked_pairs():
+
+    survs = range(1, 9)
+    for max_resident in [2, 3, 4, 8]:
+        pairs = blocked_pairs(survs, max_resident)
+        assert sorted(pairs) == list(itertools.combinations(survs, 2))
+        # at most max_resident surveys in each tile
+        block = max_resident // 2
+        tiles = {}
+        for pair in pairs:
+            tiles.setdefault(tuple((s - 1) // block for s in pair), set()).update(pair)
+        assert max(len(t) for t in tiles.values()) <= max_resident
+
+def test_pairs_of_maps(tmpdir):
+
+    read = lambda surv: [np.arange(12.) + surv]
+    survs = range(1, 6)
+    in_memory = dict(((s1, s2), (m1[0].copy(), m2[0].copy())) for s1, s2, m1, m2 in pairs_of_maps(read, survs))
+    # a budget of 2 maps
+    out_of_core = dict(((s1, s2), (m1[0].copy(), m2[0].copy())) for s1, s2, m1, m2 in
+                       pairs_of_maps(read, survs, memory_budget=2 * 12 * 8 / 2.**20, scratch_folder=str(tmpdir)))
+    assert sorted(out_of_core) == sorted(in_memory)
+    for pair in in_memory:
+        assert np.all(out_of_core[pair][0] == in_memory[pair][0])
+        assert np.all(out_of_core[pair][1] == in_memory[pair][1])
+    assert not tmpdir.listdir()
+
+def test_out_of_core_tasks(tmpdir):
+
+    reader_conf = synthetic.write_release(str(tmpdir.join("release")), nside=8, freqs=[30], survs=[1, 2, 3])
+    mapreader = DXReader(reader_conf, nside=8)
+    smooth_combine_config = dict(fwhm=np.radians(10.), degraded_nside=4, spectra=True, chi2=False)
+    tasks = [Task("surveydiff", 30, "", (1, 2, 3), "IQU", False),
+             Task("chdiff", 30, ("LFI27M", "LFI27S", "LFI28M"), "full", "I", False)]
+    folders = {}
+    # a budget below the maps of 2 surveys or channels, at least 2 are resident
+    for name, out_of_core_config in [("memory", None),
+                                     ("scratch", dict(memory_budget=1e-6, scratch_folder=str(tmpdir.mkdir("tmp"))))]:
+        folders[name] = str(tmpdir.join(name))
+        for task in tasks:
+            run_task(task, mapreader, smooth_combine_config, folders[name], out_of_core_config=out_of_core_config)
+    assert not tmpdir.join("tmp").listdir()
+
+    outputs = []
+    for path, dirs, files in os.walk(folders["memory"]):
+        outputs += [os.path.relpath(os.path.join(path, f), folders["memory"]) for f in files]
+    # map, spectra and metadata of the 3 couples of each task
+    assert len([f for f in outputs if f.startswith("surveydiff")]) == 3 * 4
+    assert len([f for f in outputs if f.startswith("chdiff")]) == 3 * 4
+    for output in outputs:
+        filenames = [os.path.join(folders[name], output) for name in ["memory", "scratch"]]
+        if output.endswith("_map.fits"):
+            in_memory, out_of_core = [hp.read_map(f, field=None, verbose=False) for f in filenames]
+        elif output.endswith("_cl.fits"):
+            in_memory, out_of_core = [hp.read_cl(f) for f in filenames]
+        else:
+            in_memory, out_of_core = [json.load(open(f)) for f in filenames]
+            assert sorted(out_of_core) == sorted(in_memory)
+            in_memory, out_of_core = [[metadata[k] for k in sorted(metadata) if isinstance(metadata[k], float)]
+                                      for metadata in [in_memory, out_of_core]]
+        assert np.allclose(out_of_core, in_memory)
+
+def test_cache_within_budget(tmpdir):
+
+    reader_conf = synthetic.write_release(str(tmpdir.join("release")), nside=8, freqs=[30], survs=[1, 2])
+    for options, cache_maps in [({}, 8), (dict(worker_cache_maps="4"), 4),
+                                # 2 IQU maps at nside 8
+                                (dict(memory_budget="0.05"), 2), (dict(memory_budget="1e-6"), 0)]:
+        run_conf = synthetic.make_run_config(reader_conf, str(tmpdir.join("out")), 8, freqs=[30], options=options)
+        assert Run(run_conf).cache_maps == cache_maps
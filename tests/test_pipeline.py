@@ -0,0 +1,97 @@
+import os
+import json
+import numpy as np
+
+import sys
+sys.path.append("../../")
+from plancknull.pipeline import Graph, ThreadExecutor, build_graph, run_graph
+from plancknull.reader import DXReader
+from plancknull.mapstore import SharedMapStore, SharedStoreReader
+from plancknull.tasks import Task, task_reads
+from plancknull import fingerprint, synthetic
+
+def read(name, calls):
+    calls.append(name)
+    if name == "missing":
+        raise IOError("No match for pattern " + name)
+    if name == "bug":
+        raise ValueError("Bug in " + name)
+    return name
+
+def combine(a, b):
+    return a + "-" + b
+
+def test_graph():
+
+    calls = []
+    graph = Graph()
+    outputs = []
+    for a, b in [("ss1", "ss2"), ("ss1", "ss3"), ("ss2", "ss3"), ("ss1", "missing"), ("ss1", "bug")]:
+        refs = [graph.add(("map", name), read, name, calls) for name in [a, b]]
+        outputs.append(graph.add(("output", a, b), combine, *refs).key)
+    # each map is read once
+    assert len(graph.nodes) == 5 + 5
+
+    for executor in [None, ThreadExecutor(2)]:
+        del calls[:]
+        status = graph.run(executor)
+        assert sorted(calls) == ["bug", "missing", "ss1", "ss2", "ss3"]
+        assert [status[key][0] for key in outputs] == ["done"] * 3 + ["skipped"] * 2
+        assert status[("map", "missing")][0] == "skipped"
+        # errors other than missing inputs fail with their traceback
+        assert status[("map", "bug")][0] == "failed"
+        assert "Traceback" in status[("map", "bug")][1]
+        # intermediates are freed after their last consumer
+        assert all(node.value is None for node in graph.nodes.values())
+
+def test_run_graph(tmpdir):
+
+    reader_conf = synthetic.write_release(str(tmpdir.join("release")), nside=8, freqs=[30], survs=[1, 2])
+    mapreader = DXReader(reader_conf, nside=8)
+    smooth_combine_config = dict(fwhm=np.radians(10.), degraded_nside=4, spectra=True, chi2=False)
+    tasks = [Task("halfrings", 30, "", "full", "IQU", False),
+             Task("surveydiff", 30, "", (1, 2), "IQU", False),
+             # no template of survey halfrings
+             Task("halfrings", 30, "", 1, "IQU", False),
+             # no maps at 44 GHz
+             Task("halfrings", 44, "", "full", "IQU", False)]
+
+    graph = build_graph(tasks, mapreader, smooth_combine_config, str(tmpdir.join("out")))
+    # the masks of 30 GHz are read once
+    assert len([key for key in graph.nodes if key[0] == "masks"]) == 2
+    assert len([key for key in graph.nodes if key[0] == "map"]) == 4 * 2
+    assert len([key for key in graph.nodes if key[0] == "output"]) == 4
+
+    for executor in ["serial", "threads"]:
+        root_folder = str(tmpdir.join(executor))
+        results = run_graph(tasks, mapreader, smooth_combine_config, root_folder, executor=executor, workers=2,
+                            fingerprints={tasks[0]: "0123abcd"})
+        assert [status for task, status, error in results] == ["done", "done", "skipped", "skipped"]
+        # a missing template skips the read, it does not fail
+        assert results[2][2] == "Dependency %s skipped" % str(("map", 30, 1, "", 1, "IQU", False))
+        for base_filename in ["halfrings/30_SSfull", "surveydiff/30_SS1-SS2"]:
+            with open(os.path.join(root_folder, base_filename + "_map.json")) as f:
+                metadata = json.load(f)
+            assert "smoothing" in metadata["timings"]
+        assert fingerprint.is_up_to_date(root_folder, tasks[0], "0123abcd")
+
+def test_run_graph_store(tmpdir):
+
+    reader_conf = synthetic.write_release(str(tmpdir.join("release")), nside=8, freqs=[30], survs=[1, 2])
+    folder = str(tmpdir.join("store"))
+    mapreader = SharedStoreReader(DXReader(reader_conf, nside=8), folder)
+    smooth_combine_config = dict(fwhm=np.radians(10.), degraded_nside=4, spectra=False, chi2=False)
+    tasks = [Task("halfrings", 30, "", "full", "IQU", False), Task("surveydiff", 30, "", (1, 2), "IQU", False)]
+    # consumers declared by runner.Run.execute
+    store = SharedMapStore(folder)
+    keys = set()
+    for task in tasks:
+        task_keys = mapreader.task_keys(task_reads(task, False), [task.freq])
+        for key in task_keys:
+            store.incref(key)
+        keys.update(task_keys)
+
+    results = run_graph(tasks, mapreader, smooth_combine_config, str(tmpdir.join("out")))
+    assert [status for task, status, error in results] == ["done", "done"]
+    # the entries are evicted after the last task reading them
+    assert not any(key in store for key in keys)
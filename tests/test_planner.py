@@ -0,0 +1,55 @@
+import numpy as np
+from ConfigParser import NoOptionError
+
+import sys
+sys.path.append("../../")
+from plancknull.planner import plan_task, estimate_wall_time, transforms_per_output, TRANSFORM_SECONDS
+from plancknull.tasks import Task
+
+class FileReader(object):
+    """Reader listing files of given sizes, each call reads one file"""
+
+    nside = 256
+
+    def __init__(self, folder, sizes):
+        self.folder = folder
+        for name, size in sizes.items():
+            folder.join(name).write("x" * size)
+
+    def mask_patterns(self, freq):
+        return [str(self.folder.join("mask_%s_%d" % (mask_type, freq))) for mask_type in ["ps", "spectra", "galaxy"]]
+
+    def map_patterns(self, freq, surv, chtag='', halfring=0, bp_corr=False):
+        if surv == "nominal":
+            raise NoOptionError("map_frequency_halfring", "Templates")
+        return [str(self.folder.join("map_%d_%s_%d" % (freq, surv, halfring)))]
+
+def test_plan_task(tmpdir):
+
+    sizes = dict(mask_ps_30=10, mask_spectra_30=20, mask_galaxy_30=30, map_30_full_1=1000, map_30_full_2=2000)
+    mapreader = FileReader(tmpdir, sizes)
+    task = Task("halfrings", 30, "", "full", "IQU", False)
+
+    plan = plan_task(task, mapreader, dict(spectra=True, chi2=False))
+    assert len(plan["inputs"]) == 5 and plan["missing"] == 0
+    assert plan["bytes_read"] == sum(sizes.values())
+    assert plan["transforms"] == 3
+    assert plan["outputs"] == ["halfrings/30_SSfull"]
+    # the variance maps are read from the files of the maps
+    plan_chi2 = plan_task(task, mapreader, dict(spectra=True, chi2=True))
+    assert len(plan_chi2["inputs"]) == 5
+    assert plan_chi2["bytes_read"] == 60 + 2 * 3000
+    assert plan_chi2["transforms"] == transforms_per_output(3, True, True)
+    assert plan_chi2["peak_memory"] > plan["peak_memory"]
+
+    wall_time = estimate_wall_time(plan, mapreader.nside, io_rate=1e-3)
+    assert np.allclose(wall_time, 3060 / (1e-3 * 2**20) + 3 * TRANSFORM_SECONDS / 8.)
+
+    tmpdir.join("map_30_full_2").remove()
+    plan = plan_task(task, mapreader, dict(spectra=True, chi2=False))
+    assert plan["missing"] == 1
+    assert plan["bytes_read"] == 1060
+
+    plan = plan_task(task._replace(surv="nominal"), mapreader, dict(spectra=True, chi2=False))
+    assert "map_frequency_halfring" in plan["error"]
+    assert estimate_wall_time(plan, mapreader.nside) is None
@@ -0,0 +1,26 @@
+import numpy as np
+import healpy as hp
+
+import sys
+sys.path.append("../../")
+from plancknull.preflight import read_fits_header, check_file, read_columns
+
+def test_check_file(tmpdir):
+
+    filename = str(tmpdir.join("map_030_survey_1.fits"))
+    hp.write_map(filename, [np.zeros(hp.nside2npix(16)) for c in range(3)])
+    header = read_fits_header(filename)
+    assert header["NSIDE"] == 16
+    assert header["TFIELDS"] == 3
+
+    pattern = str(tmpdir.join("map_030_*_1.fits"))
+    assert check_file(pattern, columns=3, nside=16)["problem"] is None
+    assert check_file(pattern, columns=3, nside=32)["problem"] == "nside"
+    # variance II, IQ, IU, QQ, QU, UU is in the columns 5 to 10
+    assert check_file(pattern, columns=read_columns(30, "", "ADF"), nside=16)["problem"] == "columns"
+    assert check_file(str(tmpdir.join("map_030_*_2.fits")))["problem"] == "missing"
+
+    hp.write_map(str(tmpdir.join("map_030_survey_1_v2.fits")), np.zeros(hp.nside2npix(16)))
+    result = check_file(str(tmpdir.join("map_030_survey_1*.fits")))
+    assert result["problem"] == "ambiguous"
+    assert result["filename"] is None
@@ -0,0 +1,26 @@
+import sys
+sys.path.append("../../")
+from plancknull import profiling
+
+def busy_loop(n):
+    return sum(i * i for i in xrange(n))
+
+def test_merge(tmpdir):
+
+    root_folder = str(tmpdir)
+    filenames = [profiling.profile_filename(root_folder, name) for name in ["surveydiff/30_SS1-SS2", "halfrings/30_SSfull"]]
+    for filename in filenames:
+        with profiling.TaskProfile(filename):
+            busy_loop(10000)
+    # without filename the task is not profiled
+    with profiling.TaskProfile(None):
+        busy_loop(10)
+    assert profiling.find_profiles(root_folder) == sorted(filenames)
+
+    report = profiling.merge(filenames, top=5)
+    assert report.startswith("2 task profiles")
+    assert "busy_loop" in report
+
+    report_filename = tmpdir.join(profiling.REPORT_FILENAME)
+    assert profiling.write_report(filenames + [root_folder + "/chdiff/missing.prof"], str(report_filename)) == 2
+    assert "busy_loop" in report_filename.read()
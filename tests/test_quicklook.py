@@ -0,0 +1,59 @@
+import json
+
+import sys
+sys.path.append("../../")
+from plancknull.quicklook import exceeded, mark_stage, copy_outputs, run_progressive
+from plancknull.summarydb import SummaryDB
+from plancknull.runner import Run
+from plancknull import synthetic
+
+def test_exceeded():
+
+    metadata = dict(map_chi2=1.3, map_chi2_galmask=1.1, map_unsm_chi2=1.25, map_std_I=2., title="Halfring")
+    assert exceeded(metadata, {"map_chi2*": 1.2}) == dict(map_chi2=1.3)
+    assert exceeded(metadata, {"map_chi2*": 1.05, "map_unsm_chi2": 1.2}) == dict(map_chi2=1.3, map_chi2_galmask=1.1, map_unsm_chi2=1.25)
+    assert exceeded(metadata, {"map_chi2*": 2.}) == {}
+
+def test_mark_stage(tmpdir):
+
+    quick_folder = tmpdir.join("quicklook")
+    quick_folder.join("halfrings", "30_SSfull_map.json").write(json.dumps(dict(map_chi2=1.)), ensure=True)
+    quick_folder.join("halfrings", "30_SSfull_map.fits").write("")
+    mark_stage(str(quick_folder), "halfrings/30_SSfull", stage="quicklook", stage_nside=64)
+    copy_outputs(str(quick_folder), str(tmpdir), "halfrings/30_SSfull")
+    assert tmpdir.join("halfrings", "30_SSfull_map.fits").check()
+    assert not tmpdir.join("halfrings", "30_SSfull_cl.json").check()
+    metadata = json.loads(tmpdir.join("halfrings", "30_SSfull_map.json").read())
+    assert metadata == dict(map_chi2=1., stage="quicklook", stage_nside=64)
+
+def test_summary_db(tmpdir, monkeypatch):
+
+    reader_conf = synthetic.write_release(str(tmpdir.join("release")), nside=16, freqs=[30], survs=[])
+    summary_db = str(tmpdir.join("summary.sqlite"))
+    # every connection opened to store the outputs is closed
+    connections = []
+    close = SummaryDB.close
+    def counting_close(db):
+        connections.remove(db)
+        close(db)
+    monkeypatch.setattr(SummaryDB, "close", counting_close)
+    init = SummaryDB.__init__
+    def counting_init(db, *args, **kwargs):
+        connections.append(db)
+        init(db, *args, **kwargs)
+    monkeypatch.setattr(SummaryDB, "__init__", counting_init)
+    # every output passes or every output is run again at full resolution
+    for run_id, threshold, stage in [("passed", 1e9, "quicklook"), ("flagged", -1., "full")]:
+        options = dict(backend="serial", summary_db=summary_db, run_id=run_id, quicklook_nside="8",
+                       quicklook_thresholds=json.dumps({"map_chi2*": threshold}))
+        run_conf = synthetic.make_run_config(reader_conf, str(tmpdir.join(run_id)), 16, freqs=[30], degraded_nside=4,
+                                             surveydiff=False, options=options)
+        run_progressive(Run(run_conf))
+        assert connections == []
+
+        db = SummaryDB(summary_db)
+        quick_rows = db.query(run_id=run_id + "_quicklook", component="I")
+        assert [row["metadata"]["stage"] for row in quick_rows] == ["quicklook"]
+        rows = db.query(run_id=run_id, component="I")
+        assert [row["metadata"]["stage"] for row in rows] == [stage]
+        db.close()
@@ -0,0 +1,194 @@
+import os
+import time
+
+import sys
+sys.path.append("../../")
+from plancknull.tasks import Task, split_task, task_name, task_outputs
+from plancknull.scheduler import Dispatcher, locality_key, submit_packed, run_local, wait_watched
+from plancknull.reader import BaseMapReader
+from plancknull.watchdog import Watchdog
+from plancknull.runner import Run
+from plancknull import planner, synthetic
+
+def test_dispatcher_locality():
+
+    tasks = [Task("chdiff", 70, ("LFI18", "LFI19"), surv, "I", False) for surv in [1, 2]] + \
+            [Task("surveydiff", 70, ch, (1, 2, 3), "I", False) for ch in ["LFI18M", "LFI18S", "LFI19M"]] + \
+            [Task("surveydiff", 30, ch, (1, 2, 3), "I", False) for ch in ["LFI27M", "LFI27S"]]
+    dispatcher = Dispatcher(tasks)
+    assert len(dispatcher) == len(tasks)
+
+    # workers start from the largest groups nobody is working on
+    assert dispatcher.next_task(0)[1].chtag == "LFI18M"
+    assert dispatcher.next_task(1)[1].chtag == "LFI27M"
+    # and keep working on their group
+    assert dispatcher.next_task(0)[1].chtag == "LFI18S"
+    assert dispatcher.next_task(1)[1].chtag == "LFI27S"
+    assert dispatcher.next_task(1)[1].freq == 70
+    dispatched = [dispatcher.next_task(0) for i in range(3)]
+    assert dispatched[-1] is None
+    assert len(dispatcher) == 0
+
+def test_split_task():
+
+    task = Task("surveydiff", 30, "", (1, 2, 3, 4), "IQU", False)
+    pairs = split_task(task)
+    assert len(pairs) == 6
+    assert sorted(sum([task_outputs(pair) for pair in pairs], [])) == sorted(task_outputs(task))
+    # each couple has its own name, i.e. log file and fingerprint
+    assert len(set(task_name(pair) for pair in pairs)) == 6
+    assert task_name(pairs[0]) == "surveydiff/30_SS1-SS2"
+    # all couples read the same maps
+    assert len(set(locality_key(pair) for pair in pairs)) == 1
+
+    pairs = split_task(Task("chdiff", 30, ("LFI27", "LFI28"), 1, "I", False))
+    assert pairs == [Task("chdiff", 30, ("LFI27", "LFI28"), 1, "I", False)]
+    assert task_name(pairs[0]) == "chdiff/LFI27-LFI28_SS1"
+    assert split_task(Task("halfrings", 30, "", "full", "IQU", False)) == [Task("halfrings", 30, "", "full", "IQU", False)]
+
+class FakeResult(object):
+
+    def __init__(self, task):
+        self.task = task
+
+    def ready(self):
+        return True
+
+class FakeView(object):
+
+    def __init__(self, engine_ids):
+        self.engine_ids = engine_ids
+
+    def apply_sync(self, func):
+        return ["node%d" % (engine_id // 2) for engine_id in self.engine_ids]
+
+class FakeClient(object):
+    """2 nodes with 2 engines each"""
+
+    ids = [0, 1, 2, 3]
+
+    def __getitem__(self, engine_ids):
+        return FakeView(engine_ids if isinstance(engine_ids, list) else [engine_ids])
+
+def test_submit_packed():
+
+    tasks = [Task("chdiff", 30, ("LFI27", "LFI28"), surv, "I", False) for surv in range(1, 7)]
+    memory = dict(zip(range(1, 7), [15, 15, 15, 15, 5, 5]))
+    submitted = []
+    def submit(view, task):
+        submitted.append((view.engine_ids[0], task.surv))
+        return FakeResult(task)
+    async_tasks = submit_packed(FakeClient(), tasks, submit, worker_memory=10,
+                                task_memory=lambda task: memory[task.surv], poll_interval=0)
+    assert [a.task for a in async_tasks] == tasks
+    # each node has 20, only one task of 15 at a time, the small tasks fill the second engine
+    assert submitted[:4] == [(0, 1), (1, 5), (2, 2), (3, 6)]
+
+class HangingReader(BaseMapReader):
+    """Hangs reading the masks the first time, then fails"""
+
+    nside = 8
+
+    def __init__(self, flag):
+        self.flag = flag
+
+    def read_masks(self, freq):
+        if not os.path.exists(self.flag):
+            open(self.flag, "w").close()
+            time.sleep(60)
+        raise RuntimeError("corrupt masks")
+
+def test_run_local_watchdog(tmpdir):
+
+    task = Task("halfrings", 30, "", "full", "I", False)
+    watchdog = Watchdog(timeout=lambda task: 1., retries=1, backoff=0.)
+    start = time.time()
+    results = run_local([task], HangingReader(str(tmpdir.join("flag"))), dict(chi2=False), str(tmpdir),
+                        processes=1, poll_interval=0.1, watchdog=watchdog)
+    assert time.time() - start < 30
+    # killed after its timeout, then retried on a new worker
+    assert results[0][1] == "failed"
+    assert "Attempt 1 on worker 0: Timed out" in results[0][2]
+    assert "Attempt 2 on worker 1" in results[0][2]
+    assert "corrupt masks" in results[0][2]
+    assert watchdog.gave_up(task)
+
+class DyingReader(BaseMapReader):
+    """Reader whose process dies reading the masks of 30 GHz, the other masks are missing"""
+
+    def read_masks(self, freq):
+        if freq == 30:
+            os._exit(1)
+        time.sleep(.2)
+        raise IOError("No masks at %d GHz" % freq)
+
+def test_run_local_dead_worker(tmpdir):
+
+    tasks = [Task("halfrings", 30, "", "full", "I", False)] + \
+            [Task("halfrings", 44, "", surv, "I", False) for surv in ["full", "nominal", 1, 2, 3]]
+    start = time.time()
+    results = run_local(tasks, DyingReader(), dict(chi2=False), str(tmpdir), processes=2, poll_interval=5.)
+    # the death is detected while the other worker keeps sending results, and the shutdown does not wait for it
+    assert time.time() - start < 5
+    assert results[0][1] == "failed" and "Worker died" in results[0][2]
+    assert [result[1] for result in results[1:]] == ["skipped"] * 5
+
+class RemoteError(Exception):
+
+    ename = "ValueError"
+    traceback = "Traceback: ValueError"
+
+class FakeAsyncResult(object):
+    """Task on an engine, hung if it never completes"""
+
+    def __init__(self, engine_id, error=None, hung=False):
+        self.metadata = dict(engine_id=engine_id, started=True)
+        self.error = error
+        self.hung = hung
+
+    def ready(self):
+        return not self.hung
+
+    def get(self):
+        if self.error:
+            raise self.error
+        return dict(wall_time=1.)
+
+def test_wait_watched():
+
+    tasks = [Task("chdiff", 30, ("LFI27", "LFI28"), surv, "I", False) for surv in [1, 2]]
+    async_tasks = [FakeAsyncResult(0, hung=True), FakeAsyncResult(1, error=RemoteError())]
+    retried = []
+    def submit(view, task):
+        retried.append((view.engine_ids, task.surv))
+        return FakeAsyncResult(view.engine_ids[0])
+    client = FakeClient()
+    client.load_balanced_view = lambda targets: FakeView(targets)
+    watchdog = Watchdog(timeout=lambda task: 0., retries=1, backoff=0.)
+    wait_watched(client, tasks, async_tasks, submit, watchdog, poll_interval=0)
+    # the hung engine is left out, the failed task goes to the other engines
+    assert watchdog.hung == set([0])
+    assert retried == [([1, 2, 3], 1), ([2, 3], 2)]
+    assert not watchdog.gave_up(tasks[0]) and not watchdog.gave_up(tasks[1])
+    assert async_tasks[1].get() == dict(wall_time=1.)
+
+def test_task_timeout(tmpdir):
+
+    reader_conf = synthetic.write_release(str(tmpdir.join("release")), nside=8, freqs=[30], survs=[])
+    run_conf = synthetic.make_run_config(reader_conf, str(tmpdir.join("out")), 8, freqs=[30], surveydiff=False,
+                                         options=dict(timeout_min="1", io_rate="1e-4"))
+    run = Run(run_conf)
+    task = run.tasks[0]
+    # never run: planned wall time, 10 times
+    plan = planner.plan_task(task, run.mapreader, run.smooth_combine_config)
+    expected = planner.estimate_wall_time(plan, 8, 1e-4)
+    assert expected > 1.
+    assert run.task_timeout(task) == 10 * expected
+    # recorded wall time
+    run = Run(run_conf)
+    run.history.update(task, dict(wall_time=30., peak_memory=0))
+    assert run.task_timeout(task) == 300.
+    # disabled
+    with open(run_conf, "a") as f:
+        f.write("timeout_factor = 0\n")
+    assert Run(run_conf).task_timeout(task) is None
@@ -0,0 +1,61 @@
+import numpy as np
+import healpy as hp
+
+import sys
+sys.path.append("../../")
+from plancknull.reader import BaseMapReader
+from plancknull.differences import smooth_combine_maps
+from plancknull.session import NullTestSession
+
+NSIDE = 8
+
+class RandomReader(BaseMapReader):
+    """Deterministic white noise maps, a different seed for each map"""
+
+    def __call__(self, freq, surv, chtag='', halfring=0, pol="I", bp_corr=False):
+        seed = hash((freq, surv, chtag, halfring)) % 2**32
+        maps = np.random.RandomState(seed).standard_normal((len(pol), hp.nside2npix(NSIDE)))
+        maps = [hp.ma(m) for m in maps]
+        return maps[0] if len(pol) == 1 else maps
+
+    def read_masks(self, freq):
+        npix = hp.nside2npix(NSIDE)
+        ps_mask = np.zeros(npix, dtype=np.bool)
+        ps_mask[:10] = True
+        galaxy_mask = np.zeros(npix, dtype=np.bool)
+        galaxy_mask[npix // 3:npix // 2] = True
+        return ps_mask, ps_mask | galaxy_mask, galaxy_mask
+
+def test_session(tmpdir):
+
+    session = NullTestSession(RandomReader(), fwhm=np.radians(20), degraded_nside=4)
+    result = session.halfrings(30, "", "full", pol="IQU")
+    assert result.base_filename == "halfrings/30_SSfull"
+
+    # same outputs as smooth_combine with hp.smoothing
+    mapreader = RandomReader()
+    ps_mask, union_mask, galaxy_mask = mapreader.read_masks(30)
+    outputs = smooth_combine_maps([(mapreader(30, "full", halfring=1, pol="IQU"), 1),
+                                   (mapreader(30, "full", halfring=2, pol="IQU"), -1)],
+                                  fwhm=np.radians(20), degraded_nside=4, spectra=True,
+                                  smooth_mask=ps_mask, spectra_mask=union_mask, galaxy_mask=galaxy_mask,
+                                  metadata=dict(file_type="halfring"))
+    for k, v in outputs["metadata"].items():
+        if isinstance(v, float):
+            assert np.allclose(v, result.metadata[k])
+    assert np.allclose(outputs["cl"], result.cl)
+
+    # a repeated call returns the same result, a new smoothing reuses the alms
+    assert session.halfrings(30, "", "full", pol="IQU") is result
+    stats = session.stats()
+    session.halfrings(30, "", "full", pol="IQU", fwhm=np.radians(30))
+    assert session.stats()["alm_misses"] == stats["alm_misses"]
+    assert session.stats()["alm_hits"] == stats["alm_hits"] + 1
+    assert session.stats()["map_misses"] == stats["map_misses"]
+
+    results = session.surveydiff(30, "", [1, 2, 3], pol="IQU")
+    assert [r.base_filename for r in results] == ["surveydiff/30_SS1-SS2", "surveydiff/30_SS1-SS3", "surveydiff/30_SS3-SS2"]
+
+    result.write(str(tmpdir))
+    assert tmpdir.join("halfrings", "30_SSfull_map.json").check()
+    assert tmpdir.join("halfrings", "30_SSfull_cl.fits").check()
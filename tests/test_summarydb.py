@@ -0,0 +1,37 @@
+import os
+
+import sys
+sys.path.append("../../")
+from plancknull.summarydb import SummaryDB
+
+def test_summarydb(tmpdir):
+
+    db = SummaryDB(str(tmpdir.join("summary.sqlite")))
+    metadata = dict(base_file_name="surveydiff/70_SS1-SS2", file_type="surveydiff_frequency_map",
+                    channel="70", surveys=(1, 2), title="Survey difference SS1-SS2 ch 70")
+    for comp, chi2 in zip("IQU", [1.1, 0.9, 1.3]):
+        metadata["map_chi2_%s" % comp] = chi2
+        metadata["map_std_%s" % comp] = 1e-6
+    db.insert(metadata, "dx11")
+    db.insert(dict(base_file_name="chdiff/LFI18M-LFI18S_SS1", file_type="chdiff_map",
+                   channel=["LFI18M", "LFI18S"], survey=1, map_chi2=2., map_std_I=1e-5), "dx11")
+    # reinserting replaces the rows
+    db.insert(metadata, "dx11")
+
+    rows = db.query(run_id="dx11", test_type="surveydiff", component="Q")
+    assert len(rows) == 1
+    assert rows[0]["map_chi2"] == .9
+    assert rows[0]["surveys"] == "1-2"
+    assert rows[0]["metadata"]["title"] == metadata["title"]
+
+    rows = db.query(channel=("LFI18M", "LFI18S"))
+    assert [(r["component"], r["map_chi2"]) for r in rows] == [("I", 2.)]
+
+    table = db.chi2_table("dx11", "surveydiff")
+    assert table == [("70", "1-2", "surveydiff/70_SS1-SS2", {"I":1.1, "Q":.9, "U":1.3})]
+    # outputs of the same channel and surveys, e.g. with bandpass correction, are separate rows
+    db.insert(dict(metadata, base_file_name="surveydiff/70_SS1-SS2_bpcorr", map_chi2_I=1., map_chi2_Q=1., map_chi2_U=1.), "dx11")
+    table = db.chi2_table("dx11", "surveydiff")
+    assert table == [("70", "1-2", "surveydiff/70_SS1-SS2", {"I":1.1, "Q":.9, "U":1.3}),
+                     ("70", "1-2", "surveydiff/70_SS1-SS2_bpcorr", {"I":1., "Q":1., "U":1.})]
+    assert db.compare_runs(["dx11", "dx10"], "chdiff") == {("LFI18M-LFI18S", "1", "I"): {"dx11": 2.}}
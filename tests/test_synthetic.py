@@ -0,0 +1,29 @@
+import numpy as np
+
+import sys
+sys.path.append("../../")
+from plancknull import synthetic
+from plancknull.reader import DXReader
+
+def test_release(tmpdir):
+
+    reader_conf = synthetic.write_release(str(tmpdir), nside=8, freqs=[30, 70], survs=[1, 2])
+    mapreader = DXReader(reader_conf)
+
+    # halfrings, surveys, radiometers, horns and quadruplets in the read_dx11.conf layout
+    assert np.shape(mapreader(30, "full", halfring=1, pol="IQU")) == (3, 768)
+    assert np.shape(mapreader(30, 2, pol="IQU")) == (3, 768)
+    assert np.shape(mapreader(30, 1, "LFI27M")) == (768,)
+    assert np.shape(mapreader(30, "nominal", "LFI28")) == (768,)
+    assert np.shape(mapreader(70, "full", "18_23", halfring=2, pol="IQU")) == (3, 768)
+    assert np.shape(mapreader(70, 2, "19_22", pol="I")) == (768,)
+
+    # white noise: the halfring difference has chi2 about 1
+    first, second = [mapreader(70, "full", halfring=halfring, pol="IA") for halfring in [1, 2]]
+    assert abs(np.mean((first[0] - second[0])**2 / (first[1] + second[1])) - 1) < .2
+
+    ps_mask, union_mask, galaxy_mask = DXReader(reader_conf, nside=8).read_masks(30)
+    assert 0 < ps_mask.sum() < galaxy_mask.sum() < union_mask.sum() < 768
+
+    run_conf = synthetic.make_run_config(reader_conf, str(tmpdir.join("out")), 8, freqs=[30])
+    assert "degraded_nside = 2" in open(run_conf).read()
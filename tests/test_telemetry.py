@@ -0,0 +1,40 @@
+import json
+
+import sys
+sys.path.append("../../")
+from plancknull import telemetry
+from plancknull.tasks import Task
+
+def test_events_and_metrics(tmpdir):
+
+    events_file, metrics_file = tmpdir.join(telemetry.EVENTS_FILENAME), tmpdir.join(telemetry.METRICS_FILENAME)
+    tmpdir.mkdir("halfrings")
+    tmpdir.join("halfrings/30_SSfull_map.json").write(json.dumps(dict(timings=dict(read=2., anafast=1.))))
+    done, failed, up_to_date = [Task("halfrings", 30, "", surv, "IQU", False) for surv in ["full", 1, 2]]
+
+    events = telemetry.Telemetry(str(events_file), str(metrics_file), root_folder=str(tmpdir), interval=3600.)
+    events.run_started("local", 3)
+    for task in [done, failed]:
+        events.queued(task, 2**20)
+        events.started(task, worker=1)
+    assert "plancknull_tasks_running 2" in events.metrics()
+    events.completed(done, "done", 1, 3.5, dict(peak_memory=2**30, cache_hits=4, cache_misses=2))
+    events.completed(failed, "failed", 1, 0.5, error="Traceback\nValueError: bad map\n")
+    events.close([(done, "done", None), (failed, "failed", "ValueError: bad map"), (up_to_date, "up to date", None)])
+
+    records = [json.loads(line) for line in events_file.readlines()]
+    assert [record["event"] for record in records] == ["run_started", "queued", "started", "queued", "started",
+                                                       "finished", "failed", "up_to_date", "run_finished"]
+    finished = records[5]
+    assert finished["task"] == "halfrings/30_SSfull"
+    assert finished["stages"] == dict(read=2., anafast=1.)
+    assert finished["cache_hits"] == 4
+    assert records[6]["error"] == "ValueError: bad map"
+    assert records[-1]["finished"] == records[-1]["failed"] == records[-1]["up_to_date"] == 1
+
+    metrics = metrics_file.read()
+    assert 'plancknull_tasks_total{status="finished"} 1' in metrics
+    assert "plancknull_tasks_running 0" in metrics
+    assert "plancknull_bytes_read_total %d" % 2**20 in metrics
+    assert "plancknull_cache_hits_total 4" in metrics
+    assert 'plancknull_stage_seconds_total{stage="read"} 2.000' in metrics
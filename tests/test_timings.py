@@ -0,0 +1,61 @@
+import json
+import time
+import threading
+
+import sys
+sys.path.append("../../")
+from plancknull import timings
+
+def test_timed():
+
+    timings.reset()
+    with timings.timed("read"):
+        time.sleep(.01)
+
+    @timings.timed("read")
+    def read():
+        time.sleep(.01)
+    read()
+    with timings.timed("anafast"):
+        pass
+    elapsed = timings.take()
+    assert sorted(elapsed) == ["anafast", "read"]
+    assert elapsed["read"] >= .02
+    # the timers are reset
+    assert timings.take() == {}
+
+def test_thread_timers():
+
+    timings.reset()
+    elapsed = []
+    def node():
+        with timings.timed("smoothing"):
+            time.sleep(.01)
+        elapsed.append(timings.take())
+    with timings.timed("read"):
+        thread = threading.Thread(target=node)
+        thread.start()
+        thread.join()
+    # each thread has its own timers
+    assert sorted(elapsed[0]) == ["smoothing"]
+    assert sorted(timings.take()) == ["read"]
+
+def test_aggregate(tmpdir):
+
+    tmpdir.mkdir("surveydiff")
+    outputs = []
+    for i, seconds in enumerate([1., 2., 3.]):
+        base_filename = "surveydiff/30_SS1-SS%d" % (i + 2)
+        tmpdir.join(base_filename + "_map.json").write(json.dumps(dict(timings=dict(read=seconds, smoothing=1.))))
+        outputs.append(("surveydiff", base_filename))
+    # outputs of failed tasks are ignored
+    outputs.append(("surveydiff", "surveydiff/30_SS2-SS3"))
+
+    rows = dict((row[:2], row[2:]) for row in timings.aggregate(str(tmpdir), outputs))
+    assert rows["surveydiff", "read"][0] == 3
+    assert rows["surveydiff", "read"][1] == 2.
+    assert 2.8 < rows["surveydiff", "read"][2] <= 3.
+    assert rows["surveydiff", "total"][3] == 9.
+
+    table = timings.write_table(str(tmpdir), outputs)
+    assert tmpdir.join(timings.FILENAME).read().startswith(table)
@@ -0,0 +1,80 @@
+import os
+import json
+
+import sys
+sys.path.append("../../")
+from plancknull.runner import Run
+from plancknull.watch import Watcher
+from plancknull import fingerprint
+
+RUN_CONF = """[smooth_combine]
+nside = 16
+smoothing = 10
+degraded_nside = 8
+spectra = true
+chi2 = false
+[run]
+debug = false
+paral = false
+frequency = [30]
+reader_conf = %s
+output_folder = %s
+run_halfrings = true
+run_surveydiff = false
+run_chdiff = false
+watch_settle = 60
+"""
+
+READ_CONF = """[Templates]
+base_dir = %s
+map_frequency_halfring = %%(base_dir)s/RingHalf/map_{frequency:03d}_{survey}_ringhalf_{halfring}.fits
+ps_mask = %%(base_dir)s/MASKs/mask_ps_{frequency}.fits
+spectra_mask = %%(base_dir)s/MASKs/union_mask_{frequency}.fits
+galaxy_mask = %%(base_dir)s/MASKs/galaxy_mask_{frequency}.fits
+"""
+
+def test_watch_states(tmpdir):
+
+    tmpdir.join("read.conf").write(READ_CONF % tmpdir)
+    tmpdir.join("run.conf").write(RUN_CONF % (tmpdir.join("read.conf"), tmpdir.join("out")))
+    for mask in ["mask_ps_30", "union_mask_30", "galaxy_mask_30"]:
+        tmpdir.join("MASKs", mask + ".fits").write("", ensure=True)
+
+    run = Run(str(tmpdir.join("run.conf")))
+    watcher = Watcher(run)
+    task = run.tasks[0]
+    assert watcher.folders == [str(tmpdir.join("MASKs"))]
+    assert watcher.poll() == []
+    assert watcher.states[task]["state"] == "waiting"
+
+    # folders created during the watch are listed
+    tmpdir.mkdir("RingHalf")
+    assert watcher.poll() == []
+    assert watcher.folders == [str(tmpdir.join("MASKs")), str(tmpdir.join("RingHalf"))]
+
+    # new files settle before the task is scheduled
+    for halfring in [1, 2]:
+        tmpdir.join("RingHalf", "map_030_full_ringhalf_%d.fits" % halfring).write("")
+    assert watcher.poll() == []
+    assert watcher.states[task]["state"] == "settling"
+    old = os.path.getmtime(str(tmpdir.join("RingHalf"))) - 120
+    for f in tmpdir.join("RingHalf").listdir() + tmpdir.join("MASKs").listdir():
+        os.utime(str(f), (old, old))
+    assert watcher.poll() == [task]
+    assert watcher.states[task]["state"] == "runnable"
+
+    # completed, then an input changes
+    fingerprint.write_stamp(run.root_folder, task, fingerprint.task_fingerprint(task, run.mapreader, run.smooth_combine_config))
+    tmpdir.join("out", "halfrings", "30_SSfull_map.json").write("{}", ensure=True)
+    watcher.snapshot = None
+    assert watcher.poll() == []
+    assert watcher.states[task]["state"] == "done"
+    tmpdir.join("RingHalf", "map_030_full_ringhalf_1.fits").write("new")
+    os.utime(str(tmpdir.join("RingHalf", "map_030_full_ringhalf_1.fits")), (old + 60, old + 60))
+    assert watcher.poll() == [task]
+    assert watcher.states[task]["state"] == "stale"
+
+    watcher.write_status()
+    status = json.loads(tmpdir.join("out", "watch_status.json").read())
+    assert status["counts"] == dict(stale=1)
+    assert status["tasks"]["halfrings/30_SSfull"]["state"] == "stale"
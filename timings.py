@@ -0,0 +1,139 @@
+"""Wall time of the stages of the null tests
+
+The readers and smooth_combine add the wall time of their stages to the
+timers of the process: reading the input files (read), downgrading them
+(read_ud_grade), combining the maps (combine), fit_dipole, anafast and the
+white noise spectra (whitenoise_cl), smoothing the combined map (smoothing),
+smoothing the variance and galaxy masked maps for the chi2 (smoothing_chi2),
+degrading the output (ud_grade) and writing the FITS files (write).
+
+differences.write_outputs stores in the `timings` block of each `_map.json`
+the seconds spent in each stage since the previous output of the task, maps
+read once for several couples are accounted to the first one. At the end of
+a run, runner.Run writes the mean, 95th percentile and total of each stage
+by test type over the outputs of the completed tasks to run_timings.txt in
+the output folder.
+
+The timers of each thread are separate, e.g. of the nodes evaluated by
+pipeline.ThreadExecutor, stages are accounted to the next output written by
+the same thread.
+
+A timer costs two calls to time.time() and the peak memory readings of
+memory.py, the timers are always on.
+"""
+
+import os
+import json
+import time
+import threading
+import exceptions
+import functools
+import numpy as np
+
+import memory
+
+FILENAME = "run_timings.txt"
+
+class _Timers(threading.local):
+    def __init__(self):
+        self.elapsed = {}
+
+_timers = _Timers()
+
+class timed(object):
+    """Add the wall time of a block, or of each call of a function, to a stage
+
+    Examples
+    --------
+    >>> with timed("anafast"):
+    ...     cl = hp.anafast(maps)
+
+    >>> @timed("read")
+    ... def read_map(self, path, components):
+    """
+
+    def __init__(self, stage):
+        self.stage = stage
+
+    def __enter__(self):
+        memory.start_stage()
+        self.start = time.time()
+        return self
+
+    def __exit__(self, *exc_info):
+        _timers.elapsed[self.stage] = _timers.elapsed.get(self.stage, 0.) + time.time() - self.start
+        memory.end_stage(self.stage)
+
+    def __call__(self, function):
+        stage = self.stage
+
+        @functools.wraps(function)
+        def timed_function(*args, **kwargs):
+            with timed(stage):
+                return function(*args, **kwargs)
+        return timed_function
+
+def reset():
+    """Discard the wall time of the stages, e.g. of a failed task"""
+    _timers.elapsed.clear()
+
+def take():
+    """Seconds spent in each stage since the last call, the timers are reset"""
+    elapsed = dict((stage, round(seconds, 4)) for stage, seconds in _timers.elapsed.items())
+    reset()
+    return elapsed
+
+def aggregate(root_folder, outputs):
+    """Statistics of the timings of outputs by test type and stage
+
+    Parameters
+    ----------
+    root_folder : string
+        root path of the output files
+    outputs : list of tuples
+        (test_type, base_filename) of the outputs, e.g. of the completed
+        tasks, see tasks.task_outputs, outputs without timings are ignored
+
+    Returns
+    -------
+    rows : list of tuples
+        (test_type, stage, outputs, mean, p95, total) in seconds, sorted by
+        test type and stage, an output counts only in the stages it spent time in,
+        stage "total" is the sum of the stages of each output
+    """
+    seconds = {}
+    for test_type, base_filename in outputs:
+        try:
+            with open(os.path.join(root_folder, base_filename + "_map.json")) as f:
+                output_timings = json.load(f).get("timings")
+        except exceptions.IOError:
+            continue
+        if not output_timings:
+            continue
+        output_timings = dict(output_timings, total=sum(output_timings.values()))
+        for stage, value in output_timings.items():
+            seconds.setdefault((test_type, stage), []).append(value)
+    return [(test_type, stage, len(values), np.mean(values), np.percentile(values, 95), np.sum(values))
+            for (test_type, stage), values in sorted(seconds.items())]
+
+def format_table(rows):
+    lines = ["%-12s %-16s %7s %10s %10s %10s" % ("Test type", "Stage", "Outputs", "Mean [s]", "P95 [s]", "Total [s]")]
+    for row in rows:
+        lines.append("%-12s %-16s %7d %10.3f %10.3f %10.1f" % row)
+    return "\n".join(lines)
+
+def write_table(root_folder, outputs, filename=None):
+    """Write the timings of outputs by test type and stage, see aggregate
+
+    Returns
+    -------
+    table : string
+        text of the table, empty without timings
+    """
+    rows = aggregate(root_folder, outputs)
+    if not rows:
+        return ""
+    table = format_table(rows)
+    with open(filename or os.path.join(root_folder, FILENAME), "w") as f:
+        f.write(table + "\n")
+    return table
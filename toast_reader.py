@@ -1,4 +1,5 @@
 from reader import *
+import timings
 
 class SingleFolderToastReader(BaseMapReader):
     """All maps in a single folder, Toast naming convention"""
@@ -91,7 +92,8 @@ class SingleFolderToastReader(BaseMapReader):
                 raise exceptions.IOError(error_log)
 
             log.info("Reading %s" % os.path.basename(filename))
-            output_map.append(hp.ma(hp.read_map(filename, components)))
+            with timings.timed("read"):
+                output_map.append(hp.ma(hp.read_map(filename, components)))
             #output_map.append(None)
 
         if bp_corr:
@@ -102,7 +104,8 @@ class SingleFolderToastReader(BaseMapReader):
                 bp_corr_filename += surv.replace("survey_", "ss")
             bp_corr_filename += ".fits"
             log.info("Applying bandpass correction: " + bp_corr_filename)
-            corr_map = hp.ma(hp.read_map(os.path.join(folder, "bandpass_correction", bp_corr_filename), (0,1,2)))
+            with timings.timed("read"):
+                corr_map = hp.ma(hp.read_map(os.path.join(folder, "bandpass_correction", bp_corr_filename), (0,1,2)))
             for comp, corr in zip(output_map[0], corr_map):
                 comp += corr
 
@@ -113,6 +116,7 @@ class SingleFolderToastReader(BaseMapReader):
             out = output_map[0]
 
         if self.nside:
-            out = hp.ud_grade(out, self.nside)
+            with timings.timed("read_ud_grade"):
+                out = hp.ud_grade(out, self.nside)
         return out
 
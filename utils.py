@@ -36,7 +36,7 @@ def get_whitenoise_cl(var, mask):
     log.info("Masked pixels: %d" % mask.sum())
     return (var.filled() * ~mask).mean() * 4 * np.pi / len(var)
 
-def smooth_variance_map(var_m, fwhm):
+def smooth_variance_map(var_m, fwhm, smoothing=None):
     """Smooth a variance map
 
     Algorithm from 'Pixel errors in convolved maps'
@@ -48,6 +48,8 @@ def smooth_variance_map(var_m, fwhm):
         input variance map
     fwhm : float (radians)
         target fwhm
+    smoothing : callable or None
+        smoothing(map, fwhm=fwhm), by default hp.smoothing
 
     Returns
     -------
@@ -57,7 +59,10 @@ def smooth_variance_map(var_m, fwhm):
 
     # smooth map
     fwhm_variance = fwhm / np.sqrt(2)
-    smoothed_var_m = hp.smoothing(var_m, fwhm=fwhm_variance, regression=False)
+    if smoothing is None:
+        smoothed_var_m = hp.smoothing(var_m, fwhm=fwhm_variance, regression=False)
+    else:
+        smoothed_var_m = smoothing(var_m, fwhm=fwhm_variance)
 
     # normalization factor
     pix_area = hp.nside2pixarea(hp.npix2nside(len(var_m)))
@@ -0,0 +1,204 @@
+"""Watch mode, null tests run as the input files of a release land
+
+Usage:
+    python run_null.py run_dx11.conf --watch
+
+Every `watch_interval` seconds (default 60) in the [run] section, the
+folders of the [Templates] of the reader configuration are listed, including
+the folders created since the watch started; when a file appears, changes or
+disappears, the state of every task is worked out
+again from its input files and fingerprint, see fingerprint.py:
+
+ * waiting: some inputs are missing or ambiguous
+ * settling: all inputs exist, but one was modified less than `watch_settle`
+   seconds ago (default watch_interval), it might still be copied
+ * runnable: never completed, scheduled
+ * stale: completed with other inputs or configuration, scheduled
+ * done: up to date
+ * failed: failed with the current inputs, retried when they change
+
+The runnable and stale tasks are executed with the configured back end, the
+MPI back end is not supported. The state of all the tasks is kept up to date
+in a json status file, `watch_status` or watch_status.json in the output
+folder. With `watch_until_complete = true` the watch ends when all the tasks
+are done or failed, otherwise on Ctrl-C.
+"""
+
+import os
+import re
+import json
+import time
+import exceptions
+import logging as log
+from glob import glob
+from ConfigParser import NoOptionError
+
+import fingerprint
+from tasks import task_name
+
+STATUS_FILENAME = "watch_status.json"
+SCHEDULED = ["runnable", "stale"]
+
+def template_folders(mapreader):
+    """Existing folders matched by the filename templates of a reader"""
+    folders = set()
+    for name, value in mapreader.config.items("Templates"):
+        if name.startswith("base_dir"):
+            continue
+        folder = os.path.dirname(re.sub(r"\{[^}]*\}", "*", value))
+        folders.update(f for f in glob(folder) if os.path.isdir(f))
+    return sorted(folders)
+
+def snapshot(folders):
+    """Name, modification time and size of all the files of folders"""
+    files = []
+    for folder in folders:
+        try:
+            names = os.listdir(folder)
+        except exceptions.OSError:
+            continue
+        for name in names:
+            path = os.path.join(folder, name)
+            try:
+                st = os.stat(path)
+            except exceptions.OSError:
+                continue
+            files.append((path, st.st_mtime, st.st_size))
+    return sorted(files)
+
+class Watcher(object):
+    """Runs the tasks of a run as their inputs become available or change
+
+    Parameters
+    ----------
+    run : runner.Run
+        run to watch, its tasks are executed with resume
+    """
+
+    def __init__(self, run):
+        if run.backend == "mpi":
+            raise exceptions.ValueError("Watch mode is not supported by the mpi back end")
+        self.run = run
+        run.resume = True
+        self.interval = run.option("watch_interval", 60., "getfloat")
+        self.settle = run.option("watch_settle", self.interval, "getfloat")
+        self.status_filename = run.option("watch_status", os.path.join(run.root_folder, STATUS_FILENAME))
+        self.folders = template_folders(run.mapreader)
+        self.snapshot = None
+        self.states = dict((task, dict(state="waiting", since=time.time())) for task in run.tasks)
+        # fingerprint of the inputs of the failed tasks
+        self.failed = {}
+        self.polls = 0
+        self.runs = 0
+
+    def set_state(self, task, state, error=None):
+        entry = self.states[task]
+        if entry["state"] != state:
+            entry.update(state=state, since=time.time())
+        entry["error"] = error
+
+    def task_state(self, task):
+        """State of a task from its input files, see the module docstring
+
+        Returns
+        -------
+        state : string
+        error : string or None
+            the missing input of waiting tasks
+        """
+        mapreader = self.run.mapreader
+        chi2 = self.run.smooth_combine_config["chi2"]
+        try:
+            files = fingerprint.task_input_files(task, mapreader, chi2)
+        except (NoOptionError, exceptions.IOError) as e:
+            return "waiting", str(e)
+        try:
+            newest = max(os.path.getmtime(f) for f in files)
+        except exceptions.OSError as e:
+            return "waiting", str(e)
+        if time.time() - newest < self.settle:
+            return "settling", None
+        task_fingerprint = fingerprint.task_fingerprint(task, mapreader, self.run.smooth_combine_config)
+        if fingerprint.is_up_to_date(self.run.root_folder, task, task_fingerprint):
+            return "done", None
+        if self.failed.get(task) == task_fingerprint:
+            return "failed", self.states[task].get("error")
+        if os.path.exists(fingerprint.stamp_filename(self.run.root_folder, task)):
+            return "stale", None
+        return "runnable", None
+
+    def poll(self):
+        """Update the states of the tasks if the template folders changed
+
+        Returns
+        -------
+        tasks : list of Task
+            runnable and stale tasks
+        """
+        self.polls += 1
+        # folders of a release, e.g. Surveys/, might be created during the watch
+        self.folders = template_folders(self.run.mapreader)
+        current = snapshot(self.folders)
+        settling = any(entry["state"] == "settling" for entry in self.states.values())
+        if current != self.snapshot or settling:
+            self.snapshot = current
+            for task in self.run.tasks:
+                self.set_state(task, *self.task_state(task))
+        return [task for task in self.run.tasks if self.states[task]["state"] in SCHEDULED]
+
+    def execute(self, tasks):
+        """Run tasks with the back end of the run and record their outcome"""
+        for task in tasks:
+            self.set_state(task, "running")
+        self.write_status()
+        self.runs += 1
+        for task, status, error in self.run.execute(tasks):
+            if status in ["done", "up to date"]:
+                self.set_state(task, "done")
+            elif status == "skipped":
+                self.set_state(task, "waiting", error)
+            else:
+                self.failed[task] = fingerprint.task_fingerprint(task, self.run.mapreader, self.run.smooth_combine_config)
+                self.set_state(task, "failed", error)
+        self.write_status()
+
+    def counts(self):
+        counts = {}
+        for entry in self.states.values():
+            counts[entry["state"]] = counts.get(entry["state"], 0) + 1
+        return counts
+
+    def write_status(self):
+        """Write the state of all the tasks to the status file"""
+        status = dict(updated=time.time(), polls=self.polls, runs=self.runs, counts=self.counts(),
+                      folders=self.folders,
+                      tasks=dict((task_name(task), entry) for task, entry in self.states.items()))
+        tmp_filename = "%s.tmp%d" % (self.status_filename, os.getpid())
+        with open(tmp_filename, "w") as f:
+            json.dump(status, f, indent=4, sort_keys=True)
+        os.rename(tmp_filename, self.status_filename)
+
+    def is_complete(self):
+        return all(entry["state"] in ["done", "failed"] for entry in self.states.values())
+
+    def watch(self, until_complete=None):
+        """Poll and run until interrupted or, with until_complete, all tasks are done or failed"""
+        if until_complete is None:
+            until_complete = self.run.option("watch_until_complete", False, "getboolean")
+        log.info("Watching %d folders every %.0f s, status in %s" % (len(self.folders), self.interval, self.status_filename))
+        try:
+            while True:
+                tasks = self.poll()
+                self.write_status()
+                if tasks:
+                    print "WATCH: run %d tasks, %s" % (len(tasks), json.dumps(self.counts(), sort_keys=True))
+                    self.execute(tasks)
+                    # tasks might have become runnable while running
+                    continue
+                if until_complete and self.is_complete():
+                    break
+                time.sleep(self.interval)
+        except KeyboardInterrupt:
+            log.info("Watch interrupted")
+        self.write_status()
+        print "WATCH: %s" % json.dumps(self.counts(), sort_keys=True)
@@ -0,0 +1,110 @@
+"""Timeouts and retries of the tasks of the local and ipython back ends
+
+A read from a shared filesystem can hang for tens of minutes, stalling a
+worker. The watchdog gives each task a timeout of `timeout_factor` in the
+[run] section (default 10, 0 disables timeouts) times its expected wall
+time, at least `timeout_min` seconds (default 600). The expected wall time
+is the last one recorded in the history, see history.py, or for tasks never
+run before the planned one, see planner.estimate_wall_time, with inputs read
+at `io_rate` MB/s, so that a read hanging in a first run is also caught.
+
+A local worker running a task past its timeout is killed and replaced, it
+has its own result queue, see scheduler.run_local, so that killing it cannot
+block the queue of the other workers. An ipython engine is left out of the
+rest of the run. Failed and timed out
+tasks are retried up to `task_retries` times (default 2) on another worker
+if there is one, after `retry_backoff` seconds (default 30) doubling at
+each retry. The error of a task that failed all its attempts lists the
+error or traceback of every attempt with the worker that ran it.
+"""
+
+import time
+import logging as log
+
+from tasks import task_name
+
+class Watchdog(object):
+    """Timeouts, attempts and retries of the tasks of a run
+
+    Parameters
+    ----------
+    timeout : callable or None
+        timeout(task) in seconds, None for no timeout
+    retries : int
+        number of retries of a failed or timed out task
+    backoff : float
+        seconds before the first retry, doubled at each retry
+    """
+
+    def __init__(self, timeout=None, retries=2, backoff=30.):
+        self.timeout = timeout or (lambda task: None)
+        self.retries = retries
+        self.backoff = backoff
+        self.attempts = {}
+        self.delayed = []
+        # workers left out of the run after a timeout
+        self.hung = set()
+        self.abandoned = set()
+
+    def expired(self, task, start, now=None):
+        """Whether a task started at start is running past its timeout"""
+        timeout = self.timeout(task)
+        return timeout is not None and (now or time.time()) - start > timeout
+
+    def timeout_error(self, task, start):
+        return "Timed out after %.0f s, limit %.0f s" % (time.time() - start, self.timeout(task))
+
+    def failed(self, task_id, task, worker, error):
+        """Record a failed attempt and schedule a retry if any is left
+
+        Returns
+        -------
+        retry : bool
+            whether the task is retried, see ready
+        """
+        attempts = self.attempts.setdefault(task, [])
+        attempts.append((worker, error))
+        if len(attempts) > self.retries:
+            log.error("%s failed %d times" % (task_name(task), len(attempts)))
+            return False
+        delay = self.backoff * 2**(len(attempts) - 1)
+        log.warning("%s failed on worker %s, retry in %.0f s" % (task_name(task), str(worker), delay))
+        self.delayed.append((time.time() + delay, task_id, task))
+        return True
+
+    def ready(self, now=None):
+        """Tasks whose retry is due, removed from the delayed tasks
+
+        Returns
+        -------
+        items : list of tuples
+            (task_id, task)
+        """
+        now = now or time.time()
+        due = [item for item in self.delayed if item[0] <= now]
+        self.delayed = [item for item in self.delayed if item[0] > now]
+        return [(task_id, task) for ready_time, task_id, task in sorted(due)]
+
+    def avoid(self, task, worker, workers):
+        """Whether worker should not run task, because it failed there and other workers are available"""
+        failed_on = set(w for w, error in self.attempts.get(task, []))
+        return worker in failed_on and any(w not in failed_on for w in workers)
+
+    def abandon(self, task, error):
+        """Record the last error of a task that is not retried, e.g. without workers left"""
+        self.attempts.setdefault(task, []).append((None, error))
+        self.abandoned.add(task)
+
+    def gave_up(self, task):
+        """Whether a task failed all its attempts or was abandoned"""
+        return task in self.abandoned or len(self.attempts.get(task, [])) > self.retries
+
+    def error(self, task):
+        """Errors of all the attempts of a task"""
+        return "\n".join("Attempt %d on worker %s: %s" % (i + 1, str(worker), error)
+                         for i, (worker, error) in enumerate(self.attempts.get(task, [])))
+
+    def print_report(self):
+        """Print the number of failed attempts, if any"""
+        if self.attempts:
+            print "Watchdog: %d failed attempts of %d tasks" % (sum(len(a) for a in self.attempts.values()), len(self.attempts))